@@ -12,6 +12,7 @@ from vehicles.time_aware_polyline import encode_time_aware_polyline
 from busstops.models import Operator, Service, StopPoint
 from bustimes.models import StopTime, Trip
 from bustimes.utils import contiguous_stoptimes_only
+from vehicles.history import get_archived_locations
 from vehicles.models import Livery, Vehicle, VehicleJourney, VehicleType
 from vehicles.utils import redis_client
 
@@ -172,7 +173,9 @@ class VehicleJourneyViewSet(viewsets.ReadOnlyModelViewSet):
             extra_data["times"] = serializers.TripSerializer().get_times(instance.trip)
 
         if redis_client:
-            locations = redis_client.lrange(instance.get_redis_key(), 0, -1)
+            locations = redis_client.lrange(
+                instance.get_redis_key(), 0, -1
+            ) or get_archived_locations(instance)
             locations = [
                 struct.unpack("I 2f ?h ?h", location) for location in locations
             ]
@@ -344,6 +344,32 @@ TNDS_DIR = DATA_DIR / "TNDS"
 
 AVL_ARCHIVE_DIR = DATA_DIR / "avl"
 
+# journey location histories are moved from Redis to here after this many hours
+# without any new locations (see vehicles/history.py)
+JOURNEY_HISTORY_DIR = DATA_DIR / "history"
+JOURNEY_HISTORY_HOURS = int(os.environ.get("JOURNEY_HISTORY_HOURS", 6))
+
+# store live locations in Redis in a compact binary format, rather than JSON
+# (turn on once everything that reads them understands both)
+VEHICLE_LOCATION_BINARY = bool(os.environ.get("VEHICLE_LOCATION_BINARY", False))
+# update live locations using a Lua script, so that older locations never overwrite
+# newer ones (e.g. when a SIRI-VM push and a poll of the same feed overlap)
+VEHICLE_LOCATION_SCRIPT = bool(os.environ.get("VEHICLE_LOCATION_SCRIPT", False))
+# work out vehicles' progress along their trips (and delays) when importing
+# locations, rather than when someone looks at a departure board or the map
+VEHICLE_LOCATION_PROGRESS = bool(os.environ.get("VEHICLE_LOCATION_PROGRESS", False))
+# how many trips' stop times and shapes to keep in memory for that
+# (should be at least the number of trips being tracked at once)
+TRIP_GEOMETRY_CACHE_SIZE = int(os.environ.get("TRIP_GEOMETRY_CACHE_SIZE", 20000))
+
+# posts to SIRI-VM subscriptions are handled by a long-running consume_siri_posts
+# process, rather than by a handle_siri_post task each
+SIRI_POST_CONSUMER = bool(os.environ.get("SIRI_POST_CONSUMER", False))
+# how many seconds of recent posts to keep in each subscription's Redis stream
+# (posts can be several MB, so only enough to cover a handle_siri_post task queue
+# or consumer lag - older posts are dropped, and counted, if they haven't been handled)
+SIRI_POST_STREAM_AGE = int(os.environ.get("SIRI_POST_STREAM_AGE", 300))
+
 FLICKR_API_KEY = os.environ.get("FLICKR_API_KEY")
 
 STADIA_MAPS_API_KEY = os.environ.get("STADIA_MAPS_API_KEY")
@@ -34,6 +34,7 @@ urlpatterns = [
     path("503", TemplateView.as_view(template_name="503.html")),
     path("data", TemplateView.as_view(template_name="data.html")),
     path("status", views.status),
+    path("status.json", views.status_json),
     path("timetable-source-stats.json", views.timetable_source_stats),
     path("stats.json", views.stats),
     path(
@@ -277,30 +277,68 @@ def contact(request):
     return render(request, "contact.html", {"form": form, "submitted": submitted})
 
 
+BOD_AVL_STATUS_KEYS = [
+    f"{key}_status"
+    for key in ("bod_avl", "Transport_for_Wales", "Bus_Open_Data", "Todd's_Travel")
+]
+AVL_STATUS_KEYS = [
+    "Realtime_Transport_Operators_status",
+    "Irish_Citylink_status",
+    "Translink_status",
+    "Stagecoach_status",
+    "Ember_status",
+    "TfE_status",
+    "jersey_status",
+]
+
+
+def summarise_avl_status(status) -> dict:
+    """mean and maximum time taken by each stage, and the operators whose journeys
+    took longest to match, over a list of recent updates (Status namedtuples)
+    """
+    stages = {}
+    operators = {}
+    for item in status:
+        for name, seconds in (item.stages or {}).items():
+            stages.setdefault(name, []).append(seconds)
+        for operator_id, (items, seconds) in (item.operators or {}).items():
+            totals = operators.setdefault(operator_id, [0, 0])
+            totals[0] += items
+            totals[1] += seconds
+    return {
+        "stages": [
+            (name, round(sum(times) / len(times), 3), max(times))
+            for name, times in stages.items()
+        ],
+        "operators": sorted(
+            (
+                (operator_id, items, round(seconds, 3))
+                for operator_id, (items, seconds) in operators.items()
+            ),
+            key=lambda operator: operator[2],
+            reverse=True,
+        )[:10],
+    }
+
+
 def status(request):
     context = {
         "sources": DataSource.objects.filter(
             name__in=["National Operator Codes", "NPTG", "NaPTAN", "Irish NaPTAN"]
         ),
-        "bod_avl_status": {},
+        "bod_avl_status": [],
     }
 
-    for key in ("bod_avl", "Transport_for_Wales", "Bus_Open_Data", "Todd's_Travel"):
-        key = f"{key}_status"
+    for key in BOD_AVL_STATUS_KEYS:
         if status := cache.get(key):
-            context["bod_avl_status"][key] = status
-
-    context["statuses"] = cache.get_many(
-        [
-            "Realtime_Transport_Operators_status",
-            "Irish_Citylink_status",
-            "Translink_status",
-            "Stagecoach_status",
-            "Ember_status",
-            "TfE_status",
-            "jersey_status",
-        ]
-    ).items()
+            context["bod_avl_status"].append(
+                (key, status, summarise_avl_status(status))
+            )
+
+    context["statuses"] = [
+        (key, status, summarise_avl_status(status))
+        for key, status in cache.get_many(AVL_STATUS_KEYS).items()
+    ]
 
     return render(
         request,
@@ -390,6 +428,30 @@ def stats(request):
     return JsonResponse(cache.get("vehicle-tracking-stats", []), safe=False)
 
 
+def status_json(request):
+    """recent live vehicle updates, with per-stage and per-operator timings"""
+
+    def get_seconds(value):
+        if type(value) is datetime.timedelta:
+            return value.total_seconds()
+        return value
+
+    statuses = cache.get_many(BOD_AVL_STATUS_KEYS + AVL_STATUS_KEYS)
+    return JsonResponse(
+        {
+            key: [
+                {
+                    **item._asdict(),
+                    "age": get_seconds(item.age),
+                    "time_taken": get_seconds(item.time_taken),
+                }
+                for item in status
+            ]
+            for key, status in statuses.items()
+        }
+    )
+
+
 def timetable_source_stats(request):
     return JsonResponse(cache.get("timetable-source-stats", []), safe=False)
 
@@ -13,6 +13,7 @@ from django.db.models.functions import Now
 from django.utils.dateparse import parse_duration
 
 from busstops.models import AdminArea, DataSource, Operator, Region, Service, StopPoint
+from vehicles.rtpi import TripCache
 
 from ...download_utils import download_if_modified
 from ...utils import log_time_taken
@@ -293,6 +294,8 @@ class Command(BaseCommand):
             service.update_search_vector()
 
         services.update(modified_at=Now())
+        # let live vehicle importers know that their cached services might be stale
+        TripCache.services_modified()
 
         self.source.save(update_fields=["datetime"])
 
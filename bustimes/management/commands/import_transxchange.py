@@ -2,23 +2,31 @@
 Usage:
 
     ./manage.py import_transxchange EA.zip [EM.zip etc]
+
+or, to handle an archive's files in 4 worker processes:
+
+    ./manage.py import_transxchange --processes 4 EA.zip
 """
 
 import datetime
 import hashlib
 import logging
+import multiprocessing
 import os
 import sys
+from contextlib import nullcontext
 from pathlib import Path
+from queue import Empty
 import re
 import zipfile
+import zlib
 from functools import cache
 
 from tqdm import tqdm
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.contrib.gis.geos import GEOSGeometry, Point
-from django.db import IntegrityError
+from django.db import IntegrityError, connections
 from django.db.models import Count, Exists, OuterRef, Q
 from django.db.models.functions import Now, Upper
 from django.utils.timezone import localdate
@@ -37,6 +45,7 @@ from busstops.management.commands.naptan_new import get_stop
 from busstops.utils import get_datetime
 from txc import TransXChange
 from vehicles.models import get_text_colour
+from vehicles.rtpi import TripCache
 from vosa.models import Registration
 
 from ...models import (
@@ -413,6 +422,10 @@ def get_description(txc_service):
 class Command(BaseCommand):
     bank_holidays = None
     version = None
+    processes = 1
+    # held while getting or creating things shared between worker processes
+    # (see handle_in_processes)
+    lock = nullcontext()
 
     @staticmethod
     def add_arguments(parser):
@@ -424,6 +437,12 @@ class Command(BaseCommand):
             default=sys.stdout.isatty(),
             help="Show progress bar (default: auto-detect based on terminal)",
         )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of worker processes to handle each archive's files in",
+        )
 
     def set_up(self):
         self.calendar_cache = {}
@@ -435,6 +454,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         self.set_up()
         self.show_progress = options["progress"]
+        self.processes = options["processes"]
 
         self.open_data_operators, self.incomplete_operators = get_open_data_operators()
 
@@ -582,6 +602,103 @@ class Command(BaseCommand):
                 elif filename.endswith(".zip"):
                     self.handle_sub_archive(sub_archive, filename)
 
+    def handle_archive_member(self, archive, filename):
+        if filename.startswith("__MACOSX"):
+            return
+
+        if filename.endswith(".zip"):
+            self.handle_sub_archive(archive, filename)
+
+        if filename.endswith(".xml"):
+            with archive.open(filename) as open_file:
+                self.handle_file(open_file, filename)
+
+    def handle_in_processes(self, archive_path: Path, filenames):
+        """handle an archive's files in worker processes.
+
+        Reading and parsing files happens in parallel, but only one worker at a time
+        can be in handle_service (which finds or creates Services, ServiceColours,
+        VehicleTypes, Notes etc, then writes routes and trips), so services are
+        matched the same way as in a single process - just maybe in a different order.
+        Files with the same TNDS-style service code (or in the same sub-archive)
+        go to the same worker, so at least those are handled in order
+        """
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        self.lock = context.Lock()
+
+        shards = [[] for _ in range(self.processes)]
+        for filename in filenames:
+            key = get_service_code(filename) or filename
+            shards[zlib.crc32(key.encode()) % self.processes].append(filename)
+
+        # each worker must open its own database connection
+        connections.close_all()
+
+        workers = [
+            context.Process(
+                target=self.work, args=(archive_path, shard, i, results), daemon=True
+            )
+            for i, shard in enumerate(filter(None, shards))
+        ]
+        for worker in workers:
+            worker.start()
+
+        errors = []
+        finished = set()
+        try:
+            while len(finished) < len(workers):
+                # (check before waiting, so the result of a worker that has just
+                # finished is already in the queue)
+                dead = [
+                    worker
+                    for i, worker in enumerate(workers)
+                    if i not in finished and not worker.is_alive()
+                ]
+                try:
+                    i, service_ids, route_ids, error = results.get(
+                        timeout=1 if dead else 60
+                    )
+                except Empty:
+                    if dead:
+                        raise CommandError(
+                            f"{archive_path.name}: worker process exited "
+                            f"with code {dead[0].exitcode} without finishing"
+                        )
+                    continue
+                finished.add(i)
+                self.service_ids.update(service_ids)
+                self.route_ids.update(route_ids)
+                if error:
+                    errors.append(error)
+        finally:
+            for worker in workers:
+                if worker.is_alive() and len(finished) < len(workers):
+                    worker.kill()
+                worker.join()
+            self.lock = nullcontext()
+
+        if errors:
+            # (don't go on to mark services as not current)
+            raise CommandError(f"{archive_path.name}: {errors}")
+
+    def work(self, archive_path: Path, filenames, i: int, results):
+        """(in a worker process)"""
+        self.service_ids = set()
+        self.route_ids = set()
+        error = None
+
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                for filename in filenames:
+                    self.handle_archive_member(archive, filename)
+        except Exception as e:
+            logger.exception(e)
+            error = repr(e)
+
+        results.put((i, self.service_ids, self.route_ids, error))
+        connections.close_all()
+
     def handle_archive(self, archive_path: Path, filenames):
         self.service_ids = set()
         self.route_ids = set()
@@ -599,19 +716,15 @@ class Command(BaseCommand):
                 namelist = archive.namelist()
 
                 items = filenames or namelist
-                if self.show_progress:
-                    items = tqdm(items, desc=basename)
-
-                for filename in items:
-                    if filename.startswith("__MACOSX"):
-                        continue
 
-                    if filename.endswith(".zip"):
-                        self.handle_sub_archive(archive, filename)
+                if self.processes > 1:
+                    self.handle_in_processes(archive_path, items)
+                else:
+                    if self.show_progress:
+                        items = tqdm(items, desc=basename)
 
-                    if filename.endswith(".xml"):
-                        with archive.open(filename) as open_file:
-                            self.handle_file(open_file, filename)
+                    for filename in items:
+                        self.handle_archive_member(archive, filename)
         except zipfile.BadZipFile:
             with archive_path.open("rb") as open_file:
                 self.handle_file(open_file, str(archive_path))
@@ -653,14 +766,17 @@ class Command(BaseCommand):
                     service.operator.set(operators)
 
         services.update(modified_at=Now())
+        # let live vehicle importers know that their cached services might be stale
+        TripCache.services_modified()
 
     def get_bank_holiday(self, bank_holiday_name: str):
         if self.bank_holidays is None:
             self.bank_holidays = BankHoliday.objects.in_bulk(field_name="name")
         if bank_holiday_name not in self.bank_holidays:
-            self.bank_holidays[bank_holiday_name] = BankHoliday.objects.create(
-                name=bank_holiday_name
-            )
+            with self.lock:
+                self.bank_holidays[bank_holiday_name] = (
+                    BankHoliday.objects.get_or_create(name=bank_holiday_name)[0]
+                )
         return self.bank_holidays[bank_holiday_name]
 
     def do_bank_holidays(self, holiday_elements, operation: bool, calendar_dates: list):
@@ -818,9 +934,10 @@ class Command(BaseCommand):
 
     @cache
     def get_note(self, note_code=None, note_text=None):
-        return Note.objects.get_or_create(
-            code=note_code or "", text=(note_text or "")[:255]
-        )[0]
+        with self.lock:
+            return Note.objects.get_or_create(
+                code=note_code or "", text=(note_text or "")[:255]
+            )[0]
 
     def handle_journeys(
         self,
@@ -892,13 +1009,14 @@ class Command(BaseCommand):
 
             if journey.vehicle_type and journey.vehicle_type.code:
                 if journey.vehicle_type.code not in self.vehicle_types:
-                    (
-                        self.vehicle_types[journey.vehicle_type.code],
-                        _,
-                    ) = VehicleType.objects.get_or_create(
-                        code=journey.vehicle_type.code,
-                        description=journey.vehicle_type.description or "",
-                    )
+                    with self.lock:
+                        (
+                            self.vehicle_types[journey.vehicle_type.code],
+                            _,
+                        ) = VehicleType.objects.get_or_create(
+                            code=journey.vehicle_type.code,
+                            description=journey.vehicle_type.description or "",
+                        )
                 trip.vehicle_type = self.vehicle_types[journey.vehicle_type.code]
 
             if journey.garage_ref:
@@ -1155,250 +1273,264 @@ class Command(BaseCommand):
             if self.should_defer_to_other_source(operators, line.line_name):
                 continue
 
-            existing = None
+            # (matching and saving services, in a lock in case other worker processes
+            # are matching the same service)
+            with self.lock:
+                existing = None
 
-            services = Service.objects.order_by("-current", "id").filter(
-                Q(line_name__iexact=line.line_name)
-                | Exists(
-                    Route.objects.filter(
-                        line_name__iexact=line.line_name, service=OuterRef("id")
+                services = Service.objects.order_by("-current", "id").filter(
+                    Q(line_name__iexact=line.line_name)
+                    | Exists(
+                        Route.objects.filter(
+                            line_name__iexact=line.line_name, service=OuterRef("id")
+                        )
                     )
                 )
-            )
 
-            if operators:
-                q = Q(operator__in=operators.values())
+                if operators:
+                    q = Q(operator__in=operators.values())
+
+                    # prevent certain seemingly-the-same services being merged
+                    if (
+                        description
+                        and self.source.name.startswith("Stagecoach")
+                        and (
+                            line.line_name == "1"
+                            and "Chester" in description
+                            or (
+                                line.line_name == "59"
+                                and self.source.name == "Stagecoach East Scotland"
+                            )
+                            or line.line_name == "700"
+                        )
+                    ):
+                        q = (Q(source=self.source) | q) & Q(description=description)
+                    existing = services.filter(q)
+                else:
+                    existing = services
 
-                # prevent certain seemingly-the-same services being merged
-                if (
-                    description
-                    and self.source.name.startswith("Stagecoach")
-                    and (
-                        line.line_name == "1"
-                        and "Chester" in description
-                        or (
-                            line.line_name == "59"
-                            and self.source.name == "Stagecoach East Scotland"
+                if len(transxchange.services) == 1:
+                    has_stop_time = Exists(
+                        StopTime.objects.filter(
+                            stop__in=stops, trip__route__service=OuterRef("id")
                         )
-                        or line.line_name == "700"
                     )
-                ):
-                    q = (Q(source=self.source) | q) & Q(description=description)
-                existing = services.filter(q)
-            else:
-                existing = services
-
-            if len(transxchange.services) == 1:
-                has_stop_time = Exists(
-                    StopTime.objects.filter(
-                        stop__in=stops, trip__route__service=OuterRef("id")
+                    has_stop_usage = Exists(
+                        StopUsage.objects.filter(stop__in=stops, service=OuterRef("id"))
                     )
-                )
-                has_stop_usage = Exists(
-                    StopUsage.objects.filter(stop__in=stops, service=OuterRef("id"))
-                )
-                has_no_route = ~Exists(
-                    Trip.objects.filter(route__service=OuterRef("id"))
-                )
-                condition = has_stop_time | (has_stop_usage & has_no_route)
-            else:
-                condition = Exists(
-                    Route.objects.filter(
-                        service_code=txc_service.service_code,
-                        service=OuterRef("id"),
+                    has_no_route = ~Exists(
+                        Trip.objects.filter(route__service=OuterRef("id"))
                     )
-                )
-                if description:
-                    condition |= Q(description=description)
-
-            existing = existing.filter(condition).first()
-
-            service_code = None
-
-            if self.source.is_tnds():
-                service_code = get_service_code(filename)
-                if service_code is None:
-                    service_code = txc_service.service_code
-
-                if not existing:
-                    if service_code[:4] == "tfl_":
-                        existing = self.source.service_set.filter(
-                            Q(service_code=service_code)
-                            | Q(line_name__iexact=line.line_name)
-                            & (
-                                Q(description=description)
-                                | Q(operator__in=operators.values())
-                            )
-                        ).first()
-                    else:
-                        existing = self.source.service_set.filter(
-                            Q(
-                                service_code=service_code,
-                                operator__in=operators.values(),
-                            )
-                            | Q(
-                                description=description,
-                                line_name__iexact=line.line_name,
-                            )
-                        ).first()
-            elif unique_service_code:
-                service_code = unique_service_code
-
-                if not existing:
-                    # try getting by BODS profile compliant service code
-                    existing = services.filter(service_code=service_code).first()
-
-            if existing:
-                service = existing
-                existing_current_service = existing.current
-            else:
-                service = Service()
-                existing_current_service = False
+                    condition = has_stop_time | (has_stop_usage & has_no_route)
+                else:
+                    condition = Exists(
+                        Route.objects.filter(
+                            service_code=txc_service.service_code,
+                            service=OuterRef("id"),
+                        )
+                    )
+                    if description:
+                        condition |= Q(description=description)
+
+                existing = existing.filter(condition).first()
+
+                service_code = None
+
+                if self.source.is_tnds():
+                    service_code = get_service_code(filename)
+                    if service_code is None:
+                        service_code = txc_service.service_code
+
+                    if not existing:
+                        if service_code[:4] == "tfl_":
+                            existing = self.source.service_set.filter(
+                                Q(service_code=service_code)
+                                | Q(line_name__iexact=line.line_name)
+                                & (
+                                    Q(description=description)
+                                    | Q(operator__in=operators.values())
+                                )
+                            ).first()
+                        else:
+                            existing = self.source.service_set.filter(
+                                Q(
+                                    service_code=service_code,
+                                    operator__in=operators.values(),
+                                )
+                                | Q(
+                                    description=description,
+                                    line_name__iexact=line.line_name,
+                                )
+                            ).first()
+                elif unique_service_code:
+                    service_code = unique_service_code
+
+                    if not existing:
+                        # try getting by BODS profile compliant service code
+                        existing = services.filter(service_code=service_code).first()
+
+                if existing:
+                    service = existing
+                    existing_current_service = existing.current
+                else:
+                    service = Service()
+                    existing_current_service = False
 
-            service.line_name = line.line_name
-            service.source = self.source
-            service.current = True
+                service.line_name = line.line_name
+                service.source = self.source
+                service.current = True
 
-            journeys = transxchange.get_journeys(txc_service.service_code, line.id)
+                journeys = transxchange.get_journeys(txc_service.service_code, line.id)
 
-            if not journeys:
-                logger.warning(f"{txc_service.service_code} has no journeys")
-                continue
+                if not journeys:
+                    logger.warning(f"{txc_service.service_code} has no journeys")
+                    continue
 
-            if txc_service.mode:
-                service.mode = txc_service.mode
+                if txc_service.mode:
+                    service.mode = txc_service.mode
 
-            if self.region_id:
-                service.region_id = self.region_id
+                if self.region_id:
+                    service.region_id = self.region_id
 
-            if service_code:
-                service.service_code = service_code
+                if service_code:
+                    service.service_code = service_code
 
-            if description and (
-                not service.description
-                or "Origin - " not in description
-                and " - Destination" not in description
-            ):
-                service.description = description
-
-            if line.colour:
-                background = f"#{line.colour}"
-                foreground = get_text_colour(background) or "#000"
-                service.colour, _ = ServiceColour.objects.get_or_create(
-                    background=background,
-                    foreground=foreground,
-                    use_name_as_brand=False,
-                )
-            elif service_code and service.mode == "bus" and service_code[:4] == "tfl_":
-                # London bus red
-                service.colour_id = 127
-            else:
-                # use the operator's colour
-                for operator in operators.values():
-                    if operator.colour_id:
-                        service.colour_id = operator.colour_id
-                        break
-
-            # Lines and Services can have a MarketingName
-            # (a line_brand is a thing I've made up)
-
-            line_brand = line.line_brand or line.marketing_name
-            if line_brand:
-                logger.info(line_brand)
-
-            if txc_service.marketing_name:
-                logger.info(txc_service.marketing_name)
-                if txc_service.marketing_name in (
-                    "CornwallbyKernow",
-                    line.line_name,
+                if description and (
+                    not service.description
+                    or "Origin - " not in description
+                    and " - Destination" not in description
                 ):
-                    pass
+                    service.description = description
+
+                if line.colour:
+                    background = f"#{line.colour}"
+                    foreground = get_text_colour(background) or "#000"
+                    service.colour, _ = ServiceColour.objects.get_or_create(
+                        background=background,
+                        foreground=foreground,
+                        use_name_as_brand=False,
+                    )
                 elif (
-                    "tudents only" in txc_service.marketing_name
-                    or "pupils only" in txc_service.marketing_name
+                    service_code
+                    and service.mode == "bus"
+                    and service_code[:4] == "tfl_"
                 ):
-                    service.public_use = False
+                    # London bus red
+                    service.colour_id = 127
                 else:
-                    line_brand = txc_service.marketing_name
-
-                    if service.description and " [" in service.description:
-                        service.description = service.description.removesuffix(
-                            f" [{line_brand}]"
-                        )
-
-            if (
-                not line_brand
-                and service.colour
-                and service.colour.use_name_as_brand
-                and service.colour.name
-                and service.colour.name != service.line_name
-            ):
-                # e.g. (First Eastern Counties) 'Yellow Line'
-                line_brand = service.colour.name
-            if any(line_brand == operator.name for operator in operators.values()):
-                line_brand = ""
-
-            if line_brand:
-                service.line_brand = line_brand
-            elif not existing_current_service:
-                service.line_brand = ""
+                    # use the operator's colour
+                    for operator in operators.values():
+                        if operator.colour_id:
+                            service.colour_id = operator.colour_id
+                            break
 
-            # inbound and outbound descriptions
+                # Lines and Services can have a MarketingName
+                # (a line_brand is a thing I've made up)
+
+                line_brand = line.line_brand or line.marketing_name
+                if line_brand:
+                    logger.info(line_brand)
+
+                if txc_service.marketing_name:
+                    logger.info(txc_service.marketing_name)
+                    if txc_service.marketing_name in (
+                        "CornwallbyKernow",
+                        line.line_name,
+                    ):
+                        pass
+                    elif (
+                        "tudents only" in txc_service.marketing_name
+                        or "pupils only" in txc_service.marketing_name
+                    ):
+                        service.public_use = False
+                    else:
+                        line_brand = txc_service.marketing_name
 
-            if (
-                line.outbound_description != line.inbound_description
-                or txc_service.origin in STUPID_ORIGINS_DESTINATIONS
-            ):
-                out_desc = line.outbound_description
-                in_desc = line.inbound_description
+                        if service.description and " [" in service.description:
+                            service.description = service.description.removesuffix(
+                                f" [{line_brand}]"
+                            )
 
-                if out_desc and in_desc and out_desc.isupper() and in_desc.isupper():
-                    out_desc = titlecase(out_desc, callback=initialisms)
-                    in_desc = titlecase(in_desc, callback=initialisms)
+                if (
+                    not line_brand
+                    and service.colour
+                    and service.colour.use_name_as_brand
+                    and service.colour.name
+                    and service.colour.name != service.line_name
+                ):
+                    # e.g. (First Eastern Counties) 'Yellow Line'
+                    line_brand = service.colour.name
+                if any(line_brand == operator.name for operator in operators.values()):
+                    line_brand = ""
 
-                if out_desc:
-                    if not service.description or len(txc_service.lines) > 1:
-                        service.description = out_desc
-                if in_desc:
-                    if not service.description:
-                        service.description = in_desc
+                if line_brand:
+                    service.line_brand = line_brand
+                elif not existing_current_service:
+                    service.line_brand = ""
 
-            service.save()
+                # inbound and outbound descriptions
 
-            if operators:
-                if existing and not existing_current_service:
-                    service.operator.set(operators.values())
-                else:
-                    service.operator.add(*operators.values())
+                if (
+                    line.outbound_description != line.inbound_description
+                    or txc_service.origin in STUPID_ORIGINS_DESTINATIONS
+                ):
+                    out_desc = line.outbound_description
+                    in_desc = line.inbound_description
+
+                    if (
+                        out_desc
+                        and in_desc
+                        and out_desc.isupper()
+                        and in_desc.isupper()
+                    ):
+                        out_desc = titlecase(out_desc, callback=initialisms)
+                        in_desc = titlecase(in_desc, callback=initialisms)
+
+                    if out_desc:
+                        if not service.description or len(txc_service.lines) > 1:
+                            service.description = out_desc
+                    if in_desc:
+                        if not service.description:
+                            service.description = in_desc
+
+                service.save()
+
+                if operators:
+                    if existing and not existing_current_service:
+                        service.operator.set(operators.values())
+                    else:
+                        service.operator.add(*operators.values())
 
-            self.service_ids.add(service.id)
+                self.service_ids.add(service.id)
 
-            journey = journeys[0]
+                journey = journeys[0]
 
-            ticket_machine_service_code = (
-                journey.ticket_machine_service_code
-                or txc_service.ticket_machine_service_code
-            )
-            if (
-                ticket_machine_service_code
-                and ticket_machine_service_code != line.line_name
-            ):
-                try:
-                    ServiceCode.objects.create(
-                        scheme="SIRI", code=ticket_machine_service_code, service=service
-                    )
-                except IntegrityError:
-                    pass
-
-            # a code used in Traveline Cymru URLs:
-            if self.source.name == "W" and "_" not in txc_service.service_code:
-                private_code = journey.private_code
-                if private_code and ":" in private_code:
-                    ServiceCode.objects.update_or_create(
-                        {"code": private_code.split(":", 1)[0]},
-                        service=service,
-                        scheme="Traveline Cymru",
-                    )
+                ticket_machine_service_code = (
+                    journey.ticket_machine_service_code
+                    or txc_service.ticket_machine_service_code
+                )
+                if (
+                    ticket_machine_service_code
+                    and ticket_machine_service_code != line.line_name
+                ):
+                    try:
+                        ServiceCode.objects.create(
+                            scheme="SIRI",
+                            code=ticket_machine_service_code,
+                            service=service,
+                        )
+                    except IntegrityError:
+                        pass
+
+                # a code used in Traveline Cymru URLs:
+                if self.source.name == "W" and "_" not in txc_service.service_code:
+                    private_code = journey.private_code
+                    if private_code and ":" in private_code:
+                        ServiceCode.objects.update_or_create(
+                            {"code": private_code.split(":", 1)[0]},
+                            service=service,
+                            scheme="Traveline Cymru",
+                        )
 
             # timetable data:
 
@@ -1470,7 +1602,8 @@ class Command(BaseCommand):
 
             # route links (geometry between stops):
             if transxchange.route_sections:
-                do_route_links(journeys, transxchange, stops, service)
+                with self.lock:
+                    do_route_links(journeys, transxchange, stops, service)
 
             route_code = filename
             if len(transxchange.services) > 1:
@@ -1589,12 +1722,13 @@ class Command(BaseCommand):
                     ad_hoc_stops[atco_code_upper] = stoppoint
                     stops[atco_code_upper] = stoppoint
 
-        StopPoint.objects.bulk_create(
-            ad_hoc_stops.values(),
-            update_conflicts=True,
-            unique_fields=["atco_code"],
-            update_fields=["common_name", "naptan_code", "latlong", "bearing"],
-        )
+        with self.lock:
+            StopPoint.objects.bulk_create(
+                ad_hoc_stops.values(),
+                update_conflicts=True,
+                unique_fields=["atco_code"],
+                update_fields=["common_name", "naptan_code", "latlong", "bearing"],
+            )
 
         return stops
 
@@ -1623,11 +1757,12 @@ class Command(BaseCommand):
                 garage_code not in self.garages
                 or self.garages[garage_code].name != name
             ):
-                garage = Garage.objects.filter(
-                    code=garage_code, name__iexact=name
-                ).first()
-                if garage is None:
-                    garage = Garage.objects.create(code=garage_code, name=name)
+                with self.lock:
+                    garage = Garage.objects.filter(
+                        code=garage_code, name__iexact=name
+                    ).first()
+                    if garage is None:
+                        garage = Garage.objects.create(code=garage_code, name=name)
                 self.garages[garage_code] = garage
 
     def handle_file(self, open_file, filename: str):
@@ -1,3 +1,4 @@
+import os
 import xml.etree.ElementTree as ET
 import zipfile
 from datetime import date
@@ -7,8 +8,8 @@ from unittest.mock import patch
 
 import time_machine
 from django.contrib.gis.geos import Point
-from django.core.management import call_command
-from django.test import TestCase, override_settings
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 
 from accounts.models import User
@@ -1696,3 +1697,42 @@ class ImportTransXChangeTest(TestCase):
         x, y = route_link.geometry[0]
         self.assertAlmostEqual(x, -3.883, places=2)
         self.assertAlmostEqual(y, 57.578, places=2)
+
+
+class ImportTransXChangeInProcessesTest(TransactionTestCase):
+    @time_machine.travel("3 October 2016")
+    def test_same_service_in_different_processes(self):
+        Region.objects.create(pk="NW", name="North West")
+
+        with TemporaryDirectory() as directory:
+            zipfile_path = Path(directory) / "NW.zip"
+            with zipfile.ZipFile(zipfile_path, "a") as open_zipfile:
+                # (names chosen to go to different worker processes)
+                open_zipfile.write(FIXTURES_DIR / "NW_04_GMS_237_1.xml", "first.xml")
+                open_zipfile.write(FIXTURES_DIR / "NW_04_GMS_237_2.xml", "second.xml")
+            call_command("import_transxchange", zipfile_path, processes=2)
+
+        # both files' routes belong to the same (not duplicated) service
+        service = Service.objects.get(line_name="237")
+        self.assertEqual(service.route_set.count(), 2)
+        self.assertTrue(service.current)
+
+    def test_worker_process_dies(self):
+        Region.objects.create(pk="NW", name="North West")
+
+        with TemporaryDirectory() as directory:
+            zipfile_path = Path(directory) / "NW.zip"
+            with zipfile.ZipFile(zipfile_path, "a") as open_zipfile:
+                open_zipfile.write(FIXTURES_DIR / "NW_04_GMS_237_1.xml", "first.xml")
+                open_zipfile.write(FIXTURES_DIR / "NW_04_GMS_237_2.xml", "second.xml")
+            with (
+                patch.object(
+                    import_transxchange.Command,
+                    "handle_archive_member",
+                    side_effect=lambda *args: os._exit(1),  # (e.g. killed for OOM)
+                ),
+                self.assertRaisesMessage(CommandError, "exited with code 1"),
+            ):
+                call_command("import_transxchange", zipfile_path, processes=2)
+
+        self.assertFalse(Service.objects.exists())
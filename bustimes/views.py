@@ -51,6 +51,7 @@ from busstops.models import (
 )
 from departures import avl, gtfsr, live
 from vehicles.forms import DateForm
+from vehicles.history import get_archived_locations
 from vehicles.models import Vehicle, VehicleJourney, VehicleLocation
 from vehicles.rtpi import add_progress_and_delay
 from vehicles.utils import redis_client
@@ -155,7 +156,9 @@ def snap(request, trip_id=None, journey_id=None):
     )
 
     if journey:
-        locations = redis_client.lrange(journey.get_redis_key(), 0, -1)
+        locations = redis_client.lrange(
+            journey.get_redis_key(), 0, -1
+        ) or get_archived_locations(journey)
 
         locations = [
             VehicleLocation.decode_appendage(location) for location in locations
@@ -1,6 +1,4 @@
-import json
-
-from vehicles.utils import redis_client
+from vehicles.utils import decode_vehicle_location, redis_client
 
 
 def get_tracking(stop, services):
@@ -18,6 +16,8 @@ def get_tracking(stop, services):
     vehicle_locations = redis_client.mget(
         [f"vehicle{int(vehicle_id)}" for vehicle_id in vehicle_ids]
     )
-    vehicle_locations = [json.loads(item) for item in vehicle_locations if item]
+    vehicle_locations = [
+        decode_vehicle_location(item) for item in vehicle_locations if item
+    ]
 
     return vehicle_locations
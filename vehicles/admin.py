@@ -531,10 +531,13 @@ class VehicleCodeAdmin(admin.ModelAdmin):
 
 @admin.register(models.SiriSubscription)
 class SiriSubscriptionAdmin(admin.ModelAdmin):
-    readonly_fields = ["uuid", "sample", "status"]
+    readonly_fields = ["uuid", "sample", "status", "dropped_posts"]
 
     def status(self, obj):
         return cache.get(obj.get_status_key())
 
+    def dropped_posts(self, obj):
+        return cache.get(obj.get_dropped_key(), 0)
+
 
 admin.site.register(models.VehicleFeature)
@@ -0,0 +1,112 @@
+"""Raw live vehicle data (SIRI-VM posts, etc), archived in hourly segment files like
+
+    AVL_ARCHIVE_DIR/{source id}/2024-03-15_06.gz
+
+Each record is appended as a separate gzip member (so the file as a whole is a
+valid gzip file) containing a header (timestamp, name length, data length),
+the name (like "2024-03-15_060942.xml") and the data.
+
+Alongside each segment, an index file (2024-03-15_06.idx) has a (timestamp, offset)
+entry per record, so reading can start part way through an hour
+without decompressing everything before it.
+"""
+
+import fcntl
+import gzip
+import struct
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+record_header = struct.Struct("<dII")  # timestamp, name length, data length
+index_entry = struct.Struct("<dQ")  # timestamp, offset of gzip member
+
+
+@dataclass
+class Record:
+    timestamp: datetime
+    name: str
+    data: bytes
+
+
+def get_dir(source_id):
+    return settings.AVL_ARCHIVE_DIR / str(source_id)
+
+
+def append(source_id, data: bytes, name: str, timestamp: datetime):
+    path = get_dir(source_id)
+    path.mkdir(parents=True, exist_ok=True)
+    path /= f"{timestamp.astimezone(timezone.utc):%Y-%m-%d_%H}"
+
+    name = name.encode()
+    member = gzip.compress(
+        record_header.pack(timestamp.timestamp(), len(name), len(data)) + name + data,
+        compresslevel=6,
+    )
+
+    # (lock, in case another process is appending to the same segment)
+    with open(path.with_suffix(".gz"), "ab") as segment:
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        offset = segment.tell()
+        segment.write(member)
+        with open(path.with_suffix(".idx"), "ab") as index:
+            index.write(index_entry.pack(timestamp.timestamp(), offset))
+
+
+def read_records(stream):
+    """records from a (decompressed) segment"""
+    while header := stream.read(record_header.size):
+        timestamp, name_length, data_length = record_header.unpack(header)
+        name = stream.read(name_length).decode()
+        yield Record(
+            datetime.fromtimestamp(timestamp, timezone.utc),
+            name,
+            stream.read(data_length),
+        )
+
+
+def get_offset(path, since: datetime) -> int:
+    """offset of the first record in a segment at or after a time"""
+    index = path.with_suffix(".idx").read_bytes()
+    index = index[: len(index) - len(index) % index_entry.size]  # (being written)
+    since = since.timestamp()
+    for timestamp, offset in index_entry.iter_unpack(index):
+        if timestamp >= since:
+            return offset
+    return path.stat().st_size
+
+
+def read(source_id, since: datetime = None, until: datetime = None, path=None):
+    """archived records for a source (or in a directory of segments),
+    in the order they were written
+    """
+    if path is None:
+        path = get_dir(source_id)
+    if not path.exists():
+        return
+
+    for segment_path in sorted(path.glob("*.gz")):
+        hour = datetime.strptime(segment_path.stem, "%Y-%m-%d_%H").replace(
+            tzinfo=timezone.utc
+        )
+        if since and hour.timestamp() + 3600 <= since.timestamp():
+            continue
+        if until and hour >= until:
+            break
+
+        with open(segment_path, "rb") as segment:
+            if since and hour < since:
+                segment.seek(get_offset(segment_path, since))
+            with gzip.GzipFile(fileobj=segment) as stream:
+                try:
+                    for record in read_records(stream):
+                        if until and record.timestamp >= until:
+                            return
+                        if since and record.timestamp < since:
+                            continue
+                        yield record
+                except (EOFError, zlib.error):
+                    # a member still being written
+                    pass
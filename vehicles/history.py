@@ -0,0 +1,166 @@
+"""Journey location histories, moved out of Redis once journeys have finished.
+
+While a journey is in progress, its history is a Redis list of
+VehicleLocation.get_appendage() records (keyed by the journey UUID).
+compact() moves the histories of finished journeys into directories like
+
+    JOURNEY_HISTORY_DIR/2024-03-15/093000123456/
+
+(one per run of compact() per journey date) containing NumPy arrays:
+journeys.npy - sorted journey UUID hexes
+offsets.npy - where each journey's locations start and end in the other arrays
+timestamp.npy, longitude.npy, latitude.npy, etc - one per appendage field
+"""
+
+import logging
+import uuid
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import VehicleJourney
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+# the VehicleLocation.get_appendage() "I 2f ?h ?h" struct format (including padding)
+appendage_dtype = np.dtype(
+    [
+        ("timestamp", "=u4"),
+        ("longitude", "=f4"),
+        ("latitude", "=f4"),
+        ("has_heading", "?"),
+        ("heading", "=i2"),
+        ("has_delay", "?"),
+        ("delay", "=i2"),
+    ],
+    align=True,
+)
+
+
+def decode_locations(locations: list[bytes]):
+    """history records (from Redis or the archive) as an array, in time order"""
+    records = np.frombuffer(b"".join(locations), dtype=appendage_dtype)
+    return records[np.argsort(records["timestamp"], kind="stable")]
+
+
+def get_paths(date):
+    path = settings.JOURNEY_HISTORY_DIR / date.isoformat()
+    if not path.exists():
+        return []
+    # (directories starting with "." are still being written)
+    return sorted(path for path in path.iterdir() if not path.name.startswith("."))
+
+
+def load(path, name):
+    return np.load(path / f"{name}.npy", mmap_mode="r")
+
+
+def get_archived_locations(journey) -> list[bytes]:
+    """a journey's compacted history, in the same format as the Redis list"""
+    key = journey.uuid.hex.encode()
+
+    for path in get_paths(journey.date):
+        journeys = load(path, "journeys")
+        i = np.searchsorted(journeys, key)
+        if i < len(journeys) and journeys[i] == key:
+            start, end = load(path, "offsets")[i : i + 2]
+            records = np.zeros(end - start, dtype=appendage_dtype)
+            for field in appendage_dtype.names:
+                records[field] = load(path, field)[start:end]
+            return [record.tobytes() for record in records]
+
+    return []
+
+
+def get_archived_journeys(journeys) -> set[uuid.UUID]:
+    """which of some journeys have compacted histories"""
+    dates = {}
+    for journey in journeys:
+        dates.setdefault(journey.date, []).append(journey.uuid.hex)
+
+    archived = set()
+    for date, keys in dates.items():
+        keys = np.array(keys, dtype="S32")
+        for path in get_paths(date):
+            found = keys[np.isin(keys, load(path, "journeys"))]
+            archived.update(uuid.UUID(key.decode()) for key in found)
+
+    return archived
+
+
+def write(date, histories: dict[str, list[bytes]]):
+    keys = sorted(histories)
+    records = [decode_locations(histories[key]) for key in keys]
+    offsets = np.cumsum([0] + [len(journey_records) for journey_records in records])
+    records = np.concatenate(records)
+
+    name = f"{timezone.now():%H%M%S%f}"
+    path = settings.JOURNEY_HISTORY_DIR / date.isoformat()
+    temp_path = path / f".{name}"
+    temp_path.mkdir(parents=True)
+
+    np.save(temp_path / "journeys.npy", np.array(keys, dtype="S32"))
+    np.save(temp_path / "offsets.npy", offsets)
+    for field in appendage_dtype.names:
+        np.save(temp_path / f"{field}.npy", records[field])
+
+    temp_path.rename(path / name)
+
+
+def compact(older_than: timedelta, batch_size=1000):
+    """move the histories of journeys with no locations in the last `older_than`
+    from Redis to disk
+    """
+    cutoff = (timezone.now() - older_than).timestamp()
+
+    # journey history lists are the only Redis keys that are 16 byte UUIDs
+    keys = [
+        key
+        for key in redis_client.scan_iter(count=1000, _type="list")
+        if len(key) == 16
+    ]
+
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i : i + batch_size]
+
+        pipe = redis_client.pipeline(transaction=False)
+        for key in batch:
+            pipe.lindex(key, -1)
+        batch = [
+            key
+            for key, last in zip(batch, pipe.execute())
+            if last and np.frombuffer(last, dtype=appendage_dtype)[0][0] < cutoff
+        ]
+        if not batch:
+            continue
+
+        dates = dict(
+            VehicleJourney.objects.filter(
+                uuid__in=[uuid.UUID(bytes=key) for key in batch]
+            ).values_list("uuid", "date")
+        )
+
+        pipe = redis_client.pipeline(transaction=False)
+        for key in batch:
+            pipe.lrange(key, 0, -1)
+
+        histories = {}
+        for key, locations in zip(batch, pipe.execute()):
+            journey_uuid = uuid.UUID(bytes=key)
+            # (history of a journey that's since been deleted from the database
+            # will just be deleted)
+            if locations and journey_uuid in dates:
+                histories.setdefault(dates[journey_uuid], {})[journey_uuid.hex] = (
+                    locations
+                )
+
+        for date, date_histories in histories.items():
+            write(date, date_histories)
+
+        redis_client.delete(*batch)
+
+        logger.info(f"compacted {len(batch)} journey histories")
@@ -0,0 +1,114 @@
+import logging
+from time import monotonic, sleep
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from ...models import SiriSubscription
+from ...tasks import get_bod_avl_command, handle_posts
+from ...utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class Consumer:
+    """handles posts to one subscription, keeping the state of what's changed"""
+
+    def __init__(self, subscription):
+        self.subscription = subscription
+        self.key = subscription.get_posts_key()
+        self.checkpoint_key = subscription.get_status_key().replace(
+            "_status", "_checkpoint"
+        )
+        self.command = get_bod_avl_command(subscription.name)
+
+        # only new messages
+        last = redis_client.xrevrange(self.key, count=1)
+        self.last_id = last[0][0] if last else "0-0"
+
+        # carry on from where a previous process left off,
+        # rather than treating every vehicle as changed
+        if checkpoint := cache.get(self.checkpoint_key):
+            (
+                self.last_id,
+                self.command.source.datetime,
+                self.command.identifiers,
+                self.command.journeys_ids,
+                self.command.journeys_ids_ids,
+            ) = checkpoint
+
+    def handle(self, messages):
+        try:
+            handle_posts(self.subscription, messages, self.command)
+        except Exception as e:
+            logger.exception(e)
+        self.last_id = messages[-1][0]
+
+        # forget posts that have been handled (except the latest one)
+        redis_client.xtrim(self.key, minid=self.last_id, approximate=False)
+
+    def checkpoint(self):
+        cache.set(
+            self.checkpoint_key,
+            (
+                self.last_id,
+                self.command.source.datetime,
+                self.command.identifiers,
+                self.command.journeys_ids,
+                self.command.journeys_ids_ids,
+            ),
+            None,
+        )
+
+
+class Command(BaseCommand):
+    help = """Handle posts to SIRI-VM subscriptions in one long-running process
+    (with settings.SIRI_POST_CONSUMER, instead of a handle_siri_post task per post)"""
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "--window",
+            type=float,
+            default=1,
+            help="Seconds to wait for more posts, to handle together",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            type=float,
+            default=60,
+            help="Seconds between saving the state of what's changed",
+        )
+
+    def handle(self, window, checkpoint, **options):
+        consumers = {}  # stream key: Consumer
+        for subscription in SiriSubscription.objects.all():
+            consumer = Consumer(subscription)
+            consumers[consumer.key.encode()] = consumer
+
+        last_checkpoint = monotonic()
+
+        try:
+            while True:
+                streams = {key: consumer.last_id for key, consumer in consumers.items()}
+                response = redis_client.xread(streams, block=int(checkpoint * 1000))
+
+                if response:
+                    # micro-batch - wait for any more posts, then handle them together
+                    sleep(window)
+                    batches = dict(response)
+                    for key, messages in batches.items():
+                        streams[key] = messages[-1][0]
+                    for key, messages in redis_client.xread(streams) or ():
+                        batches.setdefault(key, []).extend(messages)
+
+                    for key, messages in batches.items():
+                        consumers[key].handle(messages)
+
+                if monotonic() - last_checkpoint >= checkpoint:
+                    for consumer in consumers.values():
+                        consumer.checkpoint()
+                    last_checkpoint = monotonic()
+        finally:
+            for consumer in consumers.values():
+                consumer.checkpoint()
@@ -1,12 +1,15 @@
 import functools
 import io
+import logging
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime, timedelta
 
 import sentry_sdk
 from lxml import etree
 from django.conf import settings
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import Point
 from django.core.cache import cache
 from django.db import IntegrityError
 from django.db.models import Exists, OuterRef, Q
@@ -23,9 +26,23 @@ from busstops.models import (
 )
 from bustimes.models import Route, Trip
 
-from ...models import Vehicle, VehicleJourney, VehicleLocation
-from ..import_live_vehicles import ImportLiveVehiclesCommand, Status
+from ...models import Vehicle, VehicleJourney
+from ...utils import (
+    TimedLRUCache,
+    decode_vehicle_location,
+    encode_vehicle_location,
+    redis_client,
+)
+from ..import_live_vehicles import (
+    ImportLiveVehiclesCommand,
+    NotModified,
+    PollSchedule,
+    Status,
+    Timings,
+    VehicleActivity,
+)
 
+logger = logging.getLogger(__name__)
 
 _SIRI_NS = "http://www.siri.org.uk/siri"
 
@@ -48,6 +65,13 @@ def _elem_to_dict(elem):
     return d
 
 
+def _find_value(elem, tag):
+    """like dict.get() on the result of _elem_to_dict(elem)"""
+    child = elem.find(f"{{{_SIRI_NS}}}{tag}")
+    if child is not None:
+        return _elem_to_dict(child)
+
+
 occupancies = {
     "seatsAvailable": "Seats available",
     "standingAvailable": "Standing available",
@@ -73,7 +97,7 @@ def get_destination_ref(destination_ref: str) -> str | None:
     return destination_ref
 
 
-@functools.cache
+@functools.lru_cache(maxsize=8192)
 def get_destination_name(destination_ref: str) -> str:
     try:
         return Locality.objects.get(stoppoint=destination_ref).name
@@ -105,6 +129,7 @@ def get_line_name_query(line_ref: str) -> Q:
 class Command(ImportLiveVehiclesCommand):
     source_name = "Bus Open Data"
     vehicle_code_scheme = "BODS"
+    prefetch = False  # (parse_items compares items with the previous update's)
     services = (
         Service.objects.using(settings.READ_DATABASE)
         .filter(current=True)
@@ -113,12 +138,76 @@ class Command(ImportLiveVehiclesCommand):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.hist = {}
+        # bods updates "every 10 seconds",
+        # it's usually worth waiting 0-9 seconds
+        # before the next fetch
+        # for maximum freshness:
+        self.schedule = PollSchedule(11, period=10)
+        self.unchanged_items = 0
+        # (operator ref, line ref, destination ref, etc) -> Service or None
+        self.service_cache = TimedLRUCache(maxsize=20000, ttl=3600)
+        self.services_modified_at = None
+        self.services_checked_at = None
+        # if set, match journeys to trips in the background:
+        self.trip_matcher = None
+        self.trips_to_match = []
+        self.matched_trips = []  # (journey, Future)
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--defer-trips",
+            action="store_true",
+            help="Publish locations before matching journeys to timetabled trips",
+        )
+
+    def handle(self, *args, defer_trips=False, **options):
+        if defer_trips:
+            self.trip_matcher = ThreadPoolExecutor(max_workers=4)
+        super().handle(*args, **options)
 
     @staticmethod
     def get_datetime(item):
         return datetime.fromisoformat(item["RecordedAtTime"])
 
+    def get_activity_fields(self, item) -> dict:
+        monitored_vehicle_journey = item["MonitoredVehicleJourney"]
+
+        journey_ref = monitored_vehicle_journey.get("VehicleJourneyRef")
+        if not journey_ref:
+            try:
+                journey_ref = monitored_vehicle_journey["FramedVehicleJourneyRef"][
+                    "DatedVehicleJourneyRef"
+                ]
+            except (KeyError, TypeError):
+                pass
+        if journey_ref == "UNKNOWN":
+            journey_ref = None
+
+        if departure_time := monitored_vehicle_journey.get("OriginAimedDepartureTime"):
+            departure_time = datetime.fromisoformat(departure_time)
+
+        if bearing := monitored_vehicle_journey.get("Bearing"):
+            # Assume '0' means None. There's only a 1/360 chance the bus is actually facing exactly north
+            bearing = float(bearing) or None
+
+        fields = {
+            "datetime": self.get_datetime(item),
+            "heading": bearing or None,
+            "vehicle_ref": monitored_vehicle_journey.get("VehicleRef"),
+            "operator_ref": monitored_vehicle_journey.get("OperatorRef"),
+            "line_ref": monitored_vehicle_journey.get("PublishedLineName")
+            or monitored_vehicle_journey.get("LineRef"),
+            "journey_ref": journey_ref,
+            "departure_time": departure_time,
+            "destination": monitored_vehicle_journey.get("DestinationName"),
+            "block": monitored_vehicle_journey.get("BlockRef"),
+        }
+        if location := monitored_vehicle_journey.get("VehicleLocation"):
+            fields["longitude"] = float(location["Longitude"])
+            fields["latitude"] = float(location["Latitude"])
+        return fields
+
     @functools.cache
     def get_operator(self, operator_ref):
         # all operators with a matching OperatorCode,
@@ -129,15 +218,16 @@ class Command(ImportLiveVehiclesCommand):
             | Q(noc=operator_ref) & ~Exists(operator_codes)
         )
 
-    def get_vehicle(self, item):
-        monitored_vehicle_journey = item["MonitoredVehicleJourney"]
-        operator_ref = monitored_vehicle_journey["OperatorRef"]
-        vehicle_ref = monitored_vehicle_journey["VehicleRef"] or ""
+    def get_vehicle(self, activity):
+        operator_ref = activity.operator_ref
+        vehicle_ref = activity.vehicle_ref or ""
 
         vehicle_ref = vehicle_ref.removeprefix(f"{operator_ref}-")
 
         try:
-            vehicle_unique_id = item["Extensions"]["VehicleJourney"]["VehicleUniqueId"]
+            vehicle_unique_id = activity.data["Extensions"]["VehicleJourney"][
+                "VehicleUniqueId"
+            ]
         except (KeyError, TypeError):
             vehicle_unique_id = None
 
@@ -229,8 +319,60 @@ class Command(ImportLiveVehiclesCommand):
 
         return vehicle, created
 
-    def get_service(self, operators, item, line_ref, vehicle_operator_id):
-        monitored_vehicle_journey = item["MonitoredVehicleJourney"]
+    def check_services_modified(self):
+        """clear the service cache if timetables have been imported since last time"""
+        now = timezone.now()
+        if self.services_checked_at and (now - self.services_checked_at).seconds < 60:
+            return
+        self.services_checked_at = now
+
+        services_modified_at = cache.get("services_modified_at")
+        if services_modified_at != self.services_modified_at:
+            self.service_cache.clear()
+            get_destination_name.cache_clear()
+            self.services_modified_at = services_modified_at
+
+    def get_service(self, operators, activity, line_ref, vehicle_operator_id):
+        monitored_vehicle_journey = activity.data["MonitoredVehicleJourney"]
+
+        destination_ref = monitored_vehicle_journey.get("DestinationRef")
+        if not destination_ref:
+            # will probably need to use the vehicle location, so can't be cached
+            return self.match_service(
+                operators, activity, line_ref, vehicle_operator_id
+            )
+
+        try:
+            ticket_machine_service_code = activity.data["Extensions"]["VehicleJourney"][
+                "Operational"
+            ]["TicketMachine"]["TicketMachineServiceCode"]
+        except (KeyError, TypeError):
+            ticket_machine_service_code = None
+
+        key = (
+            activity.operator_ref,
+            line_ref,
+            ticket_machine_service_code,
+            destination_ref,
+            monitored_vehicle_journey.get("OriginRef"),
+            f"{activity.datetime:%a}",
+            vehicle_operator_id,
+        )
+
+        self.check_services_modified()
+
+        try:
+            return self.service_cache[key]
+        except KeyError:
+            pass
+
+        # (remember "no match" results too)
+        service = self.match_service(operators, activity, line_ref, vehicle_operator_id)
+        self.service_cache[key] = service
+        return service
+
+    def match_service(self, operators, activity, line_ref, vehicle_operator_id):
+        monitored_vehicle_journey = activity.data["MonitoredVehicleJourney"]
 
         if destination_ref := monitored_vehicle_journey.get("DestinationRef"):
             destination_ref = get_destination_ref(destination_ref)
@@ -238,7 +380,7 @@ class Command(ImportLiveVehiclesCommand):
         # filter by LineRef or (if present and different) TicketMachineServiceCode
         line_name_query = get_line_name_query(line_ref)
         try:
-            ticket_machine_service_code = item["Extensions"]["VehicleJourney"][
+            ticket_machine_service_code = activity.data["Extensions"]["VehicleJourney"][
                 "Operational"
             ]["TicketMachine"]["TicketMachineServiceCode"]
         except (KeyError, TypeError):
@@ -249,7 +391,7 @@ class Command(ImportLiveVehiclesCommand):
 
         services = self.services.filter(line_name_query).defer("geometry")
 
-        if item["MonitoredVehicleJourney"]["OperatorRef"] == "TFLO":
+        if activity.operator_ref == "TFLO":
             return services.filter(route__source__name="L").first()
 
         if not operators:
@@ -343,7 +485,7 @@ class Command(ImportLiveVehiclesCommand):
                     services = services.filter(condition)
 
         else:
-            latlong = self.create_vehicle_location(item).latlong
+            latlong = Point(activity.longitude, activity.latitude)
             try:
                 return services.get(geometry__bboverlaps=latlong)
             except (Service.DoesNotExist, Service.MultipleObjectsReturned):
@@ -357,7 +499,7 @@ class Command(ImportLiveVehiclesCommand):
             pass
 
         try:
-            when = self.get_datetime(item)
+            when = activity.datetime
             trips = Trip.objects.filter(
                 **{f"calendar__{when:%a}".lower(): True}, route__service=OuterRef("pk")
             )
@@ -365,26 +507,15 @@ class Command(ImportLiveVehiclesCommand):
         except (Service.DoesNotExist, Service.MultipleObjectsReturned):
             pass
 
-    def get_journey(self, item, vehicle):
-        monitored_vehicle_journey = item["MonitoredVehicleJourney"]
+    def get_journey(self, activity, vehicle):
+        monitored_vehicle_journey = activity.data["MonitoredVehicleJourney"]
 
-        journey_ref = monitored_vehicle_journey.get("VehicleJourneyRef")
-
-        if not journey_ref:
-            try:
-                journey_ref = monitored_vehicle_journey["FramedVehicleJourneyRef"][
-                    "DatedVehicleJourneyRef"
-                ]
-            except (KeyError, ValueError):
-                pass
-
-        if journey_ref == "UNKNOWN":
-            journey_ref = None
+        journey_ref = activity.journey_ref
 
         try:
-            ticket_machine = item["Extensions"]["VehicleJourney"]["Operational"][
-                "TicketMachine"
-            ]
+            ticket_machine = activity.data["Extensions"]["VehicleJourney"][
+                "Operational"
+            ]["TicketMachine"]
             journey_code = ticket_machine["JourneyCode"]
         except (KeyError, TypeError):
             journey_code = journey_ref
@@ -395,26 +526,19 @@ class Command(ImportLiveVehiclesCommand):
             elif not journey_ref:
                 journey_ref = journey_code  # what we will use for finding matching trip
 
-        route_name = monitored_vehicle_journey.get(
-            "PublishedLineName"
-        ) or monitored_vehicle_journey.get("LineRef", "")
+        route_name = activity.line_ref or ""
         if not route_name and ticket_machine:
             route_name = ticket_machine.get("TicketMachineServiceCode", "")
 
-        if origin_aimed_departure_time := monitored_vehicle_journey.get(
-            "OriginAimedDepartureTime"
-        ):
-            origin_aimed_departure_time = datetime.fromisoformat(
-                origin_aimed_departure_time
-            )
+        origin_aimed_departure_time = activity.departure_time
 
         journey = None
 
         journeys = vehicle.vehiclejourney_set
 
-        dt = self.get_datetime(item)
+        dt = activity.datetime
 
-        operator_ref = monitored_vehicle_journey["OperatorRef"]
+        operator_ref = activity.operator_ref
 
         # treat the weird Nottingham City Transport data specially
         if operator_ref == "NCTR" and origin_aimed_departure_time is None:
@@ -443,7 +567,6 @@ class Command(ImportLiveVehiclesCommand):
                         date=timezone.localdate(dt),
                     ).first()
             elif journey_ref:
-                dt = self.get_datetime(item)
                 THREE_HOURS = timedelta(hours=3)
                 if (
                     route_name == latest_journey.route_name
@@ -474,14 +597,14 @@ class Command(ImportLiveVehiclesCommand):
             destination_ref = get_destination_ref(destination_ref)
 
         if operator_ref == "TFLO":
-            journey.destination = monitored_vehicle_journey.get("DestinationName")
+            journey.destination = activity.destination
         else:
             if destination_ref and (
                 destination := get_destination_name(destination_ref)
             ):
                 # try getting the stop locality name - usually more descriptive than "Bus_Station"
                 journey.destination = destination
-            elif destination := monitored_vehicle_journey.get("DestinationName"):
+            elif destination := activity.destination:
                 journey.destination = destination.replace("_", " ")
             else:
                 journey.direction = monitored_vehicle_journey.get("DirectionRef", "")
@@ -489,7 +612,7 @@ class Command(ImportLiveVehiclesCommand):
         if not journey.service_id and route_name:
             operators = self.get_operator(operator_ref)
             journey.service = self.get_service(
-                operators, item, route_name, vehicle.operator_id
+                operators, activity, route_name, vehicle.operator_id
             )
 
             if not operators and journey.service and journey.service.operator.all():
@@ -511,7 +634,7 @@ class Command(ImportLiveVehiclesCommand):
 
             # match trip (timetable) to journey:
             if journey.service and (origin_aimed_departure_time or journey_ref):
-                block_ref = monitored_vehicle_journey.get("BlockRef")
+                block_ref = activity.block
 
                 arrival_time = monitored_vehicle_journey.get(
                     "DestinationAimedArrivalTime"
@@ -519,60 +642,147 @@ class Command(ImportLiveVehiclesCommand):
                 if arrival_time:
                     arrival_time = datetime.fromisoformat(arrival_time)
 
-                if trip := journey.get_trip(
-                    datetime=dt,
-                    operator_ref=operator_ref,
-                    origin_ref=monitored_vehicle_journey.get("OriginRef"),
-                    destination_ref=destination_ref,
-                    departure_time=origin_aimed_departure_time,
-                    arrival_time=arrival_time,
-                    journey_code=journey_code,
-                    block_ref=block_ref,
+                trip_kwargs = {
+                    "datetime": dt,
+                    "operator_ref": operator_ref,
+                    "origin_ref": monitored_vehicle_journey.get("OriginRef"),
+                    "destination_ref": destination_ref,
+                    "departure_time": origin_aimed_departure_time,
+                    "arrival_time": arrival_time,
+                    "journey_code": journey_code,
+                    "block_ref": block_ref,
+                }
+
+                if not self.trip_matcher:
+                    self.match_trip(journey, vehicle, **trip_kwargs)
+                elif (
+                    latest_journey
+                    and latest_journey.trip_id
+                    and latest_journey.code == journey.code
+                    and latest_journey.service_id == journey.service_id
+                    and latest_journey.datetime == journey.datetime
                 ):
-                    journey.trip = trip
+                    # (same journey as before, presumably matched last time)
+                    journey.trip_id = latest_journey.trip_id
+                else:
+                    self.trips_to_match.append((journey, vehicle, trip_kwargs))
 
-                    if operator_ref == "NATX" and trip.block != block_ref:
-                        trip.block = block_ref
-                        trip.save(update_fields=["block"])
+        return journey
 
-                    if (
-                        not (destination_ref and journey.destination)
-                        and trip.destination_id
-                    ):
-                        journey.destination = (
-                            trip.headsign
-                            or get_destination_name(trip.destination_id)
-                            or journey.destination
-                        )
+    def match_trip(self, journey, vehicle, **trip_kwargs):
+        trip = journey.get_trip(**trip_kwargs)
+        if not trip:
+            return
 
-                    if not vehicle.operator_id and trip.operator_id:
-                        vehicle.operator_id = trip.operator_id
-                        vehicle.save(update_fields=["operator"])
+        journey.trip = trip
 
-        return journey
+        block_ref = trip_kwargs["block_ref"]
+        if trip_kwargs["operator_ref"] == "NATX" and trip.block != block_ref:
+            trip.block = block_ref
+            trip.save(update_fields=["block"])
+
+        if (
+            not (trip_kwargs["destination_ref"] and journey.destination)
+            and trip.destination_id
+        ):
+            journey.destination = (
+                trip.headsign
+                or get_destination_name(trip.destination_id)
+                or journey.destination
+            )
+
+        if not vehicle.operator_id and trip.operator_id:
+            vehicle.operator_id = trip.operator_id
+            vehicle.save(update_fields=["operator"])
+
+        return trip
+
+    def match_trip_later(self, journey, vehicle, trip_kwargs):
+        """run in a trip_matcher thread, after the journey and location have been saved.
+
+        journey and vehicle are copies - the main thread's own objects are only updated
+        by the main thread (see apply_matched_trips)
+        """
+        try:
+            trip = self.match_trip(journey, vehicle, **trip_kwargs)
+            if not trip or not journey.id:
+                return
+
+            VehicleJourney.objects.filter(id=journey.id).update(
+                trip=trip, destination=journey.destination
+            )
+
+            if trip.garage_id and trip.garage_id != vehicle.garage_id:
+                vehicle.garage_id = trip.garage_id
+                vehicle.save(update_fields=["garage"])
+
+            self.backfill_trip(vehicle.id, journey)
+
+            return trip, journey.destination
+        except Exception as e:
+            logger.exception(e)
 
     @staticmethod
-    def create_vehicle_location(item):
-        monitored_vehicle_journey = item["MonitoredVehicleJourney"]
-        location = monitored_vehicle_journey["VehicleLocation"]
-        latlong = GEOSGeometry(f"POINT({location['Longitude']} {location['Latitude']})")
-        bearing = monitored_vehicle_journey.get("Bearing")
-        if bearing:
-            # Assume '0' means None. There's only a 1/360 chance the bus is actually facing exactly north
-            bearing = float(bearing) or None
-        delay = monitored_vehicle_journey.get("Delay")
-        if delay:
-            delay = parse_duration(delay)
-        location = VehicleLocation(
-            latlong=latlong,
-            heading=bearing,
-            delay=delay,
-            occupancy=occupancies.get(monitored_vehicle_journey.get("Occupancy")),
-            block=monitored_vehicle_journey.get("BlockRef"),
-        )
-        if monitored_vehicle_journey["OperatorRef"] == "TFLO":
-            location.tfl_code = monitored_vehicle_journey["VehicleRef"]
-        extensions = item.get("Extensions")
+    def backfill_trip(vehicle_id, journey):
+        """set the trip of the live location (unless it's moved on to another journey)
+        - in a transaction, so a newer location saved meanwhile isn't overwritten
+        """
+        key = f"vehicle{vehicle_id}"
+
+        def update(pipe):
+            redis_json = pipe.get(key)
+            if not redis_json:
+                return
+            location = decode_vehicle_location(redis_json)
+            if location["journey_id"] != journey.id:
+                return
+            location["trip_id"] = journey.trip_id
+            location["destination"] = journey.destination
+            pipe.multi()
+            pipe.set(key, encode_vehicle_location(location), xx=True, keepttl=True)
+
+        redis_client.transaction(update, key)
+
+    def apply_matched_trips(self):
+        """copy the trips matched by finished match_trip_later threads
+        to the main thread's journeys
+        """
+        pending = []
+        for journey, future in self.matched_trips:
+            if not future.done():
+                pending.append((journey, future))
+            elif result := future.result():
+                journey.trip, journey.destination = result
+        self.matched_trips = pending
+
+    def save(self):
+        if self.trip_matcher:
+            self.apply_matched_trips()
+
+        trips_to_match = self.trips_to_match
+        self.trips_to_match = []
+
+        super().save()
+
+        # now the journeys have ids
+        for journey, vehicle, trip_kwargs in trips_to_match:
+            future = self.trip_matcher.submit(
+                self.match_trip_later, copy(journey), copy(vehicle), trip_kwargs
+            )
+            self.matched_trips.append((journey, future))
+
+    def create_vehicle_location(self, activity):
+        location = super().create_vehicle_location(activity)
+        if not location:
+            return
+
+        monitored_vehicle_journey = activity.data["MonitoredVehicleJourney"]
+        if delay := monitored_vehicle_journey.get("Delay"):
+            location.delay = parse_duration(delay)
+        location.occupancy = occupancies.get(monitored_vehicle_journey.get("Occupancy"))
+        if activity.operator_ref == "TFLO":
+            location.tfl_code = activity.vehicle_ref
+        extensions = activity.data.get("Extensions")
         if extensions:
             extensions = extensions.get("VehicleJourney") or extensions.get(
                 "VehicleJourneyExtensions"
@@ -590,7 +800,7 @@ class Command(ImportLiveVehiclesCommand):
         return location
 
     def get_items(self):
-        response = self.session.get(self.source.url, timeout=61)
+        response = self.get_response(self.source.url, timeout=61)
 
         if not response.ok:
             print(response.headers, response.content, response)
@@ -604,30 +814,104 @@ class Command(ImportLiveVehiclesCommand):
                 namelist = archive.namelist()
                 assert len(namelist) == 1
                 with archive.open(namelist[0]) as open_file:
-                    data = open_file.read()
-        else:
-            data = response.content
+                    return self.parse_items(open_file)
+
+        return self.parse_items(io.BytesIO(response.content))
 
-        with sentry_sdk.start_span(name="parse XML"):
-            root = etree.fromstring(data)
+    def parse_items(self, source) -> list[VehicleActivity]:
+        """Parse a SIRI-VM document incrementally, without building the whole tree.
 
+        Only activities that have changed since the last poll are turned into dicts
+        and parsed into VehicleActivity fields -
+        unchanged ones are just counted (in self.unchanged_items)
+        """
         ns = _SIRI_NS
-        service_delivery = root.find(f"{{{ns}}}ServiceDelivery")
+        items = []
         previous_time = self.source.datetime
+        timestamp = None
+
+        with sentry_sdk.start_span(name="parse XML"), self.timings.stage("parse"):
+            for _, elem in etree.iterparse(
+                source,
+                events=("end",),
+                tag=(f"{{{ns}}}ResponseTimestamp", f"{{{ns}}}VehicleActivity"),
+            ):
+                if elem.tag == f"{{{ns}}}VehicleActivity":
+                    identities = self.get_element_identities(elem)
+                    if not identities:
+                        items.append(_elem_to_dict(elem))
+                    elif (
+                        self.identifiers.get(identities[0]) == identities[2]
+                        and self.journeys_ids.get(identities[0]) == identities[1]
+                    ):
+                        self.unchanged_items += 1
+                    else:
+                        item = _elem_to_dict(elem)
+                        items.append(
+                            VehicleActivity(
+                                item, *identities, **self.get_activity_fields(item)
+                            )
+                        )
+                elif timestamp is None:
+                    # ServiceDelivery/ResponseTimestamp
+                    timestamp = datetime.fromisoformat(elem.text)
+                    self.source.datetime = timestamp
+                    if previous_time and timestamp < previous_time:
+                        return  # don't return old data
+
+                # free memory as we go
+                elem.clear(keep_tail=True)
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        return items
 
-        self.source.datetime = datetime.fromisoformat(
-            service_delivery.findtext(f"{{{ns}}}ResponseTimestamp")
+    @staticmethod
+    def get_element_identities(elem) -> tuple[str, str, str] | None:
+        """The same as get_vehicle_identity, get_journey_identity and get_item_identity,
+        but for a VehicleActivity element (without converting it to a dict first)
+        """
+        ns = _SIRI_NS
+        monitored_vehicle_journey = elem.find(f"{{{ns}}}MonitoredVehicleJourney")
+        if monitored_vehicle_journey is None:
+            return
+
+        item_identity = _find_value(elem, "RecordedAtTime")
+        operator_ref = _find_value(monitored_vehicle_journey, "OperatorRef")
+        vehicle_ref = _find_value(monitored_vehicle_journey, "VehicleRef")
+        if item_identity is None or operator_ref is None:
+            return
+
+        vehicle_unique_id = elem.find(
+            f"{{{ns}}}Extensions/{{{ns}}}VehicleJourney/{{{ns}}}VehicleUniqueId"
+        )
+        if vehicle_unique_id is not None:
+            vehicle_ref = f"{vehicle_ref}:{_elem_to_dict(vehicle_unique_id)}"
+
+        journey_ref = _find_value(monitored_vehicle_journey, "FramedVehicleJourneyRef")
+        if journey_ref is None:
+            journey_ref = _find_value(monitored_vehicle_journey, "VehicleJourneyRef")
+
+        journey_identity = " ".join(
+            str(value)
+            for value in (
+                _find_value(monitored_vehicle_journey, "LineRef"),
+                _find_value(monitored_vehicle_journey, "PublishedLineName"),
+                journey_ref,
+                _find_value(monitored_vehicle_journey, "OriginAimedDepartureTime"),
+                _find_value(monitored_vehicle_journey, "DirectionRef"),
+                _find_value(monitored_vehicle_journey, "DestinationName"),
+            )
         )
 
-        if (
-            self.source.datetime
-            and previous_time
-            and self.source.datetime < previous_time
-        ):
-            return  # don't return old data
+        return f"{operator_ref}:{vehicle_ref}", journey_identity, item_identity
+
+    def get_changed_items(self, items=None):
+        self.unchanged_items = 0
 
-        delivery = service_delivery.find(f"{{{ns}}}VehicleMonitoringDelivery")
-        return [_elem_to_dict(a) for a in delivery.findall(f"{{{ns}}}VehicleActivity")]
+        *changed, total_items = super().get_changed_items(items)
+
+        return (*changed, total_items + self.unchanged_items)
 
     @staticmethod
     def get_vehicle_identity(item):
@@ -666,33 +950,22 @@ class Command(ImportLiveVehiclesCommand):
         return item["RecordedAtTime"]
 
     def update(self):
+        self.timings = Timings()
         with sentry_sdk.start_transaction(name="bod_avl_update"):
             now = timezone.now()
 
-            with sentry_sdk.start_span(name="get changed items"):
-                (
-                    changed_items,
-                    changed_journey_items,
-                    changed_item_identities,
-                    changed_journey_identities,
-                    total_items,
-                ) = self.get_changed_items()
+            try:
+                changed_items, total_items = self.handle_changed_items()
+            except NotModified:
+                self.schedule.record(now, False)
+                return self.schedule.get_wait((timezone.now() - now).total_seconds())
 
-            age = int((now - self.source.datetime).total_seconds())
-            if age > 0:
-                self.hist[now.second % 10] = age
-                print(self.hist)
+            self.schedule.record(now, bool(changed_items), self.source.datetime)
+            if self.schedule.age is not None and self.schedule.age > 0:
                 print(
-                    f"{now.second=} {age=}  {total_items=}  {len(changed_items)=}  {len(changed_journey_items)=}"
+                    f"{now.second=} {self.schedule.age=}  {total_items=}  {changed_items=}"
                 )
 
-            with sentry_sdk.start_span(name="handle quick items") as span:
-                span.set_data("count", len(changed_items))
-                self.handle_items(changed_items, changed_item_identities)
-            with sentry_sdk.start_span(name="handle changed journey items") as span:
-                span.set_data("count", len(changed_journey_items))
-                self.handle_items(changed_journey_items, changed_journey_identities)
-
             time_taken = (timezone.now() - now).total_seconds()
 
             # stats for last 50 updates:
@@ -703,8 +976,10 @@ class Command(ImportLiveVehiclesCommand):
                     self.source.datetime,
                     now - self.source.datetime,
                     total_items,
-                    len(changed_items) + len(changed_journey_items),
+                    changed_items,
                     time_taken,
+                    self.timings.get_stages(),
+                    self.timings.get_operators(),
                 )
             )
             bod_status = bod_status[-50:]
@@ -712,24 +987,4 @@ class Command(ImportLiveVehiclesCommand):
 
             print(f"{time_taken=}")
 
-            if time_taken > 11:
-                return 0
-
-            # bods updates "every 10 seconds",
-            # it's usually worth waiting 0-9 seconds
-            # before the next fetch
-            # for maximum freshness:
-
-            if age > 1:
-                witching_hour = min(self.hist, key=self.hist.get)
-                worst_hour = max(self.hist, key=self.hist.get)
-                now = timezone.now().second % 10
-                wait = witching_hour - now
-                if wait <= 0:
-                    wait += 10
-                diff = worst_hour - witching_hour
-                print(f"{witching_hour=} {worst_hour=} {diff=} {now=} {wait=}\n")
-                if diff % 10 == 9:
-                    return wait
-
-            return max(11 - time_taken, 0)
+            return self.schedule.get_wait(time_taken)
@@ -1,14 +1,11 @@
 from datetime import datetime
 
-import requests
-
-from django.contrib.gis.geos import GEOSGeometry
 from django.utils import timezone
 from django.db.models import Q
 
 from busstops.models import Service
 
-from ...models import VehicleJourney, VehicleLocation, Operator
+from ...models import VehicleJourney, Operator
 from ..import_live_vehicles import ImportLiveVehiclesCommand
 from .import_bod_avl import get_line_name_query
 
@@ -22,7 +19,9 @@ class Command(ImportLiveVehiclesCommand):
     wait = 92
 
     def get_items(self):
-        self.session = requests.Session()
+        # start afresh each time, but keep using the shared connection pool
+        # (see Fetcher.mount)
+        self.session.cookies.clear()
         return super().get_items()
 
     @staticmethod
@@ -54,20 +53,40 @@ class Command(ImportLiveVehiclesCommand):
     def get_datetime(item):
         return parse_datetime(item["RecordedAtTime"])
 
-    def get_operators(self, item):
-        code = item["OperatorRef"]
+    def get_activity_fields(self, item) -> dict:
+        bearing = item["Bearing"]
+        if bearing == "-1" or bearing == "0":
+            bearing = None
+        if departure_time := item["DepartureTime"]:
+            departure_time = parse_datetime(departure_time)
+        return {
+            "datetime": self.get_datetime(item),
+            "longitude": float(item["Longitude"]),
+            "latitude": float(item["Latitude"]),
+            "heading": float(bearing) if bearing else None,
+            "vehicle_ref": item["VehicleRef"],
+            "operator_ref": item["OperatorRef"],
+            "line_ref": item["PublishedLineName"],
+            "journey_ref": item["JourneyCode"],
+            "departure_time": departure_time or None,
+            "destination": item["DestinationStopLocality"]
+            or item["DestinationStopName"],
+        }
+
+    def get_operators(self, activity):
+        code = activity.operator_ref
         return Operator.objects.filter(
             Q(noc=code) | Q(operatorcode__code=code, operatorcode__source=self.source)
         )
 
-    def get_vehicle(self, item):
-        code = item["VehicleRef"]
+    def get_vehicle(self, activity):
+        code = activity.vehicle_ref
         if code.isdigit():
             fleet_number = code
         else:
             fleet_number = None
 
-        operators = self.get_operators(item)
+        operators = self.get_operators(activity)
 
         defaults = {
             "fleet_number": fleet_number,
@@ -86,14 +105,15 @@ class Command(ImportLiveVehiclesCommand):
                 False,
             )
 
-    def get_service(self, item):
-        line_name = item["PublishedLineName"]
+    def get_service(self, activity):
+        line_name = activity.line_ref
         if not line_name:
             return
+        item = activity.data
         services = Service.objects.filter(
             get_line_name_query(line_name),
             current=True,
-            operator__in=self.get_operators(item),
+            operator__in=self.get_operators(activity),
         )
         try:
             try:
@@ -112,12 +132,9 @@ class Command(ImportLiveVehiclesCommand):
                 item["DestinationRef"],
             )
 
-    def get_journey(self, item, vehicle):
-        code = item["JourneyCode"]
-        if dt := item["DepartureTime"]:
-            dt = parse_datetime(dt)
-        else:
-            dt = None
+    def get_journey(self, activity, vehicle):
+        code = activity.journey_ref
+        dt = activity.departure_time
 
         latest_journey = vehicle.latest_journey
         if (
@@ -137,28 +154,17 @@ class Command(ImportLiveVehiclesCommand):
         journey = VehicleJourney(
             datetime=dt,
             code=code or "",
-            route_name=item["PublishedLineName"] or "",
-            service=self.get_service(item),
-            destination=item["DestinationStopLocality"]
-            or item["DestinationStopName"]
-            or "",
-            direction=item["DirectionRef"],
+            route_name=activity.line_ref or "",
+            service=self.get_service(activity),
+            destination=activity.destination or "",
+            direction=activity.data["DirectionRef"],
         )
 
         if journey.service_id and not journey.id and dt:
             journey.trip = journey.get_trip(
-                departure_time=dt, destination_ref=item["DestinationRef"]
+                departure_time=dt, destination_ref=activity.data["DestinationRef"]
             )
             if journey.trip and not journey.destination:
                 journey.destination = journey.trip.headsign or ""
 
         return journey
-
-    def create_vehicle_location(self, item):
-        bearing = item["Bearing"]
-        if bearing == "-1" or bearing == "0":
-            bearing = None
-        return VehicleLocation(
-            latlong=GEOSGeometry(f"POINT({item['Longitude']} {item['Latitude']})"),
-            heading=bearing,
-        )
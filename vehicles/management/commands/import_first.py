@@ -7,21 +7,58 @@ import requests
 from asgiref.sync import sync_to_async
 from django.db.models import Q
 from django.contrib.gis.db.models import Extent
-from django.contrib.gis.geos import Point
 from django.utils import timezone
 from websockets.asyncio.client import connect
 
 from busstops.models import DataSource, Operator, Service
 
-from ...models import Vehicle, VehicleJourney, VehicleLocation
-from ..import_live_vehicles import ImportLiveVehiclesCommand, logger
+from ...models import Vehicle, VehicleJourney
+from ..import_live_vehicles import ImportLiveVehiclesCommand, VehicleActivity, logger
 
 
 class Command(ImportLiveVehiclesCommand):
-    def handle_item(self, item, vehicle):
+    def get_activity(self, item) -> VehicleActivity:
         journey_code, vehicle_code = self.split_vehicle_id(item)
+        status = item["status"]
 
-        recorded_at_time = datetime.fromisoformat(item["status"]["recorded_at_time"])
+        heading = status["bearing"]
+        if heading == -1:
+            heading = None
+
+        # origin aimed departure time
+        departure_time = item["stops"][0]["date"] + " " + item["stops"][0]["time"]
+        departure_time = timezone.make_aware(
+            datetime.strptime(departure_time, "%Y-%m-%d %H:%M")
+        )
+
+        destination = item["stops"][-1]
+        if destination["locality"]:
+            destination = destination["locality"].split(", ", 1)[0]
+        else:
+            destination = destination["stop_name"].split(", ", 1)[0]
+
+        longitude, latitude = status["location"]["coordinates"]
+
+        return VehicleActivity(
+            item,
+            vehicle_code,
+            journey_code,
+            status["recorded_at_time"],
+            datetime=datetime.fromisoformat(status["recorded_at_time"]),
+            longitude=longitude,
+            latitude=latitude,
+            heading=heading,
+            vehicle_ref=vehicle_code,
+            operator_ref=item["operator"],
+            line_ref=item["line_name"],
+            journey_ref=journey_code,
+            departure_time=departure_time,
+            destination=destination,
+        )
+
+    def handle_item(self, activity, vehicle):
+        vehicle_code = activity.vehicle_ref
+        recorded_at_time = activity.datetime
 
         if vehicle_code in self.cache and self.cache[vehicle_code] == recorded_at_time:
             return
@@ -37,15 +74,11 @@ class Command(ImportLiveVehiclesCommand):
                     "fleet_code": str(fleet_number or ""),
                     "fleet_number": fleet_number,
                 },
-                operator_id=item["operator"],
+                operator_id=activity.operator_ref,
                 code=vehicle_code,
             )
 
-        # origin aimed departure time
-        departure_time = item["stops"][0]["date"] + " " + item["stops"][0]["time"]
-        departure_time = timezone.make_aware(
-            datetime.strptime(departure_time, "%Y-%m-%d %H:%M")
-        )
+        departure_time = activity.departure_time
 
         if vehicle.latest_journey and vehicle.latest_journey.datetime == departure_time:
             journey = vehicle.latest_journey
@@ -61,36 +94,31 @@ class Command(ImportLiveVehiclesCommand):
                 service = (
                     Service.objects.filter(
                         current=True,
-                        operator=item["operator"],
-                        route__line_name__iexact=item["line_name"],
+                        operator=activity.operator_ref,
+                        route__line_name__iexact=activity.line_ref,
                     )
                     .distinct()
                     .get()
                 )
             except (Service.DoesNotExist, Service.MultipleObjectsReturned) as e:
-                print(e, item["operator"], item["line_name"])
+                print(e, activity.operator_ref, activity.line_ref)
                 service = None
             if service and not service.tracking:
                 service.tracking = True
                 service.save(update_fields=["tracking"])
 
-            destination = item["stops"][-1]
-            if destination["locality"]:
-                destination = destination["locality"].split(", ", 1)[0]
-            else:
-                destination = destination["stop_name"].split(", ", 1)[0]
             journey = VehicleJourney(
-                route_name=item["line_name"],
-                code=journey_code,
+                route_name=activity.line_ref,
+                code=activity.journey_ref,
                 datetime=departure_time,
                 source=self.source,
-                destination=destination,
+                destination=activity.destination,
                 vehicle=vehicle,
                 service=service,
             )
             journey.trip = journey.get_trip(
                 departure_time=departure_time,
-                destination_ref=item["stops"][-1]["atcocode"],
+                destination_ref=activity.data["stops"][-1]["atcocode"],
             )
             if not journey.date:
                 journey.date = timezone.localdate(departure_time)
@@ -105,17 +133,10 @@ class Command(ImportLiveVehiclesCommand):
 
         if vehicle.latest_journey != journey:
             vehicle.latest_journey = journey
-            vehicle.latest_journey_data = item
+            vehicle.latest_journey_data = activity.data
             vehicle.save(update_fields=["latest_journey", "latest_journey_data"])
 
-        heading = item["status"]["bearing"]
-        if heading == -1:
-            heading = None
-
-        location = VehicleLocation(
-            latlong=Point(*item["status"]["location"]["coordinates"]),
-            heading=heading,
-        )
+        location = self.create_vehicle_location(activity)
         location.id = vehicle.id
         location.datetime = recorded_at_time
         location.journey = journey
@@ -153,15 +174,16 @@ class Command(ImportLiveVehiclesCommand):
         else:
             items = data["member"]
 
-        vehicle_codes = [self.split_vehicle_id(item)[1] for item in items]
+        activities = [self.get_activity(item) for item in items]
+        vehicle_codes = [activity.vehicle_ref for activity in activities]
         print(vehicle_codes)
         vehicles = Vehicle.objects.filter(
             operator__group__name="First", code__in=vehicle_codes
         )
         vehicles = vehicles.select_related("latest_journey")
         vehicles = {vehicle.code: vehicle for vehicle in vehicles}
-        for i, item in enumerate(items):
-            self.handle_item(item, vehicles.get(vehicle_codes[i]))
+        for activity in activities:
+            self.handle_item(activity, vehicles.get(activity.vehicle_ref))
         self.save()
 
     @staticmethod
@@ -43,8 +43,8 @@ class Command(GTFSRCommand):
             if item.HasField("vehicle"):
                 yield item
 
-    def get_vehicle(self, item):
-        vehicle_code = item.vehicle.vehicle.id
+    def get_vehicle(self, activity):
+        vehicle_code = activity.vehicle_ref
         reg = vehicle_code.replace(" ", "")
 
         return Vehicle.objects.filter(Q(code=vehicle_code) | Q(code=reg)).get_or_create(
@@ -52,11 +52,11 @@ class Command(GTFSRCommand):
             defaults={"code": vehicle_code, "reg": reg},
         )
 
-    def get_journey(self, item, vehicle):
-        journey = VehicleJourney(code=item.vehicle.trip.trip_id)
+    def get_journey(self, activity, vehicle):
+        journey = VehicleJourney(code=activity.journey_ref)
 
         start_date = datetime.strptime(
-            f"{item.vehicle.trip.start_date} 12:00:00",
+            f"{activity.data.vehicle.trip.start_date} 12:00:00",
             "%Y%m%d %H:%M:%S",
         )
         journey.date = start_date.date()
@@ -73,8 +73,7 @@ class Command(GTFSRCommand):
                 - timedelta(hours=12)
                 + trip.start
             )
-            now = self.get_datetime(item)
-            if journey.datetime - now > timedelta(hours=12):
+            if journey.datetime - activity.datetime > timedelta(hours=12):
                 journey.datetime -= timedelta(days=1)
 
             journey.service = trip.route.service
@@ -82,6 +81,6 @@ class Command(GTFSRCommand):
             journey.route_name = journey.service.line_name
             journey.destination = trip.headsign or ""
 
-        vehicle.latest_journey_data = json_format.MessageToDict(item)
+        vehicle.latest_journey_data = json_format.MessageToDict(activity.data)
 
         return journey
@@ -2,7 +2,6 @@ from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
 from django.conf import settings
-from django.contrib.gis.geos import GEOSGeometry
 from django.utils.dateparse import parse_duration
 from google.protobuf import json_format
 from google.transit import gtfs_realtime_pb2
@@ -11,7 +10,7 @@ from busstops.models import DataSource, Service
 from bustimes.models import Trip
 from bustimes.utils import get_calendars
 
-from ...models import Vehicle, VehicleJourney, VehicleLocation
+from ...models import Vehicle, VehicleJourney
 from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 occupancies = {
@@ -41,6 +40,17 @@ class Command(ImportLiveVehiclesCommand):
     def get_datetime(item):
         return datetime.fromtimestamp(item.vehicle.timestamp, timezone.utc)
 
+    def get_activity_fields(self, item) -> dict:
+        return {
+            "datetime": self.get_datetime(item),
+            "longitude": item.vehicle.position.longitude,
+            "latitude": item.vehicle.position.latitude,
+            "heading": item.vehicle.position.bearing or None,
+            "vehicle_ref": item.vehicle.vehicle.id,
+            "line_ref": item.vehicle.trip.route_id,
+            "journey_ref": item.vehicle.trip.trip_id,
+        }
+
     @staticmethod
     def get_vehicle_identity(item):
         return item.vehicle.vehicle.id
@@ -69,11 +79,13 @@ class Command(ImportLiveVehiclesCommand):
 
         return feed.entity
 
-    def get_vehicle(self, item):
-        vehicle_code = item.vehicle.vehicle.id
+    def get_vehicle(self, activity):
+        vehicle_code = activity.vehicle_ref
         return Vehicle.objects.get_or_create(code=vehicle_code, source=self.source)
 
-    def get_journey(self, item, vehicle):
+    def get_journey(self, activity, vehicle):
+        item = activity.data
+
         # GTFS spec for working out datetimes:
         start_date = datetime.strptime(
             f"{item.vehicle.trip.start_date} 12:00:00",
@@ -86,7 +98,7 @@ class Command(ImportLiveVehiclesCommand):
 
         # assert not (datetime.fromtimestamp(item.vehicle.timestamp) - start_date_time > timedelta(hours=12))
 
-        journey = VehicleJourney(code=item.vehicle.trip.trip_id)
+        journey = VehicleJourney(code=activity.journey_ref)
 
         if (
             latest_journey := vehicle.latest_journey
@@ -99,13 +111,13 @@ class Command(ImportLiveVehiclesCommand):
         services = Service.objects.filter(
             current=True,
             route__source=self.source,
-            route__code=item.vehicle.trip.route_id,
+            route__code=activity.line_ref,
         ).distinct()
         if not services:
-            if "_" in item.vehicle.trip.route_id:
-                suffix = item.vehicle.trip.route_id.split("_", 1)[1]
+            if "_" in activity.line_ref:
+                suffix = activity.line_ref.split("_", 1)[1]
             else:
-                suffix = item.vehicle.trip.route_id
+                suffix = activity.line_ref
             services = Service.objects.filter(
                 current=True,
                 route__source=self.source,
@@ -158,11 +170,9 @@ class Command(ImportLiveVehiclesCommand):
 
         return journey
 
-    def create_vehicle_location(self, item):
-        return VehicleLocation(
-            heading=item.vehicle.position.bearing or None,
-            latlong=GEOSGeometry(
-                f"POINT({item.vehicle.position.longitude} {item.vehicle.position.latitude})"
-            ),
-            occupancy=occupancies.get(item.vehicle.occupancy_status or None),
+    def create_vehicle_location(self, activity):
+        location = super().create_vehicle_location(activity)
+        location.occupancy = occupancies.get(
+            activity.data.vehicle.occupancy_status or None
         )
+        return location
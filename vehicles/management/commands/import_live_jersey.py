@@ -1,9 +1,8 @@
 from datetime import datetime
-from django.contrib.gis.geos import Point
 from django.utils.timezone import make_aware
 from busstops.models import Service
 from ..import_live_vehicles import ImportLiveVehiclesCommand
-from ...models import VehicleLocation, VehicleJourney
+from ...models import VehicleJourney
 
 
 class Command(ImportLiveVehiclesCommand):
@@ -15,6 +14,19 @@ class Command(ImportLiveVehiclesCommand):
     def get_datetime(item):
         return datetime.fromisoformat(item["TimeOfUpdate"] + "Z")
 
+    def get_activity_fields(self, item) -> dict:
+        return {
+            "datetime": self.get_datetime(item),
+            "longitude": item["Longitude"],
+            "latitude": item["Latitude"],
+            "heading": item["Bearing"],
+            "vehicle_ref": item["AssetRegistrationNumber"],
+            "line_ref": item["ServiceName"],
+            "departure_time": make_aware(
+                datetime.fromisoformat(item["OriginalStartTime"])
+            ),
+        }
+
     @staticmethod
     def get_vehicle_identity(item):
         return item["AssetRegistrationNumber"]
@@ -31,8 +43,8 @@ class Command(ImportLiveVehiclesCommand):
     def get_item_identity(item):
         return item["TimeOfUpdate"]
 
-    def get_vehicle(self, item):
-        vehicle_code = item["AssetRegistrationNumber"]
+    def get_vehicle(self, activity):
+        vehicle_code = activity.vehicle_ref
         defaults = {
             "operator_id": self.operator,
         }
@@ -45,17 +57,12 @@ class Command(ImportLiveVehiclesCommand):
     def get_items(self):
         return super().get_items()["updates"]
 
-    def get_journey(self, item, _):
+    def get_journey(self, activity, _):
         journey = VehicleJourney()
-        journey.route_name = item["ServiceName"]
-        journey.direction = item["Direction"]
-        journey.datetime = make_aware(datetime.fromisoformat(item["OriginalStartTime"]))
+        journey.route_name = activity.line_ref
+        journey.direction = activity.data["Direction"]
+        journey.datetime = activity.departure_time
         journey.service = Service.objects.filter(
             line_name=journey.route_name, operator=self.operator, current=True
         ).first()
         return journey
-
-    def create_vehicle_location(self, item):
-        return VehicleLocation(
-            latlong=Point(item["Longitude"], item["Latitude"]), heading=item["Bearing"]
-        )
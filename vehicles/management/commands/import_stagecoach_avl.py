@@ -1,11 +1,10 @@
 from datetime import datetime, timezone
-from django.contrib.gis.geos import GEOSGeometry
 from django.db.models import Exists, OuterRef, Q
 from django.utils.timezone import localdate
 
 from busstops.models import Operator, Service, StopPoint
 
-from ...models import Vehicle, VehicleJourney, VehicleLocation
+from ...models import Vehicle, VehicleJourney
 from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 # "fn" "fleetNumber": "10452",
@@ -88,13 +87,29 @@ class Command(ImportLiveVehiclesCommand):
     def get_datetime(item):
         return parse_timestamp(item["ut"])
 
+    def get_activity_fields(self, item) -> dict:
+        return {
+            "datetime": self.get_datetime(item),
+            "longitude": float(item["lo"]),
+            "latitude": float(item["la"]),
+            "heading": float(item["hg"]) if item.get("hg") else None,
+            "vehicle_ref": item["fn"],  # fleetNumber
+            "operator_ref": item.get("oc"),  # operatingCompany
+            "line_ref": item.get("sn", ""),  # serviceNumber
+            "journey_ref": item.get("td", ""),  # tripId
+            # aimedOriginStopDepartureTime
+            "departure_time": parse_timestamp(item.get("ao")),
+            # destinationDisplay or finalStopName
+            "destination": item.get("dd", "") or item.get("fs", ""),
+        }
+
     def get_items(self):
         return super().get_items()["services"]
 
-    def get_vehicle(self, item) -> tuple[Vehicle, bool]:
-        vehicle_code = item["fn"]
+    def get_vehicle(self, activity) -> tuple[Vehicle, bool]:
+        vehicle_code = activity.vehicle_ref
 
-        operator_id = item.get("oc")
+        operator_id = activity.operator_ref
 
         if operator_id in self.operators:
             operator = self.operators[operator_id]
@@ -104,7 +119,7 @@ class Command(ImportLiveVehiclesCommand):
         vehicle = Vehicle.objects.filter(
             operator=None, code__iexact=vehicle_code
         ).first()
-        if vehicle or item.get("hg") == "0":
+        if vehicle or activity.data.get("hg") == "0":
             return vehicle, False
 
         return Vehicle.objects.filter(operator__in=self.operators).get_or_create(
@@ -112,11 +127,9 @@ class Command(ImportLiveVehiclesCommand):
             code=vehicle_code,
         )
 
-    def get_journey(self, item, vehicle):
-        if item.get("ao"):  # aimedOriginStopDepartureTime
-            departure_time = parse_timestamp(item["ao"])
-        else:
-            departure_time = None
+    def get_journey(self, activity, vehicle):
+        item = activity.data
+        departure_time = activity.departure_time
 
         if departure_time:
             if (
@@ -137,12 +150,11 @@ class Command(ImportLiveVehiclesCommand):
 
         journey = VehicleJourney(
             datetime=departure_time,
-            destination=item.get("dd", "")
-            or item.get("fs", ""),  # destinationDisplay or finalStopName
-            route_name=item.get("sn", ""),  # serviceNumber
+            destination=activity.destination,
+            route_name=activity.line_ref,
         )
 
-        if code := item.get("td", ""):  # trip id:
+        if code := activity.journey_ref:
             journey.code = code
 
         if not journey.service_id and journey.route_name:
@@ -173,10 +185,3 @@ class Command(ImportLiveVehiclesCommand):
             )
 
         return journey
-
-    def create_vehicle_location(self, item):
-        return VehicleLocation(
-            latlong=GEOSGeometry(f"POINT({item['lo']} {item['la']})"),
-            heading=item.get("hg"),
-            # occupancy=occupancies.get(item.get("rg")),
-        )
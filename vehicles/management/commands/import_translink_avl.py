@@ -1,11 +1,10 @@
 from datetime import timedelta, datetime
 
-from django.contrib.gis.geos import GEOSGeometry
 from django.db.models import Q
 
 from busstops.models import Operator, Service
 
-from ...models import Vehicle, VehicleJourney, VehicleLocation
+from ...models import Vehicle, VehicleJourney
 from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 
@@ -28,6 +27,17 @@ class Command(ImportLiveVehiclesCommand):
     def get_datetime(item):
         return datetime.fromisoformat(item["Timestamp"])
 
+    def get_activity_fields(self, item) -> dict:
+        return {
+            "datetime": self.get_datetime(item),
+            "longitude": float(item["X"]),
+            "latitude": float(item["Y"]),
+            "vehicle_ref": item["VehicleIdentifier"],
+            "line_ref": item["LineText"],
+            "journey_ref": item["JourneyIdentifier"],
+            "destination": item["DirectionText"],
+        }
+
     @staticmethod
     def get_vehicle_identity(item):
         return item["VehicleIdentifier"]
@@ -44,8 +54,8 @@ class Command(ImportLiveVehiclesCommand):
     def get_item_identity(item):
         return item["Timestamp"]
 
-    def get_vehicle(self, item) -> tuple[Vehicle, bool]:
-        vehicle_code = item["VehicleIdentifier"]
+    def get_vehicle(self, activity) -> tuple[Vehicle, bool]:
+        vehicle_code = activity.vehicle_ref
 
         operator_id, fleet_code = vehicle_code.split("-", 1)
 
@@ -74,11 +84,11 @@ class Command(ImportLiveVehiclesCommand):
             code=vehicle_code,
         )
 
-    def get_journey(self, item, vehicle):
+    def get_journey(self, activity, vehicle):
         journey = VehicleJourney(
-            code=item["JourneyIdentifier"],
-            destination=item["DirectionText"],
-            route_name=item["LineText"],
+            code=activity.journey_ref,
+            destination=activity.destination,
+            route_name=activity.line_ref,
         )
         if (latest_journey := vehicle.latest_journey) and (
             journey.code == latest_journey.code
@@ -100,16 +110,16 @@ class Command(ImportLiveVehiclesCommand):
             ).first()
 
         if journey.service:
-            journey.trip = journey.get_trip(date=parse_date(item["DayOfOperation"]))
+            journey.trip = journey.get_trip(
+                date=parse_date(activity.data["DayOfOperation"])
+            )
             print(journey.trip)
 
         return journey
 
-    def create_vehicle_location(self, item):
-        delay = item.get("Delay")
+    def create_vehicle_location(self, activity):
+        location = super().create_vehicle_location(activity)
+        delay = activity.data.get("Delay")
         if delay is not None:
-            delay = timedelta(seconds=delay)
-        return VehicleLocation(
-            latlong=GEOSGeometry(f"POINT({item['X']} {item['Y']})"),
-            delay=delay,
-        )
+            location.delay = timedelta(seconds=delay)
+        return location
@@ -1,11 +1,10 @@
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from django.db.models import Q
-from django.contrib.gis.geos import GEOSGeometry
 
 from busstops.models import Service
 
-from ...models import Vehicle, VehicleJourney, VehicleLocation
+from ...models import Vehicle, VehicleJourney
 from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 
@@ -46,11 +45,26 @@ class Command(ImportLiveVehiclesCommand):
             tzinfo=ZoneInfo("Europe/London")
         )
 
+    def get_activity_fields(self, item) -> dict:
+        coords = item["coordinate"]
+        fields = {
+            "datetime": self.get_datetime(item),
+            "heading": item["bearing"] or None,
+            "vehicle_ref": item["vehicleID"],
+            "line_ref": item["routeName"] or "",
+            "journey_ref": item["tripID"] or "",
+            "destination": item["destination"] or "",
+        }
+        if not (coords["longitude"] < -7 and coords["latitude"] < 50):  # (bogus)
+            fields["longitude"] = coords["longitude"]
+            fields["latitude"] = coords["latitude"]
+        return fields
+
     def get_items(self):
         return super().get_items()["vehicles"]
 
-    def get_vehicle(self, item):
-        vehicle_code = item["vehicleID"]
+    def get_vehicle(self, activity):
+        vehicle_code = activity.vehicle_ref
 
         return Vehicle.objects.filter(
             Q(operator__in=self.operators) | Q(source=self.source)
@@ -59,11 +73,11 @@ class Command(ImportLiveVehiclesCommand):
             code=vehicle_code,
         )
 
-    def get_journey(self, item, vehicle):
+    def get_journey(self, activity, vehicle):
         journey = VehicleJourney(
-            route_name=item["routeName"] or "",
-            code=item["tripID"] or "",
-            destination=item["destination"] or "",
+            route_name=activity.line_ref,
+            code=activity.journey_ref,
+            destination=activity.destination,
         )
 
         if journey.route_name == "Tram":
@@ -84,18 +98,9 @@ class Command(ImportLiveVehiclesCommand):
 
         if journey.service_id:
             journey.trip = journey.get_trip(
-                next_stop=item["nextStopCode"],
+                next_stop=activity.data["nextStopCode"],
                 approximate_datetime=True,
-                datetime=self.get_datetime(item),
+                datetime=activity.datetime,
             )
 
         return journey
-
-    def create_vehicle_location(self, item):
-        coords = item["coordinate"]
-        if coords["longitude"] < -7 and coords["latitude"] < 50:
-            return
-        return VehicleLocation(
-            latlong=GEOSGeometry(f"POINT({coords['longitude']} {coords['latitude']})"),
-            heading=item["bearing"] or None,
-        )
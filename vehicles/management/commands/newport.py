@@ -1,7 +1,6 @@
 from datetime import datetime
-from django.contrib.gis.geos import GEOSGeometry
 from django.utils.timezone import localdate
-from ...models import VehicleLocation, VehicleJourney
+from ...models import VehicleJourney
 from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 
@@ -16,6 +15,22 @@ class Command(ImportLiveVehiclesCommand):
     def get_datetime(item):
         return datetime.fromisoformat(item["reported"])
 
+    def get_activity_fields(self, item) -> dict:
+        position = item["position"]
+        bearing = position.get("bearing")
+        if bearing == "-1":
+            bearing = None
+        return {
+            "datetime": self.get_datetime(item),
+            "longitude": float(position["longitude"]),
+            "latitude": float(position["latitude"]),
+            "heading": float(bearing) if bearing else None,
+            "vehicle_ref": item["vehicleRef"],
+            "line_ref": item["routeName"],
+            "departure_time": datetime.fromisoformat(item["scheduledTripStartTime"]),
+            "destination": item.get("destination", ""),
+        }
+
     @staticmethod
     def get_vehicle_identity(item):
         return item["vehicleRef"]
@@ -32,14 +47,14 @@ class Command(ImportLiveVehiclesCommand):
     def get_item_identity(item):
         return item["reported"]
 
-    def get_vehicle(self, item):
-        code = item["vehicleRef"]
+    def get_vehicle(self, activity):
+        code = activity.vehicle_ref
         defaults = {"reg": code}
 
         return self.vehicles.get_or_create(defaults, code=code, operator_id="SGUE")
 
-    def get_journey(self, item, vehicle):
-        dt = datetime.fromisoformat(item["scheduledTripStartTime"])
+    def get_journey(self, activity, vehicle):
+        dt = activity.departure_time
 
         latest_journey = vehicle.latest_journey
         if latest_journey and latest_journey.datetime == dt:
@@ -50,19 +65,7 @@ class Command(ImportLiveVehiclesCommand):
             if not journey:
                 journey = VehicleJourney(date=date, datetime=dt)
 
-        journey.route_name = item["routeName"]
-        journey.destination = item.get("destination", "")
+        journey.route_name = activity.line_ref
+        journey.destination = activity.destination
 
         return journey
-
-    def create_vehicle_location(self, item):
-        position = item["position"]
-        bearing = position.get("bearing")
-        if bearing == "-1":
-            bearing = None
-        return VehicleLocation(
-            latlong=GEOSGeometry(
-                f"POINT({position['longitude']} {position['latitude']})"
-            ),
-            heading=bearing,
-        )
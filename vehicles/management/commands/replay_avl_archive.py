@@ -0,0 +1,98 @@
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ... import avl_archive
+from ...models import SiriSubscription
+from ...tasks import handle_posts
+from ...utils import redis_client
+from ..import_live_vehicles import Timings
+from .import_bod_avl import Command as ImportBodAvlCommand
+
+
+class Command(BaseCommand):
+    help = """Replay archived posts to a SIRI-VM subscription (see vehicles/avl_archive.py)
+    through the same get_changed_items and handle_items as live ones,
+    and report how long it took - for benchmarking.
+    Locations are written to the configured Redis (REDIS_URL), so use a scratch one,
+    not the one the live site uses. Each post is handled as of the time it was
+    received, so live locations expire as they would have then"""
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("subscription_name", type=str)
+        parser.add_argument("--since", type=datetime.fromisoformat)
+        parser.add_argument("--until", type=datetime.fromisoformat)
+        parser.add_argument(
+            "--dir",
+            type=Path,
+            help="Directory of archive segments, if not in AVL_ARCHIVE_DIR",
+        )
+
+    def handle(self, subscription_name, since, until, dir, **options):
+        if not redis_client:
+            raise CommandError("REDIS_URL isn't configured")
+
+        subscription = SiriSubscription.objects.get(name=subscription_name)
+
+        command = ImportBodAvlCommand()
+        command.source_name = subscription.name
+        command.do_source()
+
+        records = avl_archive.read(command.source.id, since, until, dir)
+        self.replay(subscription, command, records)
+
+    def replay(self, subscription, command, records):
+        timings = Timings()
+        cycles = 0
+        total_items = 0
+        changed_items = 0
+        queries = 0
+        time_taken = 0
+
+        for record in records:
+            fields = {
+                b"content-type": b"application/json"
+                if record.name.endswith(".json")
+                else b"text/xml",
+                b"body": record.data,
+            }
+
+            # (handle_posts takes source.datetime from the data, as it does live -
+            # command.clock is the time the post was received, for expiry times)
+            command.clock = record.timestamp
+            with CaptureQueriesContext(connection) as captured_queries:
+                start = perf_counter()
+                result = handle_posts(
+                    subscription, [(None, fields)], command, live=False
+                )
+                time_taken += perf_counter() - start
+
+            cycles += 1
+            queries += len(captured_queries)
+            timings.merge(command.timings.get_stages(), command.timings.operators)
+            if result:
+                total_items += result[0] or 0
+                changed_items += result[1]
+
+            self.stdout.write(
+                f"{record.name}: {result and result[1]} changed items, "
+                f"{len(captured_queries)} queries, {command.timings.get_stages()}"
+            )
+
+        if not cycles:
+            self.stdout.write("nothing to replay")
+            return
+
+        self.stdout.write(
+            f"""
+{cycles} cycles in {time_taken:.3f}s
+{queries / cycles:.1f} queries per cycle
+{total_items / time_taken:.0f} items ({changed_items / time_taken:.0f} changed) per second
+{timings.get_stages()}
+{timings.get_operators()}"""
+        )
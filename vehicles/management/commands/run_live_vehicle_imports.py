@@ -0,0 +1,61 @@
+import logging
+import shlex
+import threading
+from time import sleep
+
+from django.core.management import call_command, load_command_class
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Run several live vehicle importers in one process,
+    each polled according to its own PollSchedule"""
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "commands",
+            nargs="+",
+            help='Importers and their arguments, like lothian "import_bushub Arriva"',
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=4,
+            help="Maximum number of importers to update at once",
+        )
+
+    @staticmethod
+    def run(importer, args, semaphore):
+        # each importer is set up and updated in its own thread, and so always uses
+        # the same database connection (which its VehicleIndex LISTENs on)
+        with semaphore:
+            call_command(importer, *args, immediate=True)  # set up, without looping
+        while True:
+            with semaphore:
+                try:
+                    delay = importer.update()
+                except Exception as e:
+                    logger.exception(e)
+                    delay = 120
+            sleep(delay)
+
+    def handle(self, commands, threads, **options):
+        semaphore = threading.BoundedSemaphore(threads)
+        workers = []
+        for command_line in commands:
+            name, *args = shlex.split(command_line)
+            importer = load_command_class("vehicles", name)
+            importer.scheduled = True
+            workers.append(
+                threading.Thread(
+                    target=self.run, args=(importer, args, semaphore), daemon=True
+                )
+            )
+
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
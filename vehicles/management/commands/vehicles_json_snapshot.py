@@ -0,0 +1,37 @@
+from time import monotonic, sleep
+
+from django.core.management.base import BaseCommand
+
+from ...utils import redis_client
+from ...views import build_vehicles_json_snapshot
+
+
+class Command(BaseCommand):
+    help = "Keep a pre-serialised snapshot of /vehicles.json up to date"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Minimum number of seconds between snapshots",
+        )
+
+    def handle(self, interval, **options):
+        version = None
+        while True:
+            # rebuild after the importers have saved some new locations
+            new_version = redis_client.get("vehicle_locations_version")
+            if new_version == version:
+                sleep(1)
+                continue
+            version = new_version
+
+            start = monotonic()
+            snapshot_version = build_vehicles_json_snapshot()
+            time_taken = monotonic() - start
+            self.stdout.write(f"{snapshot_version} {time_taken:.3f}")
+
+            if time_taken < interval:
+                sleep(interval - time_taken)
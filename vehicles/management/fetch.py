@@ -0,0 +1,53 @@
+"""Fetching data for live vehicle importers in the background
+(see ImportLiveVehiclesCommand.fetch_items)
+"""
+
+import asyncio
+import functools
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Fetcher:
+    """An asyncio event loop, running in a background thread, for fetching things -
+    with at most `per_host` requests to each host at once,
+    and a pool of connections that can be shared between requests sessions.
+
+    Blocking functions (like requests.Session.get) are run in threads,
+    because nothing here depends on an async HTTP client library.
+    """
+
+    def __init__(self, per_host=2, pool_maxsize=10):
+        self.per_host = per_host
+        self.semaphores = {}  # host: asyncio.Semaphore
+        self.adapter = HTTPAdapter(pool_connections=20, pool_maxsize=pool_maxsize)
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def mount(self, session: requests.Session):
+        """use the shared connection pool for a session"""
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+
+    async def run(self, host, function, *args):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.per_host)
+        async with self.semaphores[host]:
+            return await asyncio.to_thread(function, *args)
+
+    def submit(self, url, function, *args):
+        """from synchronous code - call function(*args) in the background,
+        counting it as a request to url's host - returns a concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.run(urlsplit(url).hostname, function, *args), self.loop
+        )
+
+
+@functools.cache
+def get_fetcher() -> Fetcher:
+    return Fetcher()
@@ -1,39 +1,407 @@
 import json
 import logging
-from collections import namedtuple
+import multiprocessing
+import zlib
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 from datetime import timedelta, datetime
-from time import sleep
+from queue import Empty
+from time import monotonic, perf_counter, sleep
 
 import requests
 import sentry_sdk
+from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, connections
 from django.db.models import Exists, OuterRef, Q
 from django.db.models.functions import Now
 from django.utils import timezone
 from redis.exceptions import ConnectionError
-from tenacity import before_sleep_log, retry, wait_exponential
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_not_exception_type,
+    wait_exponential,
+)
 
 from busstops.models import DataSource
 from bustimes.models import Route, Trip
 
-from ..models import Vehicle, VehicleJourney, VehicleCode
-from ..utils import calculate_bearing, redis_client
+from ..models import Vehicle, VehicleJourney, VehicleCode, VehicleLocation
+from .fetch import get_fetcher
+from ..rtpi import add_progress_and_delay, load_trip_geometries
+from ..utils import (
+    calculate_bearing,
+    decode_vehicle_location,
+    encode_vehicle_location,
+    redis_client,
+)
 
 logger = logging.getLogger(__name__)
 fifteen_minutes = timedelta(minutes=15)
 twelve_hours = timedelta(hours=12)
 
 
+# ARGV: expiry timestamp, then for each vehicle: id, timestamp, encoded location,
+# longitude, latitude, space-separated set names, history key, history appendage,
+# force ("1" or "").
+# Applies each location only if it's newer than the vehicle's current one
+# (or if forced - see handle_item). Returns the ids of vehicles that were updated
+upsert_vehicle_locations = """
+local accepted = {}
+local expiry = ARGV[1]
+for i = 2, #ARGV, 9 do
+    local id, timestamp = ARGV[i], ARGV[i + 1]
+    local latest = redis.call("ZSCORE", "vehicle_location_timestamps", id)
+    if not latest or tonumber(latest) < tonumber(timestamp) or ARGV[i + 8] == "1" then
+        local set_names = ARGV[i + 5]
+        redis.call("SET", "vehicle" .. id, ARGV[i + 2], "EX", 900)
+        redis.call("ZADD", "vehicle_location_timestamps", timestamp, id)
+        redis.call("GEOADD", "vehicle_location_locations", ARGV[i + 3], ARGV[i + 4], id)
+
+        local old_set_names = redis.call("HGET", "vehicle_location_sets", id)
+        if old_set_names then
+            for name in string.gmatch(old_set_names, "%S+") do
+                if not string.find(" " .. set_names .. " ", " " .. name .. " ", 1, true) then
+                    redis.call("SREM", name, id)
+                end
+            end
+        end
+        for name in string.gmatch(set_names, "%S+") do
+            redis.call("SADD", name, id)
+        end
+        redis.call("HSET", "vehicle_location_sets", id, set_names)
+        redis.call("ZADD", "vehicle_location_expiry", expiry, id)
+
+        if ARGV[i + 7] ~= "" then
+            redis.call("RPUSH", ARGV[i + 6], ARGV[i + 7])
+        end
+        table.insert(accepted, id)
+    end
+end
+if #accepted > 0 then
+    redis.call("INCR", "vehicle_locations_version")
+end
+return accepted
+"""
+
+
 Status = namedtuple(
     "Status",
-    ("fetched_at", "timestamp", "age", "total_items", "changed_items", "time_taken"),
+    (
+        "fetched_at",
+        "timestamp",
+        "age",
+        "total_items",
+        "changed_items",
+        "time_taken",
+        "stages",
+        "operators",
+    ),
+    defaults=(None, None),
 )
 
 
+class Timings:
+    """How long each stage of an update took (excluding any stages within it),
+    and how many items and how much journey matching time each operator accounted for
+    - for the status page
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.operators = defaultdict(lambda: [0, 0.0])
+        self.nested = []
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            time_taken = perf_counter() - start
+            self.stages[name] += time_taken - self.nested.pop()
+            if self.nested:
+                self.nested[-1] += time_taken
+
+    @contextmanager
+    def operator(self, operator_id):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.operators[operator_id][1] += perf_counter() - start
+
+    def count(self, operator_id):
+        self.operators[operator_id][0] += 1
+
+    def merge(self, stages: dict, operators: dict):
+        """add the timings from another Timings' get_stages and get_operators"""
+        for name, seconds in stages.items():
+            self.stages[name] += seconds
+        for operator_id, (items, seconds) in operators.items():
+            self.operators[operator_id][0] += items
+            self.operators[operator_id][1] += seconds
+
+    def get_stages(self) -> dict:
+        return {name: round(seconds, 3) for name, seconds in self.stages.items()}
+
+    def get_operators(self, limit=10) -> dict:
+        """the operators whose journeys took longest to match"""
+        operators = sorted(
+            self.operators.items(), key=lambda item: item[1][1], reverse=True
+        )
+        return {
+            operator_id: (items, round(seconds, 3))
+            for operator_id, (items, seconds) in operators[:limit]
+        }
+
+
+class VehicleActivity:
+    """An item from a live feed, parsed once by the source (in parse_items or
+    get_activity_fields) into the fields handle_item and the methods it calls
+    (get_vehicle, get_journey, create_vehicle_location, etc) need,
+    plus the identities used to work out whether it's changed since last time.
+
+    Anything peculiar to one source (occupancy, delay, ticket machine codes, etc)
+    is still read from the original item in `data`
+    """
+
+    __slots__ = (
+        "data",
+        "vehicle_identity",
+        "journey_identity",
+        "item_identity",
+        "datetime",
+        "longitude",
+        "latitude",
+        "heading",
+        "vehicle_ref",
+        "operator_ref",
+        "line_ref",
+        "journey_ref",
+        "departure_time",
+        "destination",
+        "block",
+    )
+
+    def __init__(
+        self,
+        data,
+        vehicle_identity,
+        journey_identity,
+        item_identity,
+        *,
+        datetime: datetime | None = None,
+        longitude: float | None = None,
+        latitude: float | None = None,
+        heading: float | None = None,
+        vehicle_ref: str | None = None,
+        operator_ref: str | None = None,
+        line_ref: str | None = None,
+        journey_ref: str | None = None,
+        departure_time: datetime | None = None,
+        destination: str | None = None,
+        block: str | None = None,
+    ):
+        self.data = data  # the original item (dict, protobuf message, etc)
+        self.vehicle_identity = vehicle_identity
+        self.journey_identity = journey_identity
+        self.item_identity = item_identity
+        self.datetime = datetime  # when the location was recorded
+        self.longitude = longitude
+        self.latitude = latitude
+        self.heading = heading
+        self.vehicle_ref = vehicle_ref
+        self.operator_ref = operator_ref
+        self.line_ref = line_ref
+        self.journey_ref = journey_ref
+        self.departure_time = departure_time  # origin (aimed) departure time
+        self.destination = destination
+        self.block = block
+
+
+class VehicleIndex:
+    """Long-lived map of vehicle identities (VehicleCode codes) to Vehicles
+    (with their latest journeys), so handle_items doesn't need to query the database
+    for vehicles it has seen before.
+
+    The Vehicle objects are the same ones handle_item updates, so they stay up to date
+    as long as this process is the only one changing them.
+    Changes made by other processes are announced by triggers
+    (see migration 0021_notify_vehicle_changed) so the affected vehicles can be forgotten
+    """
+
+    channel = "vehicle_changed"
+
+    def __init__(self, scheme):
+        self.scheme = scheme
+        self.vehicles = {}
+        self.identities = defaultdict(set)  # vehicle id -> identities
+        self.backend_pid = None
+        self.changed = set()
+
+    def get_queryset(self):
+        return (
+            VehicleCode.objects.filter(scheme=self.scheme)
+            .select_related("vehicle__latest_journey__trip")
+            .defer("vehicle__latest_journey_data", "vehicle__data")
+        )
+
+    def listen(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+            self.backend_pid = cursor.connection.info.backend_pid
+
+    def warm(self):
+        self.listen()
+        self.add_codes(
+            self.get_queryset().filter(
+                vehicle__latest_journey__datetime__gte=Now() - timedelta(days=1)
+            )
+        )
+
+    def add_codes(self, vehicle_codes):
+        for vehicle_code in vehicle_codes:
+            self.add(vehicle_code.code, vehicle_code.vehicle)
+
+    def add(self, identity, vehicle):
+        self.vehicles[identity] = vehicle
+        self.identities[vehicle.id].add(identity)
+
+    def discard(self, vehicle_id):
+        for identity in self.identities.pop(vehicle_id, ()):
+            self.vehicles.pop(identity, None)
+
+    def clear(self):
+        self.vehicles.clear()
+        self.identities.clear()
+
+    def refresh(self):
+        """forget vehicles that other processes have changed since last time"""
+        if self.backend_pid is None:
+            return
+
+        connection.ensure_connection()
+        if connection.connection.info.backend_pid != self.backend_pid:
+            # reconnected, so might have missed some notifications
+            self.clear()
+            self.listen()
+            return
+
+        for notify in connection.connection.notifies(timeout=0):
+            # (ignore our own changes - our Vehicle objects already reflect them)
+            if notify.pid != self.backend_pid:
+                self.changed.add(int(notify.payload))
+
+        for vehicle_id in self.changed:
+            self.discard(vehicle_id)
+        self.changed.clear()
+
+    def get_many(self, identities) -> dict:
+        self.refresh()
+
+        missing = [identity for identity in identities if identity not in self.vehicles]
+        if missing:
+            self.add_codes(self.get_queryset().filter(code__in=missing))
+
+        return {
+            identity: self.vehicles[identity]
+            for identity in identities
+            if identity in self.vehicles
+        }
+
+
+class ShardPool:
+    """Worker processes that each handle the items for a subset of vehicles
+    (decided by a hash of the vehicle identity, so a vehicle always goes to the same
+    worker, which keeps its own identifiers/journeys_ids state, database connection
+    and save() batch)
+    """
+
+    timeout = 300
+
+    def __init__(self, command, processes: int):
+        self.command = command
+        self.processes = processes
+        self.start()
+
+    def start(self):
+        context = multiprocessing.get_context("fork")
+        self.results = context.Queue()
+        self.queues = [context.Queue() for _ in range(self.processes)]
+
+        # each worker must open its own database connection
+        connections.close_all()
+
+        self.workers = [
+            context.Process(
+                target=self.command.work, args=(queue, self.results), daemon=True
+            )
+            for queue in self.queues
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def restart(self):
+        """replace all the workers (and queues, which might have stale items or results
+        in them) - the new workers will start with empty identifiers/journeys_ids,
+        so will treat every item as changed
+        """
+        for worker in self.workers:
+            worker.kill()
+            worker.join()
+        self.start()
+
+    def get_result(self, deadline):
+        """the next worker's result - or None if a worker has died,
+        or they've taken too long
+        """
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except Empty:
+                if monotonic() > deadline:
+                    logger.error("ShardPool workers took too long")
+                    return
+                if not all(worker.is_alive() for worker in self.workers):
+                    logger.error("ShardPool worker died")
+                    return
+
+    def get_shard(self, vehicle_identity) -> int:
+        return zlib.crc32(str(vehicle_identity).encode()) % len(self.queues)
+
+    def map(self, activities, source_datetime, timings) -> tuple[int, int]:
+        """handle some VehicleActivity items,
+        return the numbers of changed items and of total items
+        (and add the workers' timings to timings)
+        """
+        shards = [[] for _ in self.queues]
+        for activity in activities:
+            shards[self.get_shard(activity.vehicle_identity)].append(activity)
+
+        for queue, shard in zip(self.queues, shards):
+            queue.put((shard, source_datetime))
+
+        changed_items = total_items = 0
+        deadline = monotonic() + self.timeout
+        for _ in self.queues:
+            result = self.get_result(deadline)
+            if result is None:
+                # (those workers' items will be handled again next time)
+                self.restart()
+                return changed_items, total_items
+            changed, total, stages, operators = result
+            changed_items += changed
+            total_items += total
+            timings.merge(stages, operators)
+        return changed_items, total_items
+
+
 def same_journey(journey, last_journey, now):
     if journey.datetime == last_journey.datetime:
         return True
@@ -57,6 +425,62 @@ def same_journey(journey, last_journey, now):
     )
 
 
+class NotModified(Exception):
+    """the source's data hasn't changed since it was last fetched (HTTP 304)"""
+
+
+class PollSchedule:
+    """Works out how long to wait before polling a source again.
+
+    Normally that's `wait` seconds (minus the time the last update took),
+    but for sources that publish new data every `period` seconds, it learns
+    at which second within the period freshly published data is available
+    - from the age of the data fetched at each second - and waits until then.
+    And it backs off (up to 4 times `wait`) while the data isn't changing.
+    """
+
+    def __init__(self, wait, period=None):
+        self.wait = wait
+        self.period = period
+        self.ages = {}  # second within period: age of the data fetched then
+        self.age = None
+        self.unchanged = 0  # number of polls in a row with no changes
+        self.behind = False  # the last update took longer than the wait
+
+    def record(self, now, changed: bool, published_at=None):
+        if changed:
+            self.unchanged = 0
+        else:
+            self.unchanged += 1
+
+        self.age = None
+        if published_at and self.period:
+            self.age = int((now - published_at).total_seconds())
+            if self.age > 0:
+                self.ages[now.second % self.period] = self.age
+
+    def get_wait(self, time_taken: float) -> float:
+        self.behind = time_taken > self.wait
+        if self.behind:
+            return 0  # took longer than minimum wait
+
+        if self.unchanged > 1:
+            return min(self.wait * 1.5 ** (self.unchanged - 1), self.wait * 4)
+
+        if self.age is not None and self.age > 1:
+            freshest = min(self.ages, key=self.ages.get)
+            stalest = max(self.ages, key=self.ages.get)
+            # only if the stalest second is just before the freshest second
+            # (if the ages don't follow a clear pattern, the phase isn't known yet)
+            if (stalest - freshest) % self.period == self.period - 1:
+                wait = freshest - timezone.now().second % self.period
+                if wait <= 0:
+                    wait += self.period
+                return wait
+
+        return max(self.wait - time_taken, 0)
+
+
 class ImportLiveVehiclesCommand(BaseCommand):
     url = ""
     vehicles = Vehicle.objects.select_related("latest_journey__trip")
@@ -64,14 +488,30 @@ class ImportLiveVehiclesCommand(BaseCommand):
     history = True
     status = []
     status_key = None
+    vehicle_code_scheme = None
+    vehicle_index = None
+    pool = None
+    in_worker = False  # in a ShardPool worker process
+    scheduled = False  # run by run_live_vehicle_imports, rather than by itself
+    # fetch the next items while handling the current ones, if falling behind
+    # (only if get_items doesn't depend on the state of previous updates)
+    prefetch = True
+    # when replaying archived data, the time it was received
+    # (rather than the current time) - see replay_avl_archive
+    clock = None
 
     @staticmethod
     def add_arguments(parser):
         parser.add_argument("--immediate", action="store_true")
+        parser.add_argument(
+            "--workers", type=int, default=0, help="Handle items in parallel"
+        )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.session = requests.Session()
+        get_fetcher().mount(self.session)
+        self.next_items = None  # concurrent.futures.Future
         self.to_save = []
         self.journeys_to_create = {}
         self.journeys_to_update = []
@@ -79,20 +519,105 @@ class ImportLiveVehiclesCommand(BaseCommand):
         self.identifiers = {}
         self.journeys_ids = {}
         self.journeys_ids_ids = {}
+        self.timings = Timings()
+        self.schedule = PollSchedule(self.wait)
+        self.validators = {}  # url: (ETag, Last-Modified)
 
     @staticmethod
     def get_datetime(self):
         return
 
+    def get_now(self):
+        return self.clock or timezone.now()
+
+    def get_response(self, url, **kwargs):
+        """GET a URL - conditionally, if it's been fetched before and the response
+        had an ETag or Last-Modified header (raises NotModified if not modified)
+        """
+        headers = kwargs.pop("headers", {})
+        if url in self.validators:
+            etag, last_modified = self.validators[url]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = self.session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304:
+            raise NotModified
+        if response.ok:
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                self.validators[url] = (etag, last_modified)
+        return response
+
     @retry(
         wait=wait_exponential(multiplier=1, min=4, max=10),
         before_sleep=before_sleep_log(logger, logging.ERROR),
+        retry=retry_if_not_exception_type(NotModified),
     )
     def get_items(self):
-        response = self.session.get(self.url, timeout=20)
+        response = self.get_response(self.url, timeout=20)
         response.raise_for_status()
         return response.json()
 
+    def fetch_items(self):
+        with self.timings.stage("fetch"):
+            if self.next_items:
+                items = self.next_items.result()
+                self.next_items = None
+            else:
+                items = self.get_items()
+
+            if self.prefetch and self.schedule.behind:
+                # handling the items is taking longer than the wait between polls,
+                # so fetch the next lot meanwhile
+                self.next_items = get_fetcher().submit(
+                    self.url or self.source.url, self.get_items
+                )
+
+        return items or ()
+
+    @contextmanager
+    def item_errors(self):
+        """in a ShardPool worker, log and skip an item that can't be handled,
+        rather than losing the whole shard
+        """
+        if not self.in_worker:
+            yield
+            return
+        try:
+            yield
+        except Exception as e:
+            logger.exception(e)
+
+    def get_activity(self, item) -> VehicleActivity:
+        if type(item) is VehicleActivity:
+            return item
+        return VehicleActivity(
+            item,
+            self.get_vehicle_identity(item),
+            self.get_journey_identity(item),
+            self.get_item_identity(item),
+            **self.get_activity_fields(item),
+        )
+
+    def get_activity_fields(self, item) -> dict:
+        """parse an item into the keyword arguments for VehicleActivity
+        (datetime, longitude, latitude, etc)
+        """
+        return {"datetime": self.get_datetime(item)}
+
+    def create_vehicle_location(self, activity) -> VehicleLocation | None:
+        if activity.longitude is None or activity.latitude is None:
+            return
+        return VehicleLocation(
+            latlong=Point(activity.longitude, activity.latitude),
+            heading=activity.heading,
+            block=activity.block,
+        )
+
     @staticmethod
     def get_service(queryset, latlong):
         for filtered_queryset in (
@@ -123,7 +648,9 @@ class ImportLiveVehiclesCommand(BaseCommand):
         latest: dict | None = None,
         keep_journey=False,
     ):
-        if dt := self.get_datetime(item):
+        activity = self.get_activity(item)
+
+        if dt := activity.datetime:
             if dt.year == 1970:
                 dt = None
             elif now and now < dt:
@@ -136,7 +663,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
         location = None
         if vehicle is None:
             try:
-                vehicle, _ = self.get_vehicle(item)
+                vehicle, _ = self.get_vehicle(activity)
             except Vehicle.MultipleObjectsReturned as e:
                 logger.exception(e)
                 return
@@ -144,11 +671,13 @@ class ImportLiveVehiclesCommand(BaseCommand):
                 return
 
         latest_datetime = None
+        # replace the latest location even though this one isn't newer
+        force = False
 
         if latest is None:
             latest = redis_client.get(f"vehicle{vehicle.id}")
             if latest:
-                latest = json.loads(latest)
+                latest = decode_vehicle_location(latest)
         if latest:
             latest_datetime = datetime.fromisoformat(latest["datetime"])
             latest_latlong = Point(*latest["coordinates"])
@@ -162,14 +691,16 @@ class ImportLiveVehiclesCommand(BaseCommand):
                     and not vehicle.latest_journey.service_id
                 ):
                     return
+                force = True
             else:
-                location = self.create_vehicle_location(item)
+                location = self.create_vehicle_location(activity)
                 if not location or location.latlong.equals_exact(latest_latlong):
                     if dt:
                         # location hasn't changed
                         # - so assume the data is old
                         # – if the vehicle was really stationary the location would "drift" a bit
                         dt = latest_datetime
+                        force = True
                     else:
                         return
         # elif now and datetime and (now - datetime).total_seconds() > 600:
@@ -180,7 +711,11 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if keep_journey:
             journey = latest_journey
         else:
-            journey = self.get_journey(item, vehicle)
+            with (
+                self.timings.stage("journey match"),
+                self.timings.operator(vehicle.operator_id),
+            ):
+                journey = self.get_journey(activity, vehicle)
 
             if (
                 journey
@@ -211,7 +746,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
         #         return  # more than 15 minutes old
 
         if not location:
-            location = self.create_vehicle_location(item)
+            location = self.create_vehicle_location(activity)
             if not location:
                 return
 
@@ -269,14 +804,16 @@ class ImportLiveVehiclesCommand(BaseCommand):
                     journey.service.save(update_fields=["tracking"])
 
             vehicle.latest_journey = journey
-            if type(item) is dict:
-                vehicle.latest_journey_data = item
+            if type(activity.data) is dict:
+                vehicle.latest_journey_data = activity.data
             self.vehicles_to_update.append(vehicle)
 
         location.id = vehicle.id
         location.journey = journey
+        location.force = force
 
         self.to_save.append((location, vehicle))
+        self.timings.count(vehicle.operator_id)
 
         return location, vehicle
 
@@ -284,6 +821,15 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if not self.to_save:
             return
 
+        with self.timings.stage("database write"):
+            self.save_journeys()
+
+        with self.timings.stage("redis write"):
+            self.save_locations()
+
+        self.to_save = []
+
+    def save_journeys(self):
         update_fields = (
             "code",
             "service",
@@ -305,21 +851,36 @@ class ImportLiveVehiclesCommand(BaseCommand):
             for v in self.vehicles_to_update:
                 v.latest_journey = v.latest_journey
 
+            # (latest_journey_data is deferred for vehicles from the VehicleIndex,
+            # unless handle_item has just set it)
+            with_data = []
+            without_data = []
+            for v in self.vehicles_to_update:
+                if "latest_journey_data" in v.get_deferred_fields():
+                    without_data.append(v)
+                else:
+                    with_data.append(v)
+
             try:
                 Vehicle.objects.bulk_update(
-                    self.vehicles_to_update,
-                    ["latest_journey", "latest_journey_data"],
+                    with_data, ["latest_journey", "latest_journey_data"]
                 )
+                Vehicle.objects.bulk_update(without_data, ["latest_journey"])
             except IntegrityError as e:
                 logger.exception(e)
+                if self.vehicle_index:
+                    # in-memory vehicles might not match the database now
+                    self.vehicle_index.clear()
+
+            if self.vehicle_index:
+                # don't keep every vehicle's latest item in memory
+                for v in with_data:
+                    del v.__dict__["latest_journey_data"]
             self.vehicles_to_update = []
 
-        # update locations in Redis
-
-        pipeline = redis_client.pipeline(transaction=False)
-
-        geoadd = []
-        sadd = {}
+    def save_locations(self):
+        # (location, vehicle, names of the sets the vehicle should be in, redis json)
+        updates = []
 
         for location, vehicle in self.to_save:
             if not location.latlong or (
@@ -328,46 +889,156 @@ class ImportLiveVehiclesCommand(BaseCommand):
             ):
                 continue
 
-            # update live map
-
-            geoadd += [location.latlong.x, location.latlong.y, vehicle.id]
-
+            set_names = []
             if location.journey.service_id:
-                key = f"service{location.journey.service_id}vehicles"
-                if key in sadd:
-                    sadd[key].append(vehicle.id)
-                else:
-                    sadd[key] = [vehicle.id]
+                set_names.append(f"service{location.journey.service_id}vehicles")
             if vehicle.operator_id:
-                key = f"operator{vehicle.operator_id}vehicles"
-                if key in sadd:
-                    sadd[key].append(vehicle.id)
-                else:
-                    sadd[key] = [vehicle.id]
+                set_names.append(f"operator{vehicle.operator_id}vehicles")
             try:
                 if (
                     location.journey.trip
                     and location.journey.trip.operator_id
                     and location.journey.trip.operator_id != vehicle.operator_id
                 ):
-                    key = f"operator{location.journey.trip.operator_id}vehicles"
-                    if key in sadd:
-                        sadd[key].append(vehicle.id)
-                    else:
-                        sadd[key] = [vehicle.id]
+                    set_names.append(
+                        f"operator{location.journey.trip.operator_id}vehicles"
+                    )
             except Trip.DoesNotExist:
                 location.journey.trip = None
 
-            redis_json = location.get_redis_json()
-            redis_json = json.dumps(redis_json, cls=DjangoJSONEncoder)
+            updates.append((location, vehicle, set_names, location.get_redis_json()))
+
+        if settings.VEHICLE_LOCATION_PROGRESS:
+            with self.timings.stage("progress"):
+                self.add_progress(
+                    [
+                        redis_json
+                        for *_, redis_json in updates
+                        if "trip_id" in redis_json
+                    ]
+                )
+
+        try:
+            if settings.VEHICLE_LOCATION_SCRIPT:
+                self.upsert_locations(updates)
+            else:
+                self.pipeline_locations(updates)
+        except ConnectionError as e:
+            logger.exception(e)
+
+    @staticmethod
+    def add_progress(items):
+        """add progress along trips and delays to locations (see add_progress_and_delay)
+        - stop times are cached per trip, and loaded in bulk for any trips
+        not in the cache yet (see load_trip_geometries)
+        """
+        load_trip_geometries(items)
+        for item in items:
+            try:
+                add_progress_and_delay(item)
+            except ValueError as e:
+                logger.exception(e)
+
+    def upsert_locations(self, updates):
+        """update live locations atomically, ignoring any that are older than
+        what's already in Redis (e.g. from another process)
+        """
+        expiry = self.get_now().timestamp() + 900
+        args = [expiry]
+        moved = {}
+        for location, vehicle, set_names, redis_json in updates:
+            if self.history:
+                history_key, appendage = location.get_appendage()
+            else:
+                history_key = appendage = ""
+            moved[vehicle.id] = {**redis_json, "sets": set_names}
+            args += [
+                vehicle.id,
+                location.datetime.timestamp(),
+                encode_vehicle_location(redis_json),
+                location.latlong.x,
+                location.latlong.y,
+                " ".join(set_names),
+                history_key,
+                appendage,
+                "1" if getattr(location, "force", False) else "",
+            ]
+        if updates:
+            upsert = redis_client.register_script(upsert_vehicle_locations)
+            accepted = upsert(args=args)
+            if len(accepted) < len(updates):
+                logger.info(
+                    f"{len(updates) - len(accepted)} locations were out of date"
+                )
+            if accepted:
+                redis_client.publish(
+                    "vehicle_locations",
+                    self.get_delta([moved[int(vehicle_id)] for vehicle_id in accepted]),
+                )
+
+    @staticmethod
+    def get_delta(moved) -> str:
+        """message for subscribers to the vehicle_locations channel (see vehicles_stream)"""
+        return json.dumps({"moved": moved}, cls=DjangoJSONEncoder)
+
+    def pipeline_locations(self, updates):
+        pipeline = redis_client.pipeline(transaction=False)
+
+        geoadd = []
+        sadd = {}
+        vehicle_sets = {}  # vehicle id: names of the sets the vehicle should be in
+        moved = []
+
+        for location, vehicle, set_names, redis_json in updates:
+            # update live map
+
+            geoadd += [location.latlong.x, location.latlong.y, vehicle.id]
+
+            vehicle_sets[vehicle.id] = set_names
+            for key in set_names:
+                if key in sadd:
+                    sadd[key].append(vehicle.id)
+                else:
+                    sadd[key] = [vehicle.id]
+
+            moved.append({**redis_json, "sets": set_names})
+            redis_json = encode_vehicle_location(redis_json)
             pipeline.set(f"vehicle{vehicle.id}", redis_json, ex=900)
             # can't use 'mset' cos it doesn't let us specify an expiry (900 secs = 15 min)
 
         if geoadd:
             pipeline.geoadd("vehicle_location_locations", geoadd)
+            pipeline.incr("vehicle_locations_version")  # see vehicles_json_snapshot
+            pipeline.publish("vehicle_locations", self.get_delta(moved))
         for key in sadd:
             pipeline.sadd(key, *sadd[key])
 
+        if vehicle_sets:
+            # remove vehicles from sets they no longer belong in (e.g. if the service
+            # has changed), and note when they will expire (see sweep_vehicle_locations)
+            old_set_names = redis_client.hmget(
+                "vehicle_location_sets", list(vehicle_sets)
+            )
+            for (vehicle_id, set_names), old in zip(
+                vehicle_sets.items(), old_set_names
+            ):
+                if old:
+                    for key in set(old.decode().split()).difference(set_names):
+                        pipeline.srem(key, vehicle_id)
+
+            pipeline.hset(
+                "vehicle_location_sets",
+                mapping={
+                    vehicle_id: " ".join(set_names)
+                    for vehicle_id, set_names in vehicle_sets.items()
+                },
+            )
+            expiry = self.get_now().timestamp() + 900
+            pipeline.zadd(
+                "vehicle_location_expiry",
+                {vehicle_id: expiry for vehicle_id in vehicle_sets},
+            )
+
         if self.history:
             # add locations to journey history
 
@@ -375,12 +1046,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
                 if location.latlong:
                     pipeline.rpush(*location.get_appendage())
 
-        try:
-            pipeline.execute()
-        except ConnectionError as e:
-            logger.exception(e)
-
-        self.to_save = []
+        pipeline.execute()
 
     def do_source(self):
         if self.url:
@@ -393,66 +1059,82 @@ class ImportLiveVehiclesCommand(BaseCommand):
         return self
 
     def handle_items(self, items, identities):
-        with sentry_sdk.start_span(name="get vehicle codes"):
-            vehicle_codes = (
-                VehicleCode.objects.filter(
-                    code__in=identities, scheme=self.vehicle_code_scheme
+        with (
+            self.timings.stage("vehicle lookup"),
+            sentry_sdk.start_span(name="get vehicle codes"),
+        ):
+            if self.vehicle_index:
+                vehicles_by_identity = self.vehicle_index.get_many(identities)
+            else:
+                vehicle_codes = (
+                    VehicleCode.objects.filter(
+                        code__in=identities, scheme=self.vehicle_code_scheme
+                    )
+                    .select_related("vehicle__latest_journey__trip")
+                    .defer("vehicle__latest_journey_data", "vehicle__data")
                 )
-                .select_related("vehicle__latest_journey__trip")
-                .defer("vehicle__latest_journey_data", "vehicle__data")
-            )
 
-            vehicles_by_identity = {code.code: code.vehicle for code in vehicle_codes}
+                vehicles_by_identity = {
+                    code.code: code.vehicle for code in vehicle_codes
+                }
 
-        vehicle_locations = redis_client.mget(
-            [f"vehicle{vc.vehicle_id}" for vc in vehicle_codes]
-        )
-        vehicle_locations = {
-            vehicle_code.vehicle_id: json.loads(item)
-            for vehicle_code, item in zip(vehicle_codes, vehicle_locations)
-            if item
-        }
+            vehicle_ids = [vehicle.id for vehicle in vehicles_by_identity.values()]
+            vehicle_locations = redis_client.mget(
+                [f"vehicle{vehicle_id}" for vehicle_id in vehicle_ids]
+            )
+            vehicle_locations = {
+                vehicle_id: decode_vehicle_location(item)
+                for vehicle_id, item in zip(vehicle_ids, vehicle_locations)
+                if item
+            }
 
         i = 1
         for item, vehicle_identity in zip(items, identities):
-            journey_identity = self.journeys_ids[vehicle_identity]
+            with self.item_errors():
+                journey_identity = self.journeys_ids[vehicle_identity]
+                activity = self.get_activity(item)
+
+                if vehicle_identity in vehicles_by_identity:
+                    vehicle = vehicles_by_identity[vehicle_identity]
+                else:
+                    vehicle, created = self.get_vehicle(activity)
+                    # print(vehicle_identity, vehicle, created)
+                    if vehicle:
+                        VehicleCode.objects.create(
+                            code=vehicle_identity,
+                            scheme=self.vehicle_code_scheme,
+                            vehicle=vehicle,
+                        )
+                        if self.vehicle_index:
+                            self.vehicle_index.add(vehicle_identity, vehicle)
+
+                keep_journey = False
+                if vehicle_identity in self.journeys_ids_ids:
+                    journey_identity_id = self.journeys_ids_ids[vehicle_identity]
+                    if journey_identity_id == (
+                        journey_identity,
+                        vehicle.latest_journey_id,
+                    ):
+                        keep_journey = True  # can dumbly keep same latest_journey
 
-            if vehicle_identity in vehicles_by_identity:
-                vehicle = vehicles_by_identity[vehicle_identity]
-            else:
-                vehicle, created = self.get_vehicle(item)
-                # print(vehicle_identity, vehicle, created)
                 if vehicle:
-                    VehicleCode.objects.create(
-                        code=vehicle_identity,
-                        scheme=self.vehicle_code_scheme,
+                    result = self.handle_item(
+                        activity,
+                        self.source.datetime,
                         vehicle=vehicle,
+                        latest=vehicle_locations.get(vehicle.id, False),
+                        keep_journey=keep_journey,
                     )
 
-            keep_journey = False
-            if vehicle_identity in self.journeys_ids_ids:
-                journey_identity_id = self.journeys_ids_ids[vehicle_identity]
-                if journey_identity_id == (journey_identity, vehicle.latest_journey_id):
-                    keep_journey = True  # can dumbly keep same latest_journey
-
-            if vehicle:
-                result = self.handle_item(
-                    item,
-                    self.source.datetime,
-                    vehicle=vehicle,
-                    latest=vehicle_locations.get(vehicle.id, False),
-                    keep_journey=keep_journey,
-                )
-
-                if result:
-                    location, vehicle = result
+                    if result:
+                        location, vehicle = result
 
-                self.journeys_ids_ids[vehicle_identity] = (
-                    journey_identity,
-                    vehicle.latest_journey_id,
-                )
+                    self.journeys_ids_ids[vehicle_identity] = (
+                        journey_identity,
+                        vehicle.latest_journey_id,
+                    )
 
-            self.identifiers[vehicle_identity] = self.get_item_identity(item)
+                self.identifiers[vehicle_identity] = activity.item_identity
 
             if i % 500 == 0:
                 self.save()
@@ -461,6 +1143,10 @@ class ImportLiveVehiclesCommand(BaseCommand):
         self.save()
 
     def get_changed_items(self, items=None):
+        with self.timings.stage("diff"):
+            return self.diff_items(items)
+
+    def diff_items(self, items):
         changed_items = []
         changed_journey_items = []
         changed_item_identities = []
@@ -470,25 +1156,25 @@ class ImportLiveVehiclesCommand(BaseCommand):
 
         total_items = 0
 
-        for i, item in enumerate(items or self.get_items() or ()):
-            vehicle_identity = self.get_vehicle_identity(item)
-
-            journey_identity = self.get_journey_identity(item)
+        for item in items or self.fetch_items():
+            activity = self.get_activity(item)
+            vehicle_identity = activity.vehicle_identity
+            journey_identity = activity.journey_identity
 
             total_items += 1
 
-            if self.identifiers.get(vehicle_identity) == self.get_item_identity(item):
+            if self.identifiers.get(vehicle_identity) == activity.item_identity:
                 if journey_identity == self.journeys_ids[vehicle_identity]:
                     continue
-                print(self.journeys_ids[vehicle_identity], item)
+                print(self.journeys_ids[vehicle_identity], activity.data)
             if (
                 vehicle_identity not in self.journeys_ids
                 or journey_identity != self.journeys_ids[vehicle_identity]
             ):
-                changed_journey_items.append(item)
+                changed_journey_items.append(activity)
                 changed_journey_identities.append(vehicle_identity)
             else:
-                changed_items.append(item)
+                changed_items.append(activity)
                 changed_item_identities.append(vehicle_identity)
 
             self.journeys_ids[vehicle_identity] = journey_identity
@@ -501,37 +1187,82 @@ class ImportLiveVehiclesCommand(BaseCommand):
             total_items,
         )
 
+    def handle_changed_items(self, items=None) -> tuple[int, int]:
+        """work out which items have changed and handle them,
+        return the numbers of changed items and of total items
+        """
+        if self.pool:
+            with sentry_sdk.start_span(name="get items"):
+                activities = [
+                    self.get_activity(item) for item in items or self.fetch_items()
+                ]
+            with sentry_sdk.start_span(name="handle items in workers") as span:
+                span.set_data("count", len(activities))
+                return self.pool.map(activities, self.source.datetime, self.timings)
+
+        with sentry_sdk.start_span(name="get changed items"):
+            (
+                changed_items,
+                changed_journey_items,
+                changed_item_identities,
+                changed_journey_identities,
+                total_items,
+            ) = self.get_changed_items(items)
+
+        with sentry_sdk.start_span(name="handle quick items") as span:
+            span.set_data("count", len(changed_items))
+            self.handle_items(changed_items, changed_item_identities)
+        with sentry_sdk.start_span(name="handle changed journey items") as span:
+            span.set_data("count", len(changed_journey_items))
+            self.handle_items(changed_journey_items, changed_journey_identities)
+
+        return len(changed_items) + len(changed_journey_items), total_items
+
+    def work(self, queue, results):
+        """run in a ShardPool worker process"""
+        self.in_worker = True
+        # (forked from the parent, which might have a pool already, if restarting)
+        self.pool = None
+        while True:
+            activities, self.source.datetime = queue.get()
+            self.timings = Timings()
+            changed_items = 0
+            total_items = len(activities)
+            if activities:
+                try:
+                    changed_items, total_items = self.handle_changed_items(activities)
+                except Exception as e:
+                    logger.exception(e)
+                    self.to_save = []
+            results.put(
+                (
+                    changed_items,
+                    total_items,
+                    self.timings.get_stages(),
+                    self.timings.get_operators(limit=None),
+                )
+            )
+
     def update(self) -> int:
+        self.timings = Timings()
         with sentry_sdk.start_transaction(name=f"{self.source.name} update"):
             now = timezone.localtime()
             self.source.datetime = now
 
-            wait = self.wait
-
-            with sentry_sdk.start_span(name="get changed items"):
-                try:
-                    (
-                        changed_items,
-                        changed_journey_items,
-                        changed_item_identities,
-                        changed_journey_identities,
-                        total_items,
-                    ) = self.get_changed_items()
-                except requests.exceptions.RequestException as e:
-                    logger.exception(e)
-                    return 120
-
-            with sentry_sdk.start_span(name="handle quick items") as span:
-                span.set_data("count", len(changed_items))
-                self.handle_items(changed_items, changed_item_identities)
-            with sentry_sdk.start_span(name="handle changed journey items") as span:
-                span.set_data("count", len(changed_journey_items))
-                self.handle_items(changed_journey_items, changed_journey_identities)
+            try:
+                changed_items, total_items = self.handle_changed_items()
+            except NotModified:
+                self.schedule.record(now, False)
+                return self.schedule.get_wait((timezone.now() - now).total_seconds())
+            except requests.exceptions.RequestException as e:
+                logger.exception(e)
+                return 120
 
         if not total_items:
             return 120
 
         time_taken = (timezone.now() - now).total_seconds()
+        self.schedule.record(now, bool(changed_items))
 
         if self.source_name:
             self.status.append(
@@ -540,16 +1271,16 @@ class ImportLiveVehiclesCommand(BaseCommand):
                     None,
                     None,
                     total_items,
-                    len(changed_items) + len(changed_journey_items),
+                    changed_items,
                     time_taken,
+                    self.timings.get_stages(),
+                    self.timings.get_operators(),
                 )
             )
             self.status = self.status[-50:]
             cache.set(self.status_key, self.status, 800)
 
-        if time_taken < wait:
-            return wait - time_taken
-        return 0  # took longer than minimum wait
+        return self.schedule.get_wait(time_taken)
 
     def handle(self, immediate=False, *args, **options):
         if self.source_name:
@@ -559,6 +1290,13 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if not immediate:
             sleep(self.wait)
         self.do_source()
+        if self.vehicle_code_scheme:
+            self.vehicle_index = VehicleIndex(self.vehicle_code_scheme)
+            self.vehicle_index.warm()
+        if options.get("workers"):
+            self.pool = ShardPool(self, options["workers"])
+        if self.scheduled:
+            return  # run_live_vehicle_imports will call update()
         while True:
             wait = self.update()
             sleep(wait)
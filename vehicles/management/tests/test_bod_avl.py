@@ -1,9 +1,15 @@
+from concurrent.futures import Future
+from copy import copy
+from datetime import timedelta
+from importlib.util import find_spec
+from io import BytesIO
 from pathlib import Path
-from unittest import mock
+from unittest import mock, skipUnless
 
 import fakeredis
 import time_machine
 from django.test import TestCase, override_settings
+from django.utils import timezone
 from vcr import use_cassette
 
 from busstops.models import (
@@ -19,8 +25,20 @@ from busstops.models import (
 )
 from bustimes.models import Calendar, Garage, Route, StopTime, Trip
 
-from ...models import Livery, Vehicle, VehicleJourney
+from ...models import Livery, Vehicle, VehicleCode, VehicleJourney
+from ...tasks import sweep_vehicle_locations
+from ...utils import (
+    TimedLRUCache,
+    decode_vehicle_location,
+    encode_vehicle_location,
+)
 from ..commands import import_bod_avl
+from ..import_live_vehicles import (
+    NotModified,
+    PollSchedule,
+    VehicleActivity,
+    VehicleIndex,
+)
 
 
 def patch_redis_client(redis_client=None):
@@ -158,6 +176,11 @@ class BusOpenDataVehicleLocationsTest(TestCase):
 
             response = self.client.get("/status")
 
+            status = self.client.get("/status.json").json()["bod_avl_status"]
+            self.assertEqual(status[0]["total_items"], 841)
+            self.assertIn("parse", status[0]["stages"])
+            self.assertIn("journey match", status[0]["stages"])
+
         self.assertContains(
             response,
             """
@@ -569,6 +592,109 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 ],
             )
 
+    # (fakeredis can only run Lua scripts with lupa installed)
+    @skipUnless(find_spec("lupa"), "lupa not installed")
+    def test_unmoved_vehicle_new_journey(self):
+        # a vehicle that hasn't moved, but has started a new journey -
+        # the pipeline and the script should both replace the latest location
+        results = []
+        for script, vehicle_ref in ((False, "BB62_BUS"), (True, "BB63_BUS")):
+            command = import_bod_avl.Command()
+            command.source = self.source
+            with (
+                self.subTest(script=script),
+                override_settings(VEHICLE_LOCATION_SCRIPT=script),
+                patch_redis_client() as redis_client,
+            ):
+                for recorded_at_time, line_ref in (
+                    ("2020-11-28T12:58:25+00:00", "146"),
+                    ("2020-11-28T13:08:25+00:00", "U"),
+                ):
+                    with time_machine.travel(recorded_at_time, tick=False):
+                        command.source.datetime = timezone.now()
+                        command.handle_item(
+                            {
+                                "RecordedAtTime": recorded_at_time,
+                                "MonitoredVehicleJourney": {
+                                    "LineRef": line_ref,
+                                    "VehicleRef": vehicle_ref,
+                                    "OperatorRef": "WHIP",
+                                    "VehicleLocation": {
+                                        "Latitude": "52.62269",
+                                        "Longitude": "1.296443",
+                                    },
+                                    "VehicleJourneyRef": f"{line_ref}_1",
+                                },
+                            },
+                            command.source.datetime,
+                        )
+                        command.save()
+
+                vehicle = Vehicle.objects.get(code=vehicle_ref)
+                location = decode_vehicle_location(
+                    redis_client.get(f"vehicle{vehicle.id}")
+                )
+                self.assertEqual(location["journey_id"], vehicle.latest_journey_id)
+                self.assertEqual(location["service"]["line_name"], "U")
+                self.assertEqual(
+                    location.get("service_id"), vehicle.latest_journey.service_id
+                )
+                del location["id"], location["journey_id"]
+                results.append(
+                    (location, redis_client.hget("vehicle_location_sets", vehicle.id))
+                )
+
+        self.assertEqual(results[0], results[1])
+
+    def test_sweep_vehicle_locations(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+
+        with (
+            time_machine.travel("2020-11-28T12:58:25+00:00", tick=False),
+            patch_redis_client() as redis_client,
+        ):
+            command.handle_item(
+                {
+                    "RecordedAtTime": "2020-11-28T12:58:25+00:00",
+                    "MonitoredVehicleJourney": {
+                        "LineRef": "146",
+                        "VehicleRef": "BB62_BUS",
+                        "OperatorRef": "BDRB",
+                        "VehicleLocation": {
+                            "Latitude": "52.62269",
+                            "Longitude": "1.296443",
+                        },
+                        "VehicleJourneyRef": "146_20201128_12_58",
+                    },
+                }
+            )
+            command.save()
+
+        vehicle = Vehicle.objects.get()
+        set_names = redis_client.hget("vehicle_location_sets", vehicle.id)
+        self.assertEqual(redis_client.zcard("vehicle_location_locations"), 1)
+        self.assertEqual(redis_client.zcard("vehicle_location_expiry"), 1)
+
+        # an expired vehicle added before vehicle_location_expiry existed
+        redis_client.geoadd("vehicle_location_locations", [1.3, 52.6, 0])
+
+        with mock.patch("vehicles.tasks.redis_client", redis_client):
+            with time_machine.travel("2020-11-28T13:10:00+00:00", tick=False):
+                sweep_vehicle_locations.call_local()  # not expired yet
+            self.assertEqual(
+                redis_client.zrange("vehicle_location_locations", 0, -1),
+                [str(vehicle.id).encode()],
+            )
+
+            with time_machine.travel("2020-11-28T13:15:00+00:00", tick=False):
+                sweep_vehicle_locations.call_local()
+        self.assertEqual(redis_client.zcard("vehicle_location_locations"), 0)
+        self.assertEqual(redis_client.zcard("vehicle_location_expiry"), 0)
+        self.assertFalse(redis_client.hlen("vehicle_location_sets"))
+        for set_name in set_names.decode().split():
+            self.assertFalse(redis_client.sismember(set_name, vehicle.id))
+
     def test_handle_item_2(self):
         command = import_bod_avl.Command()
         command.source = self.source
@@ -601,22 +727,26 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 "VehicleJourneyRef": "m1_20211010_10_58",
             },
         }
-        vehicle, created = command.get_vehicle(item)
+        activity = command.get_activity(item)
+        self.assertEqual(activity.line_ref, "m1")
+        self.assertEqual(activity.journey_ref, "m1_20211010_10_58")
+        self.assertEqual(activity.block, "65559")
+        vehicle, created = command.get_vehicle(activity)
         self.assertFalse(created)
         self.assertEqual(vehicle.name, "Jeff")
 
-        journey = command.get_journey(item, vehicle)
+        journey = command.get_journey(activity, vehicle)
         self.assertEqual("m1_20211010_10_58", journey.code)
         self.assertEqual("outbound", journey.direction)
 
         item["MonitoredVehicleJourney"]["VehicleRef"] = "11111"
-        vehicle, created = command.get_vehicle(item)
+        vehicle, created = command.get_vehicle(command.get_activity(item))
         self.assertFalse(created)
         self.assertEqual(vehicle.code, "11111")
         # self.assertEqual(vehicle.fleet_code, "2929")
 
         item["MonitoredVehicleJourney"]["VehicleRef"] = "FBRI-502_-_DK09_DZH"
-        vehicle, created = command.get_vehicle(item)
+        vehicle, created = command.get_vehicle(command.get_activity(item))
         self.assertTrue(created)
 
         self.assertEqual("DK09DZH", vehicle.reg)
@@ -1114,6 +1244,231 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             items = command.get_items()
             self.assertEqual(items, [])
 
+    def test_parse_items(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+        command.source.datetime = None
+
+        xml = b"""<Siri xmlns="http://www.siri.org.uk/siri"><ServiceDelivery>
+<ResponseTimestamp>2020-10-17T08:34:09+00:00</ResponseTimestamp>
+<VehicleMonitoringDelivery>
+<VehicleActivity><RecordedAtTime>2020-10-17T08:34:00+00:00</RecordedAtTime>
+<MonitoredVehicleJourney><LineRef>U</LineRef>
+<FramedVehicleJourneyRef><DataFrameRef>2020-10-17</DataFrameRef>
+<DatedVehicleJourneyRef>1</DatedVehicleJourneyRef></FramedVehicleJourneyRef>
+<OperatorRef>WHIP</OperatorRef><VehicleRef>1</VehicleRef></MonitoredVehicleJourney>
+<Extensions><VehicleJourney><VehicleUniqueId>X</VehicleUniqueId></VehicleJourney>
+</Extensions></VehicleActivity>
+</VehicleMonitoringDelivery></ServiceDelivery></Siri>"""
+
+        with mock.patch.object(
+            command, "get_items", lambda: command.parse_items(BytesIO(xml))
+        ):
+            changed = command.get_changed_items()
+            self.assertEqual(len(changed[1]), 1)
+            self.assertEqual(changed[2:], ([], ["WHIP:1:X"], 1))
+            self.assertEqual(
+                changed[1][0].data["MonitoredVehicleJourney"][
+                    "FramedVehicleJourneyRef"
+                ],
+                {"DataFrameRef": "2020-10-17", "DatedVehicleJourneyRef": "1"},
+            )
+            command.identifiers["WHIP:1:X"] = "2020-10-17T08:34:00+00:00"
+
+            self.assertEqual(
+                changed[1][0].journey_identity,
+                command.get_journey_identity(changed[1][0].data),
+            )
+
+            # unchanged - counted but not converted to a dict
+            command.source.datetime = None
+            self.assertEqual(command.get_changed_items(), ([], [], [], [], 1))
+            self.assertEqual(command.unchanged_items, 1)
+
+    def test_timed_lru_cache(self):
+        lru = TimedLRUCache(maxsize=2, ttl=60)
+        lru["a"] = None
+        lru["b"] = 1
+        self.assertIsNone(lru["a"])  # "a" is now the most recently used
+        lru["c"] = 2
+        self.assertEqual(len(lru), 2)
+        with self.assertRaises(KeyError):
+            lru["b"]
+
+        lru.ttl = -1
+        lru["d"] = 3
+        with self.assertRaises(KeyError):
+            lru["d"]
+
+    @time_machine.travel("2024-03-15T09:00:04Z", tick=False)
+    def test_poll_schedule(self):
+        schedule = PollSchedule(11, period=10)
+        now = timezone.now()
+        # data is freshest at 7 seconds past, stalest at 6 seconds past
+        for second in range(10):
+            now = now.replace(second=second)
+            schedule.record(now, True, now - timedelta(seconds=(second - 7) % 10 + 2))
+        self.assertEqual(schedule.get_wait(0.5), 3)  # now is 4 seconds past
+        self.assertEqual(schedule.get_wait(12), 0)
+
+        # back off while there's no new data
+        schedule = PollSchedule(10)
+        schedule.record(now, False)
+        self.assertEqual(schedule.get_wait(1), 9)
+        schedule.record(now, False)
+        self.assertEqual(schedule.get_wait(1), 15)
+        for _ in range(5):
+            schedule.record(now, False)
+        self.assertEqual(schedule.get_wait(1), 40)
+        schedule.record(now, True)
+        self.assertEqual(schedule.get_wait(1), 9)
+
+    def test_conditional_get(self):
+        command = import_bod_avl.Command()
+        ok = mock.Mock(status_code=200, ok=True, headers={"ETag": '"abc"'})
+        not_modified = mock.Mock(status_code=304, ok=False, headers={})
+        with mock.patch.object(
+            command.session, "get", side_effect=[ok, not_modified]
+        ) as get:
+            self.assertIs(command.get_response("https://example.com"), ok)
+            with self.assertRaises(NotModified):
+                command.get_response("https://example.com")
+        self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"abc"'})
+
+    def test_shard_pool_worker(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+        command.pool = mock.Mock()  # as when a ShardPool restarts its workers
+
+        class Stop(Exception):
+            pass
+
+        activity = VehicleActivity({}, "FBRI:2929", "journey", "item")
+        queue = mock.Mock(
+            get=mock.Mock(side_effect=[([activity], timezone.now()), Stop])
+        )
+        results = mock.Mock()
+        with (
+            mock.patch.object(command, "handle_items") as handle_items,
+            self.assertRaises(Stop),
+        ):
+            command.work(queue, results)
+
+        # handled in the worker, rather than passed to the pool again
+        self.assertIsNone(command.pool)
+        handle_items.assert_called_with([activity], ["FBRI:2929"])
+        self.assertEqual(results.put.call_args[0][0][:2], (1, 1))
+
+    def test_match_trip_later(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+        vehicle = Vehicle.objects.create(code="BB64_BUS", operator_id="WHIP")
+        journey = VehicleJourney.objects.create(
+            vehicle=vehicle, datetime=timezone.now(), source=self.source, route_name="U"
+        )
+
+        def match_trip(journey, vehicle, **trip_kwargs):
+            journey.trip = self.trip
+            journey.destination = "Great Yarmouth"
+            return self.trip
+
+        key = f"vehicle{vehicle.id}"
+        location = {
+            "id": vehicle.id,
+            "journey_id": journey.id,
+            "coordinates": [1.0, 52.0],
+            "datetime": timezone.now(),
+        }
+        redis_client = fakeredis.FakeStrictRedis(version=7)
+        redis_client.set(key, encode_vehicle_location(location), ex=900)
+
+        def decode(value):
+            # meanwhile, the main thread saves a newer location
+            if not decode.called:
+                decode.called = True
+                redis_client.set(
+                    key,
+                    encode_vehicle_location({**location, "coordinates": [1.5, 52.5]}),
+                    keepttl=True,
+                )
+            return decode_vehicle_location(value)
+
+        decode.called = False
+
+        with (
+            patch_redis_client(redis_client),
+            mock.patch(
+                "vehicles.management.commands.import_bod_avl.redis_client",
+                redis_client,
+            ),
+            mock.patch(
+                "vehicles.management.commands.import_bod_avl.decode_vehicle_location",
+                decode,
+            ),
+            mock.patch.object(command, "match_trip", match_trip),
+        ):
+            result = command.match_trip_later(copy(journey), copy(vehicle), {})
+
+        # only the trip and destination of the newer location were updated
+        location = decode_vehicle_location(redis_client.get(key))
+        self.assertEqual(location["coordinates"], [1.5, 52.5])
+        self.assertEqual(location["trip_id"], self.trip.id)
+        self.assertEqual(location["destination"], "Great Yarmouth")
+        self.assertGreater(redis_client.ttl(key), 0)
+
+        self.assertEqual(
+            VehicleJourney.objects.get(id=journey.id).trip_id, self.trip.id
+        )
+        self.assertEqual(
+            Vehicle.objects.get(id=vehicle.id).garage_id, self.trip.garage_id
+        )
+
+        # the main thread's objects weren't touched by the thread
+        self.assertIsNone(journey.trip_id)
+        self.assertFalse(journey.destination)
+        self.assertIsNone(vehicle.garage_id)
+
+        future = Future()
+        future.set_result(result)
+        command.matched_trips = [(journey, future)]
+        command.apply_matched_trips()
+        self.assertEqual(journey.trip, self.trip)
+        self.assertEqual(journey.destination, "Great Yarmouth")
+        self.assertEqual(command.matched_trips, [])
+
+    def test_vehicle_index(self):
+        vehicle = Vehicle.objects.get(code="2929")
+        VehicleCode.objects.create(code="FBRI:2929", scheme="BODS", vehicle=vehicle)
+
+        index = VehicleIndex("BODS")
+        index.listen()
+
+        with self.assertNumQueries(1):
+            vehicles = index.get_many(["FBRI:2929", "FBRI:404"])
+        self.assertEqual(vehicles, {"FBRI:2929": vehicle})
+        self.assertEqual(vehicles["FBRI:2929"].name, "Jeff")
+
+        with self.assertNumQueries(1):  # only look up the missing one again
+            self.assertEqual(index.get_many(["FBRI:2929", "FBRI:404"]), vehicles)
+
+        with self.assertNumQueries(0):
+            index.get_many(["FBRI:2929"])
+
+        # e.g. notified of a change by another process
+        index.changed.add(vehicle.id)
+        with self.assertNumQueries(1):
+            vehicle = index.get_many(["FBRI:2929"])["FBRI:2929"]
+
+        # latest_journey_data is saved but not kept in memory
+        command = import_bod_avl.Command()
+        command.vehicle_index = index
+        vehicle.latest_journey_data = {"VehicleRef": "2929"}
+        command.vehicles_to_update.append(vehicle)
+        command.save_journeys()
+        self.assertIn("latest_journey_data", vehicle.get_deferred_fields())
+        vehicle.refresh_from_db()
+        self.assertEqual(vehicle.latest_journey_data, {"VehicleRef": "2929"})
+
     def test_tfw_bods_coexistence(self):
         tfw = DataSource.objects.create(name="Transport for Wales")
         bods = self.source
@@ -1,16 +1,23 @@
+import json
+import tempfile
 from datetime import datetime, timezone
+from io import StringIO
 from pathlib import Path
 from unittest import mock
 
 import fakeredis
 import time_machine
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import TestCase, override_settings
 from vcr import use_cassette
 
 from busstops.models import DataSource
 
+from ... import avl_archive
 from ...models import SiriSubscription, Vehicle
+from ...tasks import get_bod_avl_command, handle_posts, handle_siri_post
+from ..commands.consume_siri_posts import Consumer
 
 
 class SiriPostTest(TestCase):
@@ -65,9 +72,15 @@ class SiriPostTest(TestCase):
         self.assertEqual(404, response.status_code)
 
     def test_siri_post_heartbeat(self):
-        response = self.client.post(
-            "/siri/475d1d1f-5708-4ee1-8f51-c63d948bc0b9",
-            data="""<?xml version="1.0" encoding="UTF-8" ?>
+        redis_client = fakeredis.FakeStrictRedis(version=7)
+
+        with (
+            mock.patch("vehicles.views.redis_client", redis_client),
+            mock.patch("vehicles.tasks.redis_client", redis_client),
+        ):
+            response = self.client.post(
+                "/siri/475d1d1f-5708-4ee1-8f51-c63d948bc0b9",
+                data="""<?xml version="1.0" encoding="UTF-8" ?>
 <Siri xmlns="http://www.siri.org.uk/siri" version="1.3"
     xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
     xsi:schemaLocation="http://www.siri.org.uk/siri http://www.siri.org.uk/schema/1.3/siri.xsd">
@@ -78,9 +91,43 @@ class SiriPostTest(TestCase):
         <ServiceStartedTime>2023-11-29T09:43:26+00:00</ServiceStartedTime>
     </HeartbeatNotification>
 </Siri>""",
-            content_type="text/xml",
-        )
-        self.assertEqual(200, response.status_code)
+                content_type="text/xml",
+            )
+            self.assertEqual(200, response.status_code)
+
+    def test_siri_post_dropped(self):
+        redis_client = fakeredis.FakeStrictRedis(version=7)
+        subscription = SiriSubscription.objects.get()
+
+        with (
+            mock.patch("vehicles.views.redis_client", redis_client),
+            mock.patch("vehicles.tasks.redis_client", redis_client),
+            override_settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+                    }
+                },
+                SIRI_POST_CONSUMER=True,
+            ),
+            time_machine.travel("2024-03-15T06:00:00Z", tick=False) as traveller,
+        ):
+            for _ in range(3):
+                self.client.post(
+                    subscription.get_absolute_url(),
+                    data="<Siri><HeartbeatNotification/></Siri>",
+                    content_type="text/xml",
+                )
+                traveller.shift(200)
+
+            # only posts from the last SIRI_POST_STREAM_AGE seconds are kept
+            messages = redis_client.xrange(subscription.get_posts_key())
+            self.assertEqual(len(messages), 2)
+
+            with self.assertLogs("vehicles.tasks", "WARNING"):
+                handle_siri_post(subscription.uuid, "1710482400000-0")
+                handle_siri_post(subscription.uuid, "1710482400000-0")
+            self.assertEqual(cache.get(subscription.get_dropped_key()), 2)
 
     @time_machine.travel("2023-12-15T08:24:05Z")
     def test_siri_post_data(self):
@@ -125,6 +172,8 @@ class SiriPostTest(TestCase):
             mock.patch(
                 "vehicles.management.import_live_vehicles.redis_client", redis_client
             ),
+            mock.patch("vehicles.views.redis_client", redis_client),
+            mock.patch("vehicles.tasks.redis_client", redis_client),
             override_settings(
                 CACHES={
                     "default": {
@@ -145,6 +194,37 @@ class SiriPostTest(TestCase):
             response = self.client.get("/siri/475d1d1f-5708-4ee1-8f51-c63d948bc0b9")
             self.assertEqual(response.headers["Content-Type"], "text/xml")
 
+            # the same again, but handled by the consume_siri_posts command
+            subscription = SiriSubscription.objects.get()
+            with (
+                mock.patch(
+                    "vehicles.management.commands.consume_siri_posts.redis_client",
+                    redis_client,
+                ),
+                override_settings(SIRI_POST_CONSUMER=True),
+            ):
+                consumer = Consumer(subscription)
+                self.client.post(
+                    "/siri/475d1d1f-5708-4ee1-8f51-c63d948bc0b9",
+                    data=data,
+                    content_type="text/xml",
+                )
+                [(_, messages)] = redis_client.xread({consumer.key: consumer.last_id})
+                self.assertEqual(len(messages), 1)
+                consumer.handle(messages)
+                consumer.checkpoint()
+                self.assertEqual(redis_client.xlen(consumer.key), 1)  # trimmed
+
+                # restarted
+                get_bod_avl_command.cache_clear()
+                restarted = Consumer(subscription)
+            self.assertIsNot(restarted.command, consumer.command)
+            self.assertEqual(restarted.last_id, messages[0][0])
+            self.assertEqual(
+                restarted.command.identifiers,
+                {"NADT:NADT-MB181": "2024-03-15T06:09:42+00:00"},
+            )
+
         vehicle = Vehicle.objects.get()
         self.assertEqual(str(vehicle), "MB181")
 
@@ -156,6 +236,8 @@ class SiriPostTest(TestCase):
             mock.patch(
                 "vehicles.management.import_live_vehicles.redis_client", redis_client
             ),
+            mock.patch("vehicles.views.redis_client", redis_client),
+            mock.patch("vehicles.tasks.redis_client", redis_client),
             override_settings(
                 CACHES={
                     "default": {
@@ -190,3 +272,144 @@ class SiriPostTest(TestCase):
 
         vehicle = Vehicle.objects.get()
         self.assertEqual(str(vehicle), "MB182")
+
+    def test_replay_avl_archive(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        source = DataSource.objects.get(name="Transport for Wales")
+
+        with override_settings(AVL_ARCHIVE_DIR=Path(temp_dir.name)):
+            avl_archive.append(
+                source.id,
+                json.dumps(
+                    {
+                        "locations": [
+                            {
+                                "type": "Feature",
+                                "geometry": {
+                                    "type": "Point",
+                                    "coordinates": [-48.3, 52.3],
+                                },
+                                "properties": {
+                                    "timestamp": "2023-12-15T08:24:05Z",
+                                    "device_id": "NADT:MB182:34:1982",
+                                },
+                            }
+                        ]
+                    }
+                ).encode(),
+                "2023-12-15_082405.json",
+                datetime(2023, 12, 15, 8, 24, 5, tzinfo=timezone.utc),
+            )
+
+            stdout = StringIO()
+            redis_client = fakeredis.FakeStrictRedis(version=7)
+            with (
+                mock.patch(
+                    "vehicles.management.commands.replay_avl_archive.redis_client",
+                    redis_client,
+                ),
+                mock.patch(
+                    "vehicles.management.import_live_vehicles.redis_client",
+                    redis_client,
+                ),
+                mock.patch(
+                    "vehicles.management.commands.import_bod_avl.redis_client",
+                    redis_client,
+                ),
+            ):
+                call_command("replay_avl_archive", "Transport for Wales", stdout=stdout)
+
+        self.assertIn("2023-12-15_082405.json: 1 changed items", stdout.getvalue())
+        self.assertIn("1 cycles in ", stdout.getvalue())
+
+        vehicle = Vehicle.objects.get()
+        self.assertEqual(str(vehicle), "MB182")
+
+    def test_replay_avl_archive_clock(self):
+        """replaying an old post leaves Redis as handling it live did"""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        subscription = SiriSubscription.objects.get()
+
+        def get_state(redis_client):
+            return {
+                key: redis_client.zrange(key, 0, -1, withscores=True)
+                for key in (
+                    "vehicle_location_locations",
+                    "vehicle_location_timestamps",
+                    "vehicle_location_expiry",
+                )
+            } | {
+                key: redis_client.get(key) for key in redis_client.keys("vehicle[0-9]*")
+            }
+
+        live_redis_client = fakeredis.FakeStrictRedis(version=7)
+        replay_redis_client = fakeredis.FakeStrictRedis(version=7)
+
+        with override_settings(AVL_ARCHIVE_DIR=Path(temp_dir.name)):
+            # received a while after the location was recorded
+            with (
+                time_machine.travel("2023-12-15T08:24:35Z", tick=False),
+                mock.patch(
+                    "vehicles.management.import_live_vehicles.redis_client",
+                    live_redis_client,
+                ),
+                mock.patch(
+                    "vehicles.management.commands.import_bod_avl.redis_client",
+                    live_redis_client,
+                ),
+            ):
+                handle_posts(
+                    subscription,
+                    [
+                        (
+                            None,
+                            {
+                                b"content-type": b"application/json",
+                                b"body": json.dumps(
+                                    {
+                                        "locations": [
+                                            {
+                                                "type": "Feature",
+                                                "geometry": {
+                                                    "type": "Point",
+                                                    "coordinates": [-48.3, 52.3],
+                                                },
+                                                "properties": {
+                                                    "timestamp": "2023-12-15T08:24:05Z",
+                                                    "device_id": "NADT:MB182:34:1982",
+                                                },
+                                            }
+                                        ]
+                                    }
+                                ).encode(),
+                            },
+                        )
+                    ],
+                )
+                live_state = get_state(live_redis_client)
+
+            with (
+                mock.patch(
+                    "vehicles.management.commands.replay_avl_archive.redis_client",
+                    replay_redis_client,
+                ),
+                mock.patch(
+                    "vehicles.management.import_live_vehicles.redis_client",
+                    replay_redis_client,
+                ),
+                mock.patch(
+                    "vehicles.management.commands.import_bod_avl.redis_client",
+                    replay_redis_client,
+                ),
+            ):
+                call_command(
+                    "replay_avl_archive", "Transport for Wales", stdout=StringIO()
+                )
+
+        self.assertEqual(
+            live_state["vehicle_location_expiry"][0][1],
+            datetime(2023, 12, 15, 8, 39, 35, tzinfo=timezone.utc).timestamp(),
+        )
+        self.assertEqual(get_state(replay_redis_client), live_state)
@@ -61,3 +61,21 @@ class StagecoachTest(TestCase):
             },
         )
         self.assertEqual(VehicleJourney.objects.count(), 8)
+
+    def test_prefetch(self):
+        command = Command()
+        command.do_source()
+
+        with patch.object(command, "get_items", side_effect=[[1], [2], [3]]) as get:
+            self.assertEqual(command.fetch_items(), [1])
+            self.assertIsNone(command.next_items)
+
+            # the last update took too long, so fetch the next items in the background
+            command.schedule.get_wait(60)
+            self.assertEqual(command.fetch_items(), [2])
+            self.assertEqual(command.next_items.result(), [3])
+
+            command.schedule.get_wait(1)  # caught up
+            self.assertEqual(command.fetch_items(), [3])
+            self.assertIsNone(command.next_items)
+        self.assertEqual(get.call_count, 3)
@@ -0,0 +1,67 @@
+# tell long-running live vehicle importers (see VehicleIndex) about vehicles
+# changed by other processes - only if something they rely on has changed
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vehicles', '0020_vehiclecode_unique_vehicle_code'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """CREATE OR REPLACE FUNCTION notify_vehicle_changed()
+            RETURNS trigger AS $$
+            BEGIN
+            IF TG_TABLE_NAME = 'vehicles_vehicle' THEN
+            PERFORM pg_notify('vehicle_changed', OLD.id::text);
+            ELSE
+            PERFORM pg_notify('vehicle_changed', OLD.vehicle_id::text);
+            END IF;
+            RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            -- previously created at runtime by the importers
+            DROP TRIGGER IF EXISTS notify_vehicle_changed ON vehicles_vehicle;
+            DROP TRIGGER IF EXISTS notify_vehicle_changed ON vehicles_vehiclecode;
+
+            CREATE TRIGGER notify_vehicle_deleted
+            AFTER DELETE ON vehicles_vehicle
+            FOR EACH ROW
+            EXECUTE PROCEDURE notify_vehicle_changed();
+
+            CREATE TRIGGER notify_vehicle_changed
+            AFTER UPDATE ON vehicles_vehicle
+            FOR EACH ROW
+            WHEN (
+                OLD.code IS DISTINCT FROM NEW.code
+                OR OLD.operator_id IS DISTINCT FROM NEW.operator_id
+                OR OLD.latest_journey_id IS DISTINCT FROM NEW.latest_journey_id
+                OR OLD.garage_id IS DISTINCT FROM NEW.garage_id
+            )
+            EXECUTE PROCEDURE notify_vehicle_changed();
+
+            CREATE TRIGGER notify_vehicle_code_deleted
+            AFTER DELETE ON vehicles_vehiclecode
+            FOR EACH ROW
+            EXECUTE PROCEDURE notify_vehicle_changed();
+
+            CREATE TRIGGER notify_vehicle_code_changed
+            AFTER UPDATE ON vehicles_vehiclecode
+            FOR EACH ROW
+            WHEN (
+                OLD.code IS DISTINCT FROM NEW.code
+                OR OLD.scheme IS DISTINCT FROM NEW.scheme
+                OR OLD.vehicle_id IS DISTINCT FROM NEW.vehicle_id
+            )
+            EXECUTE PROCEDURE notify_vehicle_changed();""",
+            """DROP TRIGGER notify_vehicle_deleted ON vehicles_vehicle;
+            DROP TRIGGER notify_vehicle_changed ON vehicles_vehicle;
+            DROP TRIGGER notify_vehicle_code_deleted ON vehicles_vehiclecode;
+            DROP TRIGGER notify_vehicle_code_changed ON vehicles_vehiclecode;
+            DROP FUNCTION notify_vehicle_changed();""",
+        ),
+    ]
@@ -849,5 +849,13 @@ class SiriSubscription(models.Model):
     def get_status_key(self):
         return f"{self.name.replace(' ', '_')}_status"
 
+    def get_posts_key(self):
+        """Redis stream of recent posts"""
+        return f"{self.name.replace(' ', '_')}_posts"
+
+    def get_dropped_key(self):
+        """count of posts trimmed from the stream before they were handled"""
+        return f"{self.name.replace(' ', '_')}_dropped"
+
     def get_absolute_url(self):
         return reverse("siri_post", args=(self.uuid,))
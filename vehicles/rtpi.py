@@ -1,14 +1,20 @@
 # "Real Time Passenger Information"-ish stuff - calculating delays etc
 
+import weakref
 from datetime import datetime, timedelta
 from itertools import pairwise
+
+import numpy as np
+from django.conf import settings
 from django.contrib.gis.geos import LineString, Point
-from django.contrib.gis.db.models.functions import Distance, LineLocatePoint
+from django.core.cache import cache
 from django.utils import timezone
 
 from bustimes.models import RouteLink, StopTime, Trip
 from bustimes.utils import contiguous_stoptimes_only
-from vehicles.utils import calculate_bearing
+from vehicles.utils import TimedLRUCache, calculate_bearing
+
+EARTH_RADIUS = 6378137  # metres, as used by EPSG:3857
 
 
 def get_route_bearing(geometry: LineString, progress: float):
@@ -21,7 +27,12 @@ def get_route_bearing(geometry: LineString, progress: float):
 
 def get_stop_times(item):
     trip = Trip.objects.select_related("calendar").get(pk=item["trip_id"])
-    trips = trip.get_trips()
+    return get_trip_stop_times(trip)
+
+
+def get_trip_stop_times(trip, trips=None):
+    if trips is None:
+        trips = trip.get_trips()
 
     stop_times = (
         StopTime.objects.filter(trip__in=trips)
@@ -37,6 +48,280 @@ def get_stop_times(item):
     return stop_times
 
 
+class TripCache(TimedLRUCache):
+    """TimedLRUCache of things derived from trips' stop times,
+    cleared when timetables are imported (checked at most once a minute)
+    """
+
+    services_modified_at = None
+    services_checked_at = None
+    instances = weakref.WeakSet()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instances.add(self)
+
+    @classmethod
+    def services_modified(cls):
+        """called by timetable importers when they finish - clear the caches in this
+        process straight away, and let other processes know theirs are stale
+        """
+        cache.set("services_modified_at", timezone.now(), None)
+        for trip_cache in cls.instances:
+            trip_cache.clear()
+
+    def check_services_modified(self):
+        now = timezone.now()
+        if self.services_checked_at and (now - self.services_checked_at).seconds < 60:
+            return
+        self.services_checked_at = now
+
+        services_modified_at = cache.get("services_modified_at")
+        if services_modified_at != self.services_modified_at:
+            self.clear()
+            self.services_modified_at = services_modified_at
+
+
+def project(starts, vectors, point):
+    """how far along (0-1) each line segment the nearest point to `point` is,
+    and how far away from `point` it is
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = ((point - starts) * vectors).sum(axis=1) / (vectors**2).sum(axis=1)
+    fractions = np.clip(np.nan_to_num(fractions), 0, 1)
+    offsets = point - (starts + vectors * fractions[:, np.newaxis])
+    return fractions, np.hypot(offsets[:, 0], offsets[:, 1])
+
+
+def to_3857(coords):
+    coords = np.radians(coords)
+    return (
+        np.column_stack(
+            (coords[..., 0], np.log(np.tan(np.pi / 4 + coords[..., 1] / 2)))
+        )
+        * EARTH_RADIUS
+    )
+
+
+class Segments:
+    """line segments between consecutive vertices of some lines,
+    in EPSG:4326 and projected to EPSG:3857 (for distances in metres)
+    """
+
+    def __init__(self, lines):
+        starts = []
+        vectors = []
+        self.line_indices = []
+        for i, vertices in enumerate(lines):
+            starts.append(vertices[:-1])
+            vectors.append(np.diff(vertices, axis=0))
+            self.line_indices += [i] * (len(vertices) - 1)
+        self.starts = np.concatenate(starts)
+        self.vectors = np.concatenate(vectors)
+        self.line_indices = np.array(self.line_indices, dtype=int)
+        starts_3857 = to_3857(self.starts)
+        self.starts_3857 = starts_3857
+        self.vectors_3857 = to_3857(self.starts + self.vectors) - starts_3857
+
+        # lengths (in degrees) of the segments, and of the lines before each segment
+        self.lengths = np.hypot(self.vectors[:, 0], self.vectors[:, 1])
+        cumulative = np.cumsum(self.lengths)
+        line_starts = np.r_[True, self.line_indices[1:] != self.line_indices[:-1]]
+        line_offsets = (cumulative - self.lengths)[line_starts]
+        self.lengths_before = (
+            cumulative - self.lengths - line_offsets[self.line_indices]
+        )
+        self.line_lengths = np.bincount(self.line_indices, self.lengths)
+
+    def locate(self, coordinates):
+        """for each line,
+        how far along (0-1) it the nearest point to some coordinates is
+        (in EPSG:4326, like GEOSGeometry.project_normalized and ST_LineLocatePoint),
+        and how far away from the coordinates it is (in EPSG:3857 metres)
+        """
+        point = np.array(coordinates, dtype=float)
+        fractions, _ = project(self.starts, self.vectors, point)
+        _, distances = project(
+            self.starts_3857, self.vectors_3857, to_3857(point[np.newaxis])[0]
+        )
+
+        # nearest segment of each line
+        order = np.lexsort((distances, self.line_indices))
+        nearest = order[
+            np.r_[True, self.line_indices[order][1:] != self.line_indices[order][:-1]]
+        ]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            progresses = (
+                self.lengths_before[nearest]
+                + fractions[nearest] * self.lengths[nearest]
+            ) / self.line_lengths
+        return np.nan_to_num(progresses), distances[nearest]
+
+    def interpolate(self, line, fraction):
+        """the point a fraction of the way along a line,
+        and the start and end of the segment it's on
+        """
+        segments = np.flatnonzero(self.line_indices == line)
+        distance = fraction * self.line_lengths[line]
+        i = segments[
+            max(
+                np.searchsorted(self.lengths_before[segments], distance, side="right")
+                - 1,
+                0,
+            )
+        ]
+        start = self.starts[i]
+        end = start + self.vectors[i]
+        if self.lengths[i]:
+            fraction = min((distance - self.lengths_before[i]) / self.lengths[i], 1)
+            return start + self.vectors[i] * fraction, start, end
+        return start, start, end
+
+
+class TripGeometry:
+    """A trip's stop times, and the lines between its stops - RouteLinks where the
+    service has them, otherwise straight lines
+    """
+
+    def __init__(self, stop_times, service_id=None, route_links=None):
+        self.stop_times = list(stop_times)
+        pairs = [(a.stop_id, b.stop_id) for a, b in pairwise(self.stop_times)]
+        coords = np.array(
+            [stop_time.stop.latlong.coords for stop_time in self.stop_times],
+            dtype=float,
+        ).reshape(-1, 2)
+
+        self.route_links = {}  # pair index: RouteLink geometry
+        if service_id and pairs:
+            if route_links is None:
+                # (from stop, to stop): geometry
+                route_links = get_route_links([service_id], {a for a, _ in pairs}).get(
+                    service_id, {}
+                )
+            for i, pair in enumerate(pairs):
+                if pair in route_links:
+                    self.route_links[i] = route_links[pair]
+
+        if pairs:
+            self.segments = Segments(
+                np.array(self.route_links[i].coords, dtype=float)
+                if i in self.route_links
+                else coords[i : i + 2]
+                for i in range(len(pairs))
+            )
+
+    def locate(self, coordinates):
+        """for each pair of consecutive stops,
+        how far along (0-1) the line between them a point is,
+        and how far away from the line (in metres) it is
+        """
+        progresses, distances = self.segments.locate(coordinates)
+        if self.route_links:
+            # RouteLink distances were measured (by PostGIS) on the spheroid,
+            # while EPSG:3857 distances are stretched by 1/cos(latitude)
+            route_links = list(self.route_links)
+            distances[route_links] *= np.cos(np.radians(coordinates[1]))
+        # round to the millimetre, so that at a stop, the pair ending there
+        # and the pair starting there are equally distant
+        return progresses, np.round(distances, 3)
+
+
+def get_route_links(service_ids, from_stop_ids) -> dict:
+    """{service id: {(from stop, to stop): geometry}}"""
+    route_links = {}
+    for rl in RouteLink.objects.filter(
+        service__in=service_ids, from_stop__in=from_stop_ids
+    ).only("service", "from_stop", "to_stop", "geometry"):
+        route_links.setdefault(rl.service_id, {})[rl.from_stop_id, rl.to_stop_id] = (
+            rl.geometry
+        )
+    return route_links
+
+
+# keyed by (trip id, service id) - whether RouteLinks are used depends on the service
+trip_geometries = TripCache(maxsize=settings.TRIP_GEOMETRY_CACHE_SIZE, ttl=3600)
+
+
+def get_trip_geometry(item):
+    trip_geometries.check_services_modified()
+
+    key = (item["trip_id"], item.get("service_id"))
+    try:
+        return trip_geometries[key]
+    except KeyError:
+        pass
+
+    try:
+        geometry = TripGeometry(get_stop_times(item), item.get("service_id"))
+    except Trip.DoesNotExist:
+        geometry = None
+    trip_geometries[key] = geometry
+    return geometry
+
+
+def load_trip_geometries(items):
+    """put the geometries of any of some items' trips that aren't cached yet
+    into the cache, with a few queries in total instead of a few per trip
+    (except for trips split into parts - see Trip.get_trips)
+    """
+    trip_geometries.check_services_modified()
+
+    keys = set()
+    for item in items:
+        if item.get("trip_id"):
+            key = (item["trip_id"], item.get("service_id"))
+            try:
+                trip_geometries[key]
+            except KeyError:
+                keys.add(key)
+    if not keys:
+        return
+
+    trips = Trip.objects.select_related("calendar", "route").in_bulk(
+        {trip_id for trip_id, _ in keys}
+    )
+
+    stop_times = {}  # trip id: stop times
+    unsplit_trip_ids = []
+    for trip_id, trip in trips.items():
+        trip_parts = trip.get_trips()
+        if len(trip_parts) > 1:
+            stop_times[trip_id] = list(get_trip_stop_times(trip, trip_parts))
+        else:
+            stop_times[trip_id] = []
+            unsplit_trip_ids.append(trip_id)
+
+    for stop_time in (
+        StopTime.objects.filter(trip__in=unsplit_trip_ids, stop__latlong__isnull=False)
+        .select_related("stop")
+        .only("trip", "arrival", "departure", "stop__latlong")
+        .order_by("id")
+    ):
+        stop_times[stop_time.trip_id].append(stop_time)
+
+    route_links = get_route_links(
+        {service_id for _, service_id in keys if service_id},
+        {stop_time.stop_id for trip in stop_times.values() for stop_time in trip},
+    )
+
+    for trip_id, service_id in keys:
+        if trip_id in stop_times:
+            trip_geometries[trip_id, service_id] = TripGeometry(
+                stop_times[trip_id], service_id, route_links.get(service_id, {})
+            )
+        else:
+            trip_geometries[trip_id, service_id] = None
+
+
+def get_link_geometry(pair):
+    """geometry of a RouteLink, or of a straight line between two stops"""
+    a, b, rl = pair
+    if rl.geometry is None:
+        rl.geometry = LineString([a.stop.latlong, b.stop.latlong], srid=4326)
+    return rl.geometry
+
+
 class Progress:
     def __init__(self, stop_times, prev_stop_time, next_stop_time, progress, distance):
         self.stop_times = list(stop_times)
@@ -57,45 +342,32 @@ class Progress:
 
 
 def get_progress(item, stop_time=None):
-    point = Point(*item["coordinates"], srid=4326)
-    point_3857 = point.transform(3857, clone=True)
-
     if stop_time:
-        stop_times = stop_time.trip.stoptime_set.all()  # prefetched earlier
+        # prefetched earlier
+        geometry = TripGeometry(
+            stop_time.trip.stoptime_set.all(), item.get("service_id")
+        )
     else:
-        try:
-            stop_times = get_stop_times(item)
-        except Trip.DoesNotExist:
+        geometry = get_trip_geometry(item)
+        if geometry is None:
             return
 
-    route_links = {}
-    if "service_id" in item:
-        for rl in RouteLink.objects.filter(
-            service=item["service_id"],
-            geometry__dwithin=(point, 0.01),  # ~1km in degrees
-        ).annotate(
-            progress=LineLocatePoint("geometry", point),
-            distance=Distance("geometry", point),
-        ):
-            rl.distance = rl.distance.m  # convert to meters
-            route_links[(rl.from_stop_id, rl.to_stop_id)] = rl
+    if len(geometry.stop_times) < 2:
+        return
+
+    stop_times = geometry.stop_times
+    progresses, distances = geometry.locate(item["coordinates"])
 
     nearby_pairs = []
-    for a, b in pairwise(stop_times):
-        key = (a.stop_id, b.stop_id)
-        if key in route_links:
-            rl = route_links[key]
-            if rl.distance < 1000:  # within ~1km
-                nearby_pairs.append((a, b, rl))
-        else:
-            geometry = LineString([a.stop.latlong, b.stop.latlong], srid=4326)
-            geometry_3857 = geometry.transform(3857, clone=True)
-            distance = geometry_3857.distance(point_3857)  # in meters
-            if distance < 1000:  # within ~1km
-                rl = RouteLink(from_stop=a.stop, to_stop=b.stop, geometry=geometry)
-                rl.distance = distance
-                rl.progress = geometry.project_normalized(point)
-                nearby_pairs.append((a, b, rl))
+    for i in np.flatnonzero(distances < 1000):  # within ~1km
+        a = stop_times[i]
+        b = stop_times[i + 1]
+        rl = RouteLink(
+            from_stop=a.stop, to_stop=b.stop, geometry=geometry.route_links.get(i)
+        )
+        rl.distance = float(distances[i])
+        rl.progress = float(progresses[i])
+        nearby_pairs.append((a, b, rl))
 
     if not nearby_pairs:
         return
@@ -107,7 +379,9 @@ def get_progress(item, stop_time=None):
     if len(nearby_pairs) >= 2 and item["heading"] is not None:
         vehicle_heading = int(item["heading"])
 
-        route_bearing = get_route_bearing(closest[2].geometry, closest[2].progress)
+        route_bearing = get_route_bearing(
+            get_link_geometry(closest), closest[2].progress
+        )
 
         difference = (vehicle_heading - route_bearing + 180) % 360 - 180
         next_closest = nearby_pairs[1]
@@ -116,28 +390,103 @@ def get_progress(item, stop_time=None):
             # bus seems to be heading the wrong way - does the bus go both ways on this road?
             # try the next closest pair of stops:
             route_bearing = get_route_bearing(
-                next_closest[2].geometry, next_closest[2].progress
+                get_link_geometry(next_closest), next_closest[2].progress
             )
 
             difference = (vehicle_heading - route_bearing + 180) % 360 - 180
             if abs(difference) < 90:
                 closest = next_closest
-                distance = next_closest[2].distance
 
     return Progress(
         stop_times, closest[0], closest[1], closest[2].progress, closest[2].distance
     )
 
 
+# how long after a vehicle's last reported location to keep estimating where it is
+MAX_ESTIMATE_AGE = timedelta(minutes=2)
+
+
+def get_time_of_day(when) -> timedelta:
+    when = timezone.localtime(when)
+    return timedelta(hours=when.hour, minutes=when.minute, seconds=when.second)
+
+
+def estimate_position(item, now):
+    """Move a vehicle along its route to where it probably is now,
+    assuming it's kept to the timetable (running just as late or early)
+    since it last reported its location
+    """
+    if "progress" not in item or item.get("delay") is None:
+        return
+
+    reported_at = item["datetime"]
+    if type(reported_at) is str:
+        reported_at = datetime.fromisoformat(reported_at)
+    elapsed = now - reported_at
+    if not timedelta() < elapsed <= MAX_ESTIMATE_AGE:
+        return
+
+    geometry = get_trip_geometry(item)
+    if geometry is None:
+        return
+    stop_times = geometry.stop_times
+    sequence = item["progress"]["sequence"]
+    if (
+        sequence >= len(stop_times) - 1
+        or stop_times[sequence].id != item["progress"]["id"]
+    ):
+        return
+
+    # the timetable time the vehicle should be at
+    when = get_time_of_day(reported_at) + elapsed - timedelta(seconds=item["delay"])
+    prev_time = stop_times[sequence].departure_or_arrival()
+    # correct for timetable times being > 24 hours:
+    if when - prev_time < -timedelta(hours=12):
+        when += timedelta(hours=24)
+    elif when - prev_time > timedelta(hours=12):
+        when -= timedelta(hours=24)
+
+    for i in range(sequence, len(stop_times) - 1):
+        departure_time = stop_times[i].departure_or_arrival()
+        arrival_time = stop_times[i + 1].arrival_or_departure()
+        if when < arrival_time:
+            if arrival_time > departure_time:
+                fraction = max(
+                    (when - departure_time) / (arrival_time - departure_time), 0
+                )
+            else:
+                fraction = 0
+            if i == sequence:
+                # never move backwards
+                fraction = max(fraction, item["progress"]["progress"])
+            break
+    else:
+        fraction = 1  # end of the trip
+
+    coordinates, start, end = geometry.segments.interpolate(i, fraction)
+    item["coordinates"] = [round(float(value), 6) for value in coordinates]
+    if (start != end).any():
+        item["heading"] = round(calculate_bearing(Point(*start), Point(*end)))
+    item["progress"] = {
+        "id": stop_times[i].id,
+        "sequence": i,
+        "prev_stop": stop_times[i].stop_id,
+        "next_stop": stop_times[i + 1].stop_id,
+        "progress": round(fraction, 3),
+    }
+    item["estimated"] = True
+
+
 def add_progress_and_delay(item, stop_time=None):
     progress = get_progress(item, stop_time)
     if not progress:
         return
 
     item["progress"] = progress.to_json()
-    when = datetime.fromisoformat(item["datetime"])
-    when = timezone.localtime(when)
-    when = timedelta(hours=when.hour, minutes=when.minute, seconds=when.second)
+    when = item["datetime"]
+    if type(when) is str:
+        when = datetime.fromisoformat(when)
+    when = get_time_of_day(when)
 
     prev_time = progress.prev_stop_time.departure_or_arrival()
     next_time = progress.next_stop_time.arrival_or_departure()
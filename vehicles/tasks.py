@@ -1,5 +1,7 @@
 import functools
+import io
 import json
+import logging
 from datetime import datetime, timedelta
 import zipfile
 
@@ -10,10 +12,12 @@ from django.utils import timezone
 from django.conf import settings
 from huey import crontab
 from huey.contrib.djhuey import db_periodic_task, db_task
+from lxml import etree
 
 from busstops.models import DataSource, Operator
 
-from .utils import archive_avl_data
+from . import history
+from .utils import archive_avl_data, redis_client
 from .management.commands import import_bod_avl
 from .models import (
     SiriSubscription,
@@ -23,6 +27,8 @@ from .models import (
     VehicleCode,
 )
 
+logger = logging.getLogger(__name__)
+
 
 @functools.cache
 def get_bod_avl_command(source_name: str):
@@ -32,62 +38,153 @@ def get_bod_avl_command(source_name: str):
     return command
 
 
-@db_task()
-def handle_siri_post(uuid, data: dict):
-    now = timezone.now()
+def get_overland_items(data: dict) -> list[dict]:
+    """an Overland (https://github.com/aaronpk/Overland-iOS#api) post's last location,
+    as a SIRI-VM VehicleActivity-like dict
+    """
+    items = []
+    for item in data["locations"][-1:]:
+        device_id = item["properties"]["device_id"]
+        operator, vehicle, line_name, journey_ref = device_id.split(":")
+        lon, lat = item["geometry"]["coordinates"]
+        items.append(
+            {
+                "RecordedAtTime": item["properties"]["timestamp"],
+                "MonitoredVehicleJourney": {
+                    "OperatorRef": operator,
+                    "VehicleRef": vehicle,
+                    "PublishedLineName": line_name,
+                    "VehicleJourneyRef": journey_ref,
+                    "VehicleLocation": {
+                        "Longitude": lon,
+                        "Latitude": lat,
+                    },
+                },
+            }
+        )
+    return items
 
-    data = data["Siri"]
 
+@db_task()
+def handle_siri_post(uuid, message_id):
+    """handle a post (added to a Redis stream by the siri_post or overland view),
+    unless settings.SIRI_POST_CONSUMER (see the consume_siri_posts command)
+    """
     subscription = SiriSubscription.objects.get(uuid=uuid)
 
-    if "HeartbeatNotification" in data:
-        timestamp = datetime.fromisoformat(
-            data["HeartbeatNotification"]["RequestTimestamp"]
-        )
-        total_items = None
-        changed_items = changed_journey_items = ()
-    else:
-        data = data["ServiceDelivery"]
+    messages = redis_client.xrange(subscription.get_posts_key(), message_id, message_id)
+    if not messages:
+        # trimmed from the stream already - the task queue must be a long way behind
+        logger.warning("%s post %s was dropped", subscription, message_id)
+        key = subscription.get_dropped_key()
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+        return
+
+    handle_posts(subscription, messages)
 
+
+def handle_posts(subscription, messages, command=None, live=True):
+    """handle a batch of posts to a subscription (Redis stream messages),
+    with one update for all the changed items
+    (live=False when replaying posts from the archive - they're not archived again,
+    or counted in the subscription's status) - returns (total items, changed items)
+    """
+    now = timezone.now()
+
+    if command is None:
         command = get_bod_avl_command(subscription.name)
+    command.timings = import_bod_avl.Timings()
+
+    timestamp = None
+    total_items = None
+    activities = {}  # vehicle identity: latest activity
+
+    for _, fields in messages:
+        content_type = fields[b"content-type"].decode()
+        body = fields[b"body"]
 
-        items = data["VehicleMonitoringDelivery"]["VehicleActivity"]
+        if b"HeartbeatNotification>" in body:
+            # (heartbeats are small, so just parse the whole thing)
+            timestamp = datetime.fromisoformat(
+                etree.fromstring(body).findtext(
+                    "{*}HeartbeatNotification/{*}RequestTimestamp"
+                )
+            )
+            continue
+
+        if content_type == "application/json":
+            items = get_overland_items(json.loads(body))
+            if not items:
+                continue
+            timestamp = datetime.fromisoformat(items[-1]["RecordedAtTime"])
+            command.source.datetime = timestamp
+            unchanged_items = 0
+            suffix = "json"
+        else:
+            # parse the same way as the import_bod_avl poller does -
+            # unchanged items are just counted, and old data is ignored
+            command.unchanged_items = 0
+            items = command.parse_items(io.BytesIO(body))
+            if items is None:
+                continue  # older than data already handled
+            timestamp = command.source.datetime
+            unchanged_items = command.unchanged_items
+            suffix = "xml"
+
+        total_items = (total_items or 0) + len(items) + unchanged_items
+        for item in items:
+            activity = command.get_activity(item)
+            activities[activity.vehicle_identity] = activity
+
+        if live:
+            archive_avl_data(
+                command.source,
+                body,
+                timestamp.strftime(f"%Y-%m-%d_%H%M%S.{suffix}"),
+                now,  # when it was received (see replay_avl_archive)
+            )
 
-        timestamp = datetime.fromisoformat(data["ResponseTimestamp"])
-        command.source.datetime = timestamp
+    if timestamp is None:
+        return
 
+    changed_items = changed_journey_items = ()
+    if activities:
         (
             changed_items,
             changed_journey_items,
             changed_item_identities,
             changed_journey_identities,
-            total_items,
-        ) = command.get_changed_items(items)
+            _,
+        ) = command.get_changed_items(list(activities.values()))
 
         command.handle_items(changed_items, changed_item_identities)
         command.handle_items(changed_journey_items, changed_journey_identities)
 
-        archive_avl_data(
-            command.source,
-            json.dumps(items),
-            timestamp.strftime("%Y-%m-%d_%H%M%S.json"),
+    changed = len(changed_items) + len(changed_journey_items)
+
+    if live:
+        # stats for last 50 updates:
+        key = subscription.get_status_key()
+        stats = cache.get(key, [])
+        stats.append(
+            import_bod_avl.Status(
+                now,
+                timestamp,
+                now - timestamp,
+                total_items,
+                changed,
+                timezone.now() - now,
+                command.timings.get_stages(),
+                command.timings.get_operators(),
+            )
         )
+        stats = stats[-50:]
+        cache.set(key, stats, 800)
 
-    # stats for last 50 updates:
-    key = subscription.get_status_key()
-    stats = cache.get(key, [])
-    stats.append(
-        import_bod_avl.Status(
-            now,
-            timestamp,
-            now - timestamp,
-            total_items,
-            len(changed_items) + len(changed_journey_items),
-            timezone.now() - now,
-        )
-    )
-    stats = stats[-50:]
-    cache.set(key, stats, 800)
+    return total_items, changed
 
 
 @db_task()
@@ -228,6 +325,75 @@ def log_vehicle_journey(service, data, time, destination, source_name, url, trip
         vehicle.save(update_fields=["garage", "latest_journey", "latest_journey_data"])
 
 
+def add_missing_expiry():
+    """add any vehicles on the map that aren't in vehicle_location_expiry
+    (like ones added before it existed) to it, according to their keys' TTLs -
+    so vehicles whose vehicle{id} keys are already gone will be swept straight away
+    """
+    vehicle_ids = redis_client.zrange("vehicle_location_locations", 0, -1)
+    if not vehicle_ids:
+        return
+    expiries = redis_client.zmscore("vehicle_location_expiry", vehicle_ids)
+    vehicle_ids = [
+        vehicle_id
+        for vehicle_id, expiry in zip(vehicle_ids, expiries)
+        if expiry is None
+    ]
+    if not vehicle_ids:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for vehicle_id in vehicle_ids:
+        pipe.pttl(f"vehicle{vehicle_id.decode()}")
+    ttls = pipe.execute()
+
+    now = timezone.now().timestamp()
+    redis_client.zadd(
+        "vehicle_location_expiry",
+        {
+            vehicle_id: now + max(ttl, 0) / 1000  # (-2 if the key is gone)
+            for vehicle_id, ttl in zip(vehicle_ids, ttls)
+            if ttl != -1  # (no TTL)
+        },
+        nx=True,  # (unless it's been updated in the meantime)
+    )
+
+
+@db_periodic_task(crontab())
+def sweep_vehicle_locations():
+    """remove expired vehicles from the map and from service and operator sets
+    (so that readers don't have to)
+    """
+    if not redis_client:
+        return
+
+    add_missing_expiry()
+
+    def sweep(pipe):
+        vehicle_ids = pipe.zrangebyscore(
+            "vehicle_location_expiry", "-inf", timezone.now().timestamp()
+        )
+        if not vehicle_ids:
+            return
+        set_names = pipe.hmget("vehicle_location_sets", vehicle_ids)
+
+        pipe.multi()
+        pipe.zrem("vehicle_location_locations", *vehicle_ids)
+        for vehicle_id, names in zip(vehicle_ids, set_names):
+            for name in names.decode().split() if names else ():
+                pipe.srem(name, vehicle_id)
+        pipe.hdel("vehicle_location_sets", *vehicle_ids)
+        pipe.zrem("vehicle_location_timestamps", *vehicle_ids)
+        pipe.zrem("vehicle_location_expiry", *vehicle_ids)
+        pipe.publish(
+            "vehicle_locations",
+            json.dumps({"expired": [int(vehicle_id) for vehicle_id in vehicle_ids]}),
+        )
+
+    # (retries if a vehicle is updated in the meantime)
+    redis_client.transaction(sweep, "vehicle_location_expiry")
+
+
 @db_periodic_task(crontab(minute="*/5"))
 def stats():
     """
@@ -306,6 +472,7 @@ def compress_avl_archive():
     """
     move files named things like
     2024-03-15_060942.json
+    (written before the hourly segment files in vehicles/avl_archive.py)
     into
     2024-03-15.zip
     """
@@ -320,7 +487,7 @@ def compress_avl_archive():
         archive = None
 
         for file_path in sorted(path.iterdir()):
-            if file_path.suffix != ".json":
+            if file_path.suffix not in (".json", ".xml"):
                 continue
             if file_path.name.startswith(today_str):
                 break
@@ -331,3 +498,9 @@ def compress_avl_archive():
                 )
             archive.write(file_path, file_path.name)
             file_path.unlink()
+
+
+@db_periodic_task(crontab(minute=40))
+def compact_journey_history():
+    """move the location histories of finished journeys out of Redis"""
+    history.compact(timedelta(hours=settings.JOURNEY_HISTORY_HOURS))
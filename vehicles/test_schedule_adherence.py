@@ -1,4 +1,5 @@
 import json
+from datetime import datetime
 from unittest.mock import patch
 
 import fakeredis
@@ -9,6 +10,7 @@ from busstops.models import DataSource, Service, StopPoint, StopUsage
 from bustimes.models import Calendar, Route, StopTime, Trip
 
 from . import rtpi
+from .management.import_live_vehicles import ImportLiveVehiclesCommand
 from .models import VehicleJourney
 
 
@@ -204,13 +206,14 @@ class ScheduleAdherenceTest(TestCase):
             }
         )
         self.assertEqual(progress.prev_stop_time.stop_id, "210021502200")
-        progress = rtpi.get_progress(
-            {
-                "coordinates": [-0.320573, 51.75536],
-                "trip_id": self.journey.trip_id,
-                "heading": 84,
-            }
-        )
+        with self.assertNumQueries(0):  # stop times cached
+            progress = rtpi.get_progress(
+                {
+                    "coordinates": [-0.320573, 51.75536],
+                    "trip_id": self.journey.trip_id,
+                    "heading": 84,
+                }
+            )
         self.assertEqual(progress.prev_stop_time.stop_id, "210021505160")
         progress = rtpi.get_progress(
             {
@@ -249,6 +252,17 @@ class ScheduleAdherenceTest(TestCase):
         self.assertEqual(item["progress"]["progress"], 1)
         self.assertEqual(item["delay"], 967)
 
+        # as when importing locations (see ImportLiveVehiclesCommand.add_progress)
+        imported_item = {
+            "coordinates": item["coordinates"],
+            "trip_id": item["trip_id"],
+            "heading": None,
+            "datetime": datetime.fromisoformat(item["datetime"]),
+        }
+        ImportLiveVehiclesCommand.add_progress([imported_item])
+        self.assertEqual(imported_item["progress"], item["progress"])
+        self.assertEqual(imported_item["delay"], 967)
+
         # more than 12 hours early/late - should adjust by 24 hours
         item["datetime"] = "2023-08-30T22:59:00Z"
         rtpi.add_progress_and_delay(item)
@@ -266,6 +280,49 @@ class ScheduleAdherenceTest(TestCase):
         self.journey.trip.delete()
         rtpi.add_progress_and_delay(item)
 
+    def test_load_trip_geometries(self):
+        rtpi.trip_geometries.clear()
+        items = [
+            {"trip_id": self.journey.trip_id, "service_id": self.service.id},
+            {"trip_id": self.journey_after_midnight.trip_id, "service_id": None},
+            {"trip_id": 0, "service_id": None},  # doesn't exist
+            {"trip_id": None},
+        ]
+        with self.assertNumQueries(3):  # trips, stop times, route links
+            rtpi.load_trip_geometries(items)
+        with self.assertNumQueries(0):
+            rtpi.load_trip_geometries(items)
+            geometry = rtpi.get_trip_geometry(items[0])
+            self.assertIsNone(rtpi.get_trip_geometry(items[2]))
+        self.assertEqual(len(geometry.stop_times), 16)
+        self.assertEqual(len(rtpi.get_trip_geometry(items[1]).stop_times), 2)
+
+        # cached separately for a different service (or none)
+        with self.assertNumQueries(2):  # trip, stop times
+            rtpi.get_trip_geometry({"trip_id": self.journey.trip_id})
+
+    def test_estimate_position(self):
+        item = {
+            "coordinates": [-0.332185, 51.750952],  # Lattimore Road
+            "trip_id": self.journey.trip_id,
+            "heading": None,
+            "datetime": "2023-08-31T09:34:00Z",
+        }
+        rtpi.add_progress_and_delay(item)
+        self.assertEqual(item["delay"], 0)
+
+        # too long ago
+        rtpi.estimate_position(item, datetime.fromisoformat("2023-08-31T09:40:00Z"))
+        self.assertNotIn("estimated", item)
+
+        # a minute later - half way to the next stop
+        rtpi.estimate_position(item, datetime.fromisoformat("2023-08-31T09:35:00Z"))
+        self.assertTrue(item["estimated"])
+        self.assertEqual(item["coordinates"], [-0.329512, 51.750775])
+        self.assertEqual(item["heading"], 96)
+        self.assertEqual(item["progress"]["prev_stop"], "210021505100")
+        self.assertEqual(item["progress"]["progress"], 0.5)
+
     @time_machine.travel("2024-02-16T00:00:07Z")
     def test_stop_times(self):
         redis_client = fakeredis.FakeStrictRedis()
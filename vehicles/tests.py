@@ -1,9 +1,13 @@
+import gzip
+import json
+import tempfile
 from http import HTTPStatus
 from unittest.mock import patch
 
 import fakeredis
 import time_machine
-from datetime import datetime
+from datetime import datetime, timedelta
+from pathlib import Path
 from django.contrib.gis.geos import Point
 from django.contrib.auth.models import Permission
 from django.test import TestCase, override_settings
@@ -21,6 +25,12 @@ from .models import (
     VehicleRevisionFeature,
     VehicleType,
 )
+from . import avl_archive, history, views
+from .utils import (
+    archive_avl_data,
+    decode_vehicle_location,
+    encode_vehicle_location,
+)
 
 
 @patch(
@@ -319,6 +329,248 @@ class VehiclesTests(TestCase):
         location.wheelchair_capacity = 1
         self.assertEqual(location.get_redis_json()["wheelchair"], "free")
 
+        redis_json = location.get_redis_json()
+        redis_json["progress"] = {
+            "id": 1234,
+            "sequence": 5,
+            "prev_stop": "210021502200",
+            "next_stop": "210021506765",
+            "progress": 0.479,
+        }
+        redis_json["delay"] = 60
+        expected = json.loads(encode_vehicle_location(redis_json))
+        self.assertEqual(decode_vehicle_location(json.dumps(expected)), expected)
+        with override_settings(VEHICLE_LOCATION_BINARY=True):
+            encoded = encode_vehicle_location(redis_json)
+        self.assertLess(len(encoded), len(json.dumps(expected)))
+        self.assertEqual(decode_vehicle_location(encoded), expected)
+
+        # headings from some importers are strings
+        location.heading = "288"
+        location.block = 1234
+        redis_json = location.get_redis_json()
+        with override_settings(VEHICLE_LOCATION_BINARY=True):
+            decoded = decode_vehicle_location(encode_vehicle_location(redis_json))
+        self.assertEqual(decoded["heading"], 288)
+        self.assertEqual(decoded["block"], "1234")
+
+        location.heading = ""
+        with override_settings(VEHICLE_LOCATION_BINARY=True):
+            decoded = decode_vehicle_location(
+                encode_vehicle_location(location.get_redis_json())
+            )
+        self.assertIsNone(decoded["heading"])
+
+    def test_vehicles_json_snapshot(self):
+        redis_client = views.redis_client
+        location = VehicleLocation(latlong=Point(1.3, 52.6))
+        location.id = self.vehicle_1.id
+        location.journey = self.journey
+        location.datetime = datetime.fromisoformat(self.datetime)
+        redis_client.set(
+            f"vehicle{location.id}", encode_vehicle_location(location.get_redis_json())
+        )
+        redis_client.geoadd("vehicle_location_locations", [1.3, 52.6, location.id])
+        self.addCleanup(
+            redis_client.delete,
+            f"vehicle{location.id}",
+            "vehicle_location_locations",
+            views.SNAPSHOT_KEY,
+        )
+
+        live = self.client.get("/vehicles.json").json()
+        self.assertEqual(len(live), 1)
+
+        views.build_vehicles_json_snapshot()
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/vehicles.json")
+        self.assertEqual(response.json(), live)
+        etag = response.headers["ETag"]
+
+        # estimating positions of all vehicles is not allowed, so the snapshot is used
+        with self.assertNumQueries(0):
+            response = self.client.get("/vehicles.json?estimate")
+        self.assertEqual(response.headers["ETag"], etag)
+
+        response = self.client.get("/vehicles.json", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(
+            "/vehicles.json", headers={"Accept-Encoding": "gzip, br"}
+        )
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(response.content)), live)
+
+        response = self.client.get(
+            "/vehicles.json?xmin=1.2&ymin=52.5&xmax=1.4&ymax=52.7"
+        )
+        self.assertEqual(response.json(), live)
+        response = self.client.get("/vehicles.json?xmin=-2&ymin=50&xmax=-1.9&ymax=50.1")
+        self.assertEqual(response.json(), [])
+
+    def test_vehicles_json_clusters(self):
+        redis_client = views.redis_client
+        redis_client.geoadd(
+            "vehicle_location_locations",
+            [1.3, 52.6, self.vehicle_1.id, 1.301, 52.601, self.vehicle_2.id],
+        )
+        self.addCleanup(
+            redis_client.delete, "vehicle_location_locations", views.SNAPSHOT_KEY
+        )
+
+        url = "/vehicles.json?xmin=1.2&ymin=52.5&xmax=1.4&ymax=52.7"
+
+        response = self.client.get(f"{url}&zoom=nine")
+        self.assertEqual(response.status_code, 400)
+
+        # live
+        with self.assertNumQueries(0):
+            (cluster,) = self.client.get(f"{url}&zoom=6").json()
+        self.assertEqual(cluster["count"], 2)
+        self.assertAlmostEqual(cluster["coordinates"][0], 1.3005, places=3)
+
+        # zoomed in - individual vehicles (none, as no vehicle{id} keys), not clusters
+        self.assertEqual(self.client.get(f"{url}&zoom=14").json(), [])
+
+        self.assertEqual(views.get_tile(1.3, 52.6, 6), (32, 20))
+        self.assertEqual(views.get_tiles(1.2, 52.5, 1.4, 52.7, 6), ["z6:32,20"])
+
+    def test_compact_journey_history(self):
+        redis_client = views.redis_client
+        location = VehicleLocation(latlong=Point(1.3, 52.6))
+        location.journey = self.journey
+        location.datetime = datetime.fromisoformat(self.datetime)
+        key, appendage = location.get_appendage()
+        redis_client.rpush(key, appendage)
+        self.addCleanup(redis_client.delete, key)
+
+        url = f"/journeys/{self.journey.id}.json"
+        live = self.client.get(url).json()["locations"]
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        with (
+            override_settings(JOURNEY_HISTORY_DIR=Path(temp_dir.name)),
+            patch("vehicles.history.redis_client", redis_client),
+        ):
+            history.compact(timedelta(hours=6))
+            self.assertFalse(redis_client.exists(key))
+
+            self.assertEqual(self.client.get(url).json()["locations"], live)
+            self.assertEqual(
+                history.get_archived_journeys([self.journey]), {self.journey.uuid}
+            )
+
+    def test_avl_archive(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        start = datetime.fromisoformat("2024-03-15T06:58:00Z")
+
+        with override_settings(AVL_ARCHIVE_DIR=Path(temp_dir.name)):
+            for minute in range(4):
+                timestamp = start + timedelta(minutes=minute)
+                archive_avl_data(
+                    self.journey.source,
+                    f"<Siri>{minute}</Siri>",
+                    f"{timestamp:%Y-%m-%d_%H%M%S}.xml",
+                    timestamp,
+                )
+
+            # two hourly segments, each with an index
+            self.assertEqual(
+                sorted(path.name for path in Path(temp_dir.name).glob("*/*")),
+                [
+                    "2024-03-15_06.gz",
+                    "2024-03-15_06.idx",
+                    "2024-03-15_07.gz",
+                    "2024-03-15_07.idx",
+                ],
+            )
+
+            records = list(avl_archive.read(self.journey.source_id))
+            self.assertEqual(len(records), 4)
+            self.assertEqual(records[0].timestamp, start)
+            self.assertEqual(records[0].name, "2024-03-15_065800.xml")
+            self.assertEqual(records[3].data, b"<Siri>3</Siri>")
+
+            records = avl_archive.read(
+                self.journey.source_id,
+                since=start + timedelta(minutes=1),
+                until=start + timedelta(minutes=3),
+            )
+            self.assertEqual(
+                [record.data for record in records],
+                [b"<Siri>1</Siri>", b"<Siri>2</Siri>"],
+            )
+
+            # the segments are ordinary gzip files
+            with gzip.open(
+                Path(temp_dir.name) / str(self.journey.source_id) / "2024-03-15_06.gz"
+            ) as segment:
+                self.assertEqual(len(list(avl_archive.read_records(segment))), 2)
+
+    async def test_vehicles_stream(self):
+        server = fakeredis.FakeServer()
+        with patch(
+            "vehicles.views.get_async_redis_client",
+            lambda: fakeredis.FakeAsyncRedis(server=server),
+        ):
+            response = await self.async_client.get("/vehicles/stream?service=1,2")
+            stream = response.streaming_content
+            self.assertEqual(await anext(stream), b"retry: 10000\n\n")
+
+            response = await self.async_client.get("/vehicles/stream?service=3")
+            other_stream = response.streaming_content
+            self.assertEqual(await anext(other_stream), b"retry: 10000\n\n")
+
+            # one subscription shared by both clients
+            publisher = fakeredis.FakeAsyncRedis(server=server)
+            self.assertEqual(
+                await publisher.pubsub_numsub("vehicle_locations"),
+                [(b"vehicle_locations", 1)],
+            )
+
+            await publisher.publish(
+                "vehicle_locations",
+                json.dumps(
+                    {
+                        "moved": [
+                            {
+                                "id": 1,
+                                "coordinates": [1, 52],
+                                "sets": ["service1vehicles"],
+                            },
+                            {
+                                "id": 2,
+                                "coordinates": [1, 52],
+                                "sets": ["service3vehicles"],
+                            },
+                        ]
+                    }
+                ),
+            )
+            self.assertEqual(
+                json.loads((await anext(stream))[6:]),
+                {"changed": [{"id": 1, "coordinates": [1, 52]}], "expired": []},
+            )
+            self.assertEqual(
+                json.loads((await anext(other_stream))[6:]),
+                {"changed": [{"id": 2, "coordinates": [1, 52]}], "expired": []},
+            )
+
+            # vehicle 1 has changed service
+            await publisher.publish(
+                "vehicle_locations",
+                json.dumps({"moved": [{"id": 1, "coordinates": [1, 52], "sets": []}]}),
+            )
+            self.assertEqual(
+                json.loads((await anext(stream))[6:]), {"changed": [], "expired": [1]}
+            )
+
+            await stream.aclose()
+            await other_stream.aclose()
+
     def test_vehicle_json(self):
         vehicle = Vehicle.objects.get(id=self.vehicle_2.id)
         vehicle.feature_names = "foo, bar"
@@ -23,6 +23,7 @@ urlpatterns = [
     path("vehicles", views.vehicles),
     path("vehicles.json", views.vehicles_json),
     path("vehicles/debug", views.debug),
+    path("vehicles/stream", views.vehicles_stream),
     path("vehicles/history", views.vehicle_edits),
     path("vehicles/edits", views.vehicle_edits),
     path(
@@ -1,9 +1,18 @@
+import json
 import math
+import struct
+from collections import OrderedDict
+from datetime import UTC, datetime, timedelta
+from time import monotonic
 
+import redis.asyncio
 from django.core.cache import caches
 from django.conf import settings
 from django.core.cache.backends.base import InvalidCacheBackendError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 
+from . import avl_archive
 from .models import VehicleRevision, VehicleRevisionFeature
 
 try:
@@ -12,21 +21,192 @@ except InvalidCacheBackendError:
     redis_client = None
 
 
+def get_async_redis_client():
+    return redis.asyncio.from_url(settings.REDIS_URL)
+
+
 def filename_from_content_disposition(response) -> str:
     # really not fully RFC 6266 compliant
     return response.headers["Content-Disposition"].split("filename", 1)[1][2:-1]
 
 
-def archive_avl_data(source, data: bytes | str, filename: str):
-    if path := settings.AVL_ARCHIVE_DIR:
-        path = path / str(source.id)
-        if not path.exists():
-            path.mkdir(parents=True)
-        path /= filename
+def archive_avl_data(source, data: bytes | str, filename: str, timestamp: datetime):
+    if settings.AVL_ARCHIVE_DIR:
         if type(data) is str:
-            path.write_text(data)
-        else:
-            path.write_bytes(data)
+            data = data.encode()
+        avl_archive.append(source.id, data, filename, timestamp)
+
+
+# compact binary encoding of VehicleLocation.get_redis_json() for "vehicle{id}" values:
+# version, flags, id, journey_id, longitude, latitude, datetime (milliseconds),
+# then the optional numbers and strings indicated by the flags (in order),
+# then progress along the trip (see add_progress_and_delay) if flagged
+LOCATION_FORMAT_VERSION = 1
+location_header = struct.Struct("<BHIQddq")
+location_numbers = (
+    ("heading", struct.Struct("<d")),
+    ("delay", struct.Struct("<d")),
+    ("trip_id", struct.Struct("<Q")),
+    ("service_id", struct.Struct("<I")),
+)
+location_strings = (
+    "destination",
+    "block",
+    "tfl_code",
+    "line_name",
+    "seats",
+    "wheelchair",
+)
+location_string_length = struct.Struct("<H")
+# stop time id, sequence, progress - then previous and next stop codes (as strings)
+location_progress = struct.Struct("<QHd")
+location_progress_flag = 1 << (len(location_numbers) + len(location_strings))
+epoch = datetime(1970, 1, 1, tzinfo=UTC)
+millisecond = timedelta(milliseconds=1)
+json_encoder = DjangoJSONEncoder()
+
+
+def encode_vehicle_location(location: dict) -> bytes | str:
+    """serialise a dict from VehicleLocation.get_redis_json() for storing in Redis
+    (as JSON, unless the VEHICLE_LOCATION_BINARY setting is on)
+    """
+    if not settings.VEHICLE_LOCATION_BINARY:
+        return json.dumps(location, cls=DjangoJSONEncoder)
+
+    values = {**location}
+    if "service" in values:
+        values["line_name"] = values["service"]["line_name"]
+
+    dt = values["datetime"]
+    if type(dt) is str:
+        dt = datetime.fromisoformat(dt)
+
+    flags = 0
+    parts = [b""]
+    for i, (key, number) in enumerate(location_numbers):
+        value = values.get(key)
+        if value is None:
+            continue
+        # (some importers' headings are strings, like "288")
+        try:
+            value = float(value) if number.format == "<d" else int(value)
+        except (TypeError, ValueError):
+            continue
+        flags |= 1 << i
+        parts.append(number.pack(value))
+    for i, key in enumerate(location_strings, len(location_numbers)):
+        if values.get(key) is not None:
+            flags |= 1 << i
+            value = str(values[key]).encode()[:65535]
+            parts.append(location_string_length.pack(len(value)))
+            parts.append(value)
+    if progress := values.get("progress"):
+        flags |= location_progress_flag
+        parts.append(
+            location_progress.pack(
+                progress["id"], progress["sequence"], progress["progress"]
+            )
+        )
+        for key in ("prev_stop", "next_stop"):
+            value = str(progress[key]).encode()[:65535]
+            parts.append(location_string_length.pack(len(value)))
+            parts.append(value)
+
+    parts[0] = location_header.pack(
+        LOCATION_FORMAT_VERSION,
+        flags,
+        values["id"],
+        values["journey_id"],
+        *values["coordinates"],
+        (dt - epoch) // millisecond,
+    )
+    return b"".join(parts)
+
+
+def decode_vehicle_location(value: bytes | str) -> dict:
+    """the opposite of encode_vehicle_location
+    - returns the same dict as json.loads() on the JSON version would
+    """
+    if value[0] != LOCATION_FORMAT_VERSION:
+        return json.loads(value)  # legacy JSON
+
+    _, flags, vehicle_id, journey_id, longitude, latitude, milliseconds = (
+        location_header.unpack_from(value)
+    )
+    dt = epoch + timedelta(milliseconds=milliseconds)
+    location = {
+        "id": vehicle_id,
+        "journey_id": journey_id,
+        "coordinates": [longitude, latitude],
+        "heading": None,
+        "datetime": json_encoder.default(timezone.localtime(dt)),
+        "destination": None,
+        "block": None,
+    }
+
+    offset = location_header.size
+    for i, (key, number) in enumerate(location_numbers):
+        if flags & (1 << i):
+            (location[key],) = number.unpack_from(value, offset)
+            offset += number.size
+    for i, key in enumerate(location_strings, len(location_numbers)):
+        if flags & (1 << i):
+            (length,) = location_string_length.unpack_from(value, offset)
+            offset += location_string_length.size
+            location[key] = value[offset : offset + length].decode()
+            offset += length
+    if flags & location_progress_flag:
+        stop_time_id, sequence, progress = location_progress.unpack_from(value, offset)
+        offset += location_progress.size
+        stop_codes = []
+        for _ in range(2):
+            (length,) = location_string_length.unpack_from(value, offset)
+            offset += location_string_length.size
+            stop_codes.append(value[offset : offset + length].decode())
+            offset += length
+        location["progress"] = {
+            "id": stop_time_id,
+            "sequence": sequence,
+            "prev_stop": stop_codes[0],
+            "next_stop": stop_codes[1],
+            "progress": progress,
+        }
+
+    if "line_name" in location:
+        location["service"] = {"line_name": location.pop("line_name")}
+
+    return location
+
+
+class TimedLRUCache:
+    """In-memory least-recently-used cache whose entries also expire after ttl seconds.
+    Can store None (e.g. to remember that something wasn't found)
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        value, expires_at = self.data[key]
+        if expires_at < monotonic():
+            del self.data[key]
+            raise KeyError(key)
+        self.data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data[key] = (value, monotonic() + self.ttl)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
 
 
 def calculate_bearing(a, b):
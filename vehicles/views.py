@@ -1,6 +1,10 @@
+import asyncio
 import datetime
+import gzip
 import json
 import logging
+import math
+import zlib
 from itertools import pairwise, groupby
 from urllib.parse import unquote
 from functools import partial
@@ -14,11 +18,12 @@ from django.contrib.gis.geos import GEOSException
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, BadRequest
 from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import IntegrityError, OperationalError, connection, transaction
 from django.db.models import Case, F, Max, OuterRef, Q, When, Value
 from django.db.models.aggregates import StringAgg
 from django.db.models.functions import Coalesce, Now
-from django.http import Http404, HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
 from django.utils import timezone
@@ -48,19 +53,30 @@ from photos.forms import PhotoForm
 from photos.utils import add_flickr_photo
 
 from . import filters, forms
+from .history import decode_locations, get_archived_journeys, get_archived_locations
 from .management.commands import import_bod_avl
 from .models import (
     Livery,
     SiriSubscription,
     Vehicle,
     VehicleJourney,
-    VehicleLocation,
     VehicleRevision,
     VehicleRevisionFeature,
 )
-from .rtpi import add_progress_and_delay
+from .rtpi import (
+    TripCache,
+    add_progress_and_delay,
+    estimate_position,
+    load_trip_geometries,
+)
 from .tasks import handle_siri_post
-from .utils import apply_revision, get_revision, redis_client  # calculate_bearing,
+from .utils import (  # calculate_bearing,
+    apply_revision,
+    decode_vehicle_location,
+    get_async_redis_client,
+    get_revision,
+    redis_client,
+)
 
 
 def get_redirect_view(*args, **kwargs):
@@ -358,82 +374,17 @@ def respond_conditionally(request, response):
     )
 
 
-@require_safe
-def vehicles_json(request) -> JsonResponse:
-    try:
-        bounds = get_bounding_box(request)
-    except KeyError:
-        bounds = None
-    except (GEOSException, ValueError):
-        raise BadRequest
-
-    vehicle_ids = None
-    set_names = None
-    service_ids = None
-    operator_ids = None
-
-    if bounds is not None:
-        # ids of vehicles within box
-        xmin, ymin, xmax, ymax = bounds.extent
-
-        try:
-            # convert to kilometres (only for Redis to convert back to degrees)
-            width = haversine((ymin, xmax), (ymin, xmin))
-            height = haversine((ymin, xmax), (ymax, xmax))
-        except ValueError:
-            raise BadRequest
-
-        vehicle_ids = redis_client.geosearch(
-            "vehicle_location_locations",
-            longitude=str((xmax + xmin) / 2),
-            latitude=str((ymax + ymin) / 2),
-            unit="km",
-            width=str(width),
-            height=str(height),
-        )
-
-    elif "service" in request.GET:
-        try:
-            service_ids = [
-                int(service_id) for service_id in request.GET["service"].split(",")
-            ]
-        except ValueError:
-            raise BadRequest
-        set_names = [f"service{service_id}vehicles" for service_id in service_ids]
-    elif "operator" in request.GET:
-        operator_ids = request.GET["operator"].split(",")
-        set_names = [f"operator{operator_id}vehicles" for operator_id in operator_ids]
-    elif "id" in request.GET:
-        # specified vehicle ids
-        vehicle_ids = request.GET["id"].split(",")
-    else:
-        # ids of all vehicles
-        vehicle_ids = redis_client.zrange("vehicle_location_locations", 0, -1)
-
-    if set_names:
-        vehicle_ids = list(redis_client.sunion(set_names))
-
-    vehicle_ids = [int(vehicle_id) for vehicle_id in vehicle_ids]
-
-    vehicle_ids.sort()  # for etag stableness
-
+def get_vehicle_locations(vehicle_ids: list[int], trip: int | None = None):
+    """live locations of some vehicles, with details of the vehicles and journeys,
+    as (vehicle id, location) pairs - location is None if it has expired
+    """
     vehicle_locations = redis_client.mget(
         [f"vehicle{vehicle_id}" for vehicle_id in vehicle_ids]
     )
     vehicle_locations = [
-        json.loads(item) if item else item for item in vehicle_locations
+        decode_vehicle_location(item) if item else item for item in vehicle_locations
     ]
 
-    # remove expired items from 'vehicle_location_locations'
-    to_remove = [
-        vehicle_id
-        for vehicle_id, item in zip(vehicle_ids, vehicle_locations)
-        if not item
-    ]
-
-    if to_remove:
-        redis_client.zrem("vehicle_location_locations", *to_remove)
-
     journeys = cache.get_many(
         [f"journey{item['journey_id']}" for item in vehicle_locations if item]
     )
@@ -461,10 +412,6 @@ def vehicles_json(request) -> JsonResponse:
 
     locations = []
 
-    trip = request.GET.get("trip")
-    if trip:
-        trip = int(trip)
-
     journeys_to_cache_later = {}
 
     for vehicle_id, item in zip(vehicle_ids, vehicle_locations):
@@ -502,25 +449,442 @@ def vehicles_json(request) -> JsonResponse:
             ):
                 add_progress_and_delay(item)
 
-        if (
-            service_ids
-            and (not item or item.get("service_id") not in service_ids)
-            or operator_ids
-            and not item
-        ):
-            for set_name in set_names:
-                redis_client.srem(set_name, vehicle_id)
-        elif item:
-            locations.append(item)
+        locations.append((vehicle_id, item))
 
     if journeys_to_cache_later:
         cache.set_many(journeys_to_cache_later, 3600)  # an hour
 
+    return locations
+
+
+# pre-serialised /vehicles.json responses for all vehicles (see vehicles_json_snapshot),
+# also split into grid cells so a bounding box can be served by joining a few cells
+SNAPSHOT_KEY = "vehicles_json_snapshot"
+SNAPSHOT_CELL_SIZE = 0.2  # degrees
+
+
+def get_snapshot_cells(xmin, ymin, xmax, ymax) -> list[str]:
+    xmin, ymin, xmax, ymax = (
+        math.floor(value / SNAPSHOT_CELL_SIZE) for value in (xmin, ymin, xmax, ymax)
+    )
+    return [f"{x},{y}" for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+
+
+# below this zoom level, /vehicles.json?zoom= returns clusters instead of vehicles
+CLUSTER_MAX_ZOOM = 10
+
+
+def get_tile(longitude, latitude, zoom: int) -> tuple[int, int]:
+    """x and y of the web map tile containing a point"""
+    n = 2**zoom
+    latitude = math.radians(max(-85.0511, min(85.0511, latitude)))
+    x = (longitude + 180) / 360 * n
+    y = (1 - math.asinh(math.tan(latitude)) / math.pi) / 2 * n
+    return min(int(x), n - 1), min(int(y), n - 1)
+
+
+def get_tiles(xmin, ymin, xmax, ymax, zoom: int) -> list[str]:
+    xmin, ymin = get_tile(xmin, ymin, zoom)
+    xmax, ymax = get_tile(xmax, ymax, zoom)
+    # (y goes down the map)
+    return [
+        f"z{zoom}:{x},{y}" for x in range(xmin, xmax + 1) for y in range(ymax, ymin + 1)
+    ]
+
+
+def get_clusters(coordinates, zoom: int) -> dict:
+    """group points into clusters (an eighth of a map tile, about 32 pixels across)
+    - returns lists of clusters, keyed by the tile they're in (like get_tiles)
+    """
+    cells = {}
+    for longitude, latitude in coordinates:
+        cell = get_tile(longitude, latitude, zoom + 3)
+        if cell in cells:
+            cells[cell].append((longitude, latitude))
+        else:
+            cells[cell] = [(longitude, latitude)]
+
+    tiles = {}
+    for (x, y), points in cells.items():
+        tiles.setdefault(f"z{zoom}:{x >> 3},{y >> 3}", []).append(
+            {
+                "coordinates": [
+                    round(sum(point[0] for point in points) / len(points), 5),
+                    round(sum(point[1] for point in points) / len(points), 5),
+                ],
+                "count": len(points),
+            }
+        )
+    return tiles
+
+
+def build_vehicles_json_snapshot():
+    version = int(redis_client.get("vehicle_locations_version") or 0)
+
+    vehicle_ids = sorted(
+        int(vehicle_id)
+        for vehicle_id in redis_client.zrange("vehicle_location_locations", 0, -1)
+    )
+    cells = {}
+    locations = []
+    coordinates = []
+    for vehicle_id, item in get_vehicle_locations(vehicle_ids):
+        if item:
+            longitude, latitude = item["coordinates"]
+            coordinates.append((longitude, latitude))
+            (cell,) = get_snapshot_cells(longitude, latitude, longitude, latitude)
+            item = json.dumps(item, cls=DjangoJSONEncoder)
+            locations.append(item)
+            cells.setdefault(cell, []).append(item)
+
+    everything = f"[{','.join(locations)}]".encode()
+
+    mapping = {cell: ",".join(items) for cell, items in cells.items()}
+    for zoom in range(CLUSTER_MAX_ZOOM):
+        for tile, clusters in get_clusters(coordinates, zoom).items():
+            mapping[tile] = json.dumps(clusters)[1:-1]
+    mapping["version"] = f"{version}-{zlib.crc32(everything):x}"
+    mapping["all"] = everything
+    mapping["all.gz"] = gzip.compress(everything, compresslevel=6)
+
+    # replace the old snapshot in one go
+    pipeline = redis_client.pipeline()
+    pipeline.delete(f"{SNAPSHOT_KEY}_new")
+    pipeline.hset(f"{SNAPSHOT_KEY}_new", mapping=mapping)
+    pipeline.expire(f"{SNAPSHOT_KEY}_new", 60)
+    pipeline.rename(f"{SNAPSHOT_KEY}_new", SNAPSHOT_KEY)
+    pipeline.execute()
+
+    return mapping["version"]
+
+
+def get_vehicles_json_snapshot(request, bounds, zoom=None):
+    """respond from the snapshot, if there is one"""
+    if bounds is None:
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            fields = ["all.gz"]
+        else:
+            fields = ["all"]
+    else:
+        if zoom is not None:
+            fields = get_tiles(*bounds.extent, zoom)
+        else:
+            fields = get_snapshot_cells(*bounds.extent)
+        if len(fields) > 1000:
+            return
+    version, *values = redis_client.hmget(SNAPSHOT_KEY, ["version", *fields])
+    if not version:
+        return
+
+    if bounds is None:
+        response = HttpResponse(values[0], content_type="application/json")
+        if fields == ["all.gz"]:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        etag = version.decode()
+    else:
+        # (may include vehicles just outside the bounding box)
+        values = [value for value in values if value]
+        response = HttpResponse(
+            b"[" + b",".join(values) + b"]", content_type="application/json"
+        )
+        etag = f"{version.decode()}-{zlib.crc32(','.join(fields).encode()):x}"
+
+    response.headers["ETag"] = f'"{etag}"'
+    return respond_conditionally(request, response)
+
+
+@require_safe
+def vehicles_json(request) -> JsonResponse:
+    try:
+        bounds = get_bounding_box(request)
+    except KeyError:
+        bounds = None
+    except (GEOSException, ValueError):
+        raise BadRequest
+
+    zoom = None
+    if bounds is not None and "zoom" in request.GET:
+        try:
+            zoom = int(request.GET["zoom"])
+        except ValueError:
+            raise BadRequest
+        if not 0 <= zoom < CLUSTER_MAX_ZOOM:
+            zoom = None  # zoomed in enough to show individual vehicles
+
+    # (only for some vehicles, not all of them, as it may mean looking up their trips)
+    estimate = "estimate" in request.GET and any(
+        key in request.GET for key in ("service", "operator", "id")
+    )
+
+    if not any(key in request.GET for key in ("service", "operator", "id", "trip")):
+        if response := get_vehicles_json_snapshot(request, bounds, zoom):
+            return response
+
+    vehicle_ids = None
+    set_names = None
+    service_ids = None
+    operator_ids = None
+
+    if bounds is not None:
+        # ids of vehicles within box
+        xmin, ymin, xmax, ymax = bounds.extent
+
+        try:
+            # convert to kilometres (only for Redis to convert back to degrees)
+            width = haversine((ymin, xmax), (ymin, xmin))
+            height = haversine((ymin, xmax), (ymax, xmax))
+        except ValueError:
+            raise BadRequest
+
+        vehicle_ids = redis_client.geosearch(
+            "vehicle_location_locations",
+            longitude=str((xmax + xmin) / 2),
+            latitude=str((ymax + ymin) / 2),
+            unit="km",
+            width=str(width),
+            height=str(height),
+            withcoord=zoom is not None,
+        )
+
+        if zoom is not None:
+            clusters = get_clusters(
+                (coordinates for vehicle_id, coordinates in vehicle_ids), zoom
+            )
+            return respond_conditionally(
+                request,
+                JsonResponse(
+                    [cluster for tile in clusters.values() for cluster in tile],
+                    safe=False,
+                ),
+            )
+
+    elif "service" in request.GET:
+        try:
+            service_ids = [
+                int(service_id) for service_id in request.GET["service"].split(",")
+            ]
+        except ValueError:
+            raise BadRequest
+        set_names = [f"service{service_id}vehicles" for service_id in service_ids]
+    elif "operator" in request.GET:
+        operator_ids = request.GET["operator"].split(",")
+        set_names = [f"operator{operator_id}vehicles" for operator_id in operator_ids]
+    elif "id" in request.GET:
+        # specified vehicle ids
+        vehicle_ids = request.GET["id"].split(",")
+    else:
+        # ids of all vehicles
+        vehicle_ids = redis_client.zrange("vehicle_location_locations", 0, -1)
+
+    if set_names:
+        vehicle_ids = list(redis_client.sunion(set_names))
+
+    vehicle_ids = [int(vehicle_id) for vehicle_id in vehicle_ids]
+
+    vehicle_ids.sort()  # for etag stableness
+
+    trip = request.GET.get("trip")
+    if trip:
+        trip = int(trip)
+
+    locations = [
+        item
+        for vehicle_id, item in get_vehicle_locations(vehicle_ids, trip)
+        # (expired vehicles are removed from the sets by sweep_vehicle_locations)
+        if item and not (service_ids and item.get("service_id") not in service_ids)
+    ]
+
+    if estimate:
+        # where vehicles probably are now, rather than where they were
+        # when they last reported their locations (see estimate_position)
+        now = timezone.now()
+        load_trip_geometries([item for item in locations if "progress" in item])
+        for item in locations:
+            estimate_position(item, now)
+
     response = JsonResponse(locations, safe=False)
 
     return respond_conditionally(request, response)
 
 
+class VehicleLocationsBroadcast:
+    """A single subscription to the vehicle_locations channel per process, shared by
+    all vehicles_stream clients - each message is only decoded once, then put in
+    every client's queue.
+
+    A client that falls too far behind is sent None (as is everyone if the
+    subscription fails), and should end its stream so the browser reconnects.
+    """
+
+    max_queue_size = 100
+
+    def __init__(self):
+        self.queues = set()
+        self.task = None
+        self.ready = None
+
+    async def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.max_queue_size)
+        self.queues.add(queue)
+        if (
+            self.task is None
+            or self.task.done()
+            or self.task.get_loop() is not asyncio.get_running_loop()
+        ):
+            self.ready = asyncio.Event()
+            self.task = asyncio.create_task(self.listen(self.ready))
+        await self.ready.wait()
+        return queue
+
+    def unsubscribe(self, queue):
+        self.queues.discard(queue)
+        if not self.queues and self.task:
+            self.task.cancel()
+            self.task = None
+
+    def close(self, queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+        self.queues.discard(queue)
+
+    async def listen(self, ready):
+        client = get_async_redis_client()
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe("vehicle_locations")
+            ready.set()
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=20
+                )
+                if not message:
+                    continue
+                delta = json.loads(message["data"])
+                # (location without "sets", set names)
+                delta["moved"] = [
+                    (item, item.pop("sets")) for item in delta.get("moved", ())
+                ]
+                for queue in list(self.queues):
+                    try:
+                        queue.put_nowait(delta)
+                    except asyncio.QueueFull:
+                        self.close(queue)
+        finally:
+            ready.set()  # (if subscribing failed)
+            for queue in list(self.queues):
+                self.close(queue)
+            await pubsub.aclose()
+            await client.aclose()
+
+
+vehicle_locations_broadcast = VehicleLocationsBroadcast()
+
+
+@require_safe
+async def vehicles_stream(request):
+    """Server-sent events of changes to live locations, as they're saved by
+    ImportLiveVehiclesCommand (only works when served by buses/asgi.py).
+
+    Takes the same bounding box, service or operator filters as vehicles_json.
+    Each event is like {"changed": [locations], "expired": [vehicle ids]} -
+    "expired" includes vehicles that have left the bounding box or changed service.
+    Changed locations don't include vehicle details, so new vehicles should be
+    looked up with vehicles.json?id=
+    """
+    try:
+        bounds = get_bounding_box(request)
+    except KeyError:
+        bounds = None
+    except (GEOSException, ValueError):
+        raise BadRequest
+
+    set_names = None
+    if "service" in request.GET:
+        try:
+            set_names = {
+                f"service{int(service_id)}vehicles"
+                for service_id in request.GET["service"].split(",")
+            }
+        except ValueError:
+            raise BadRequest
+    elif "operator" in request.GET:
+        set_names = {
+            f"operator{operator_id}vehicles"
+            for operator_id in request.GET["operator"].split(",")
+        }
+
+    if bounds:
+        xmin, ymin, xmax, ymax = bounds.extent
+
+    def matches(item, sets) -> bool:
+        if set_names and set_names.isdisjoint(sets):
+            return False
+        if bounds:
+            x, y = item["coordinates"]
+            return xmin <= x <= xmax and ymin <= y <= ymax
+        return True
+
+    async def stream():
+        queue = await vehicle_locations_broadcast.subscribe()
+        try:
+            client = get_async_redis_client()
+
+            # vehicles the client already knows about (from vehicles.json)
+            if set_names:
+                known = await client.sunion(list(set_names))
+            elif bounds:
+                known = await client.geosearch(
+                    "vehicle_location_locations",
+                    longitude=(xmax + xmin) / 2,
+                    latitude=(ymax + ymin) / 2,
+                    unit="km",
+                    width=haversine((ymin, xmax), (ymin, xmin)),
+                    height=haversine((ymin, xmax), (ymax, xmax)),
+                )
+            else:
+                known = await client.zrange("vehicle_location_locations", 0, -1)
+            known = {int(vehicle_id) for vehicle_id in known}
+            await client.aclose()
+
+            yield "retry: 10000\n\n"
+            while True:
+                try:
+                    delta = await asyncio.wait_for(queue.get(), 20)
+                except TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if delta is None:
+                    break
+
+                changed = []
+                expired = []
+                for item, sets in delta["moved"]:
+                    if matches(item, sets):
+                        changed.append(item)
+                        known.add(item["id"])
+                    elif item["id"] in known:
+                        known.remove(item["id"])
+                        expired.append(item["id"])
+                for vehicle_id in delta.get("expired", ()):
+                    if vehicle_id in known:
+                        known.remove(vehicle_id)
+                        expired.append(vehicle_id)
+
+                if changed or expired:
+                    event = json.dumps({"changed": changed, "expired": expired})
+                    yield f"data: {event}\n\n"
+        finally:
+            vehicle_locations_broadcast.unsubscribe(queue)
+
+    return StreamingHttpResponse(
+        stream(),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 def get_dates(vehicle=None, service=None):
     if not vehicle:
         # the database query for a service is too slow
@@ -605,6 +969,14 @@ def journeys_list(request, journeys, service=None, vehicle=None) -> dict:
             for journey, location in zip(journeys, locations):
                 journey.locations = bool(location)
 
+    # or history moved out of redis
+    if journeys_without_locations := [
+        journey for journey in journeys if not getattr(journey, "locations", False)
+    ]:
+        archived = get_archived_journeys(journeys_without_locations)
+        for journey in journeys_without_locations:
+            journey.locations = journey.uuid in archived
+
     # "Track this bus" button
     if vehicle and vehicle.latest_journey_id:
         if redis_client and redis_client.get(f"vehicle{vehicle.id}"):
@@ -1011,6 +1383,49 @@ class VehicleJourneyDetailView(DetailView):
     model = VehicleJourney
 
 
+# stops of trips (and the trips in the same block that it runs into), for journey_json
+trip_stops = TripCache(maxsize=1000, ttl=3600)
+
+
+def get_trip_stops(trip) -> list[dict]:
+    stops = []
+    # previous_latlong = None
+
+    trips = trip.get_trips()
+    if trips == [trip]:
+        stoptimes = trips[0].stoptime_set.select_related("stop__locality")
+    else:
+        stoptimes = (
+            StopTime.objects.filter(trip__in=trips)
+            .order_by("trip__start", "id")
+            .select_related("stop__locality")
+        )
+        stoptimes = contiguous_stoptimes_only(stoptimes, trip.id)
+
+    for stoptime in stoptimes:
+        stop = stoptime.stop
+        # if stop := stoptime.stop:
+        #     if stop.latlong:
+        #         if previous_latlong:
+        #             heading = calculate_bearing(previous_latlong, stop.latlong)
+        #         else:
+        #             heading = None
+        #         previous_latlong = stop.latlong
+        stops.append(
+            {
+                "id": stoptime.id,
+                "atco_code": stoptime.stop_id,
+                "name": (stop.get_name_for_timetable() if stop else stoptime.stop_code),
+                "aimed_arrival_time": stoptime.arrival_time(),
+                "aimed_departure_time": stoptime.departure_time(),
+                "minor": stoptime.is_minor(),
+                "heading": stop and stop.get_heading(),
+                "coordinates": stop and stop.latlong and stop.latlong.coords,
+            }
+        )
+    return stops
+
+
 @require_safe
 def journey_json(request, pk, vehicle_id=None, service_id=None):
     journey = get_object_or_404(
@@ -1033,85 +1448,79 @@ def journey_json(request, pk, vehicle_id=None, service_id=None):
         locations = redis_client and redis_client.lrange(journey.get_redis_key(), 0, -1)
     else:
         locations = None
+    if not locations:
+        locations = get_archived_locations(journey)
 
+    records = None
     if locations:
-        locations = [
-            VehicleLocation.decode_appendage(location) for location in locations
-        ]
-        locations.sort(key=lambda location: location["datetime"])
-
-        data["locations"] = []
+        records = decode_locations(locations)
+        del locations
 
+        # skip all but the first and last of each run of locations close together
+        # (each location is compared to the last one included, so this can't be
+        # done as an array operation, but only indices are juggled here)
+        indices = []
         stationary = False
-        previous = None
-        previous_coords = None
-        for location in locations:
-            coords = location["coordinates"]
-
-            if previous_coords:
-                dx = coords[0] - previous_coords[0]
-                dy = coords[1] - previous_coords[1]
+        previous_x = previous_y = None
+        for i, (x, y) in enumerate(
+            zip(records["longitude"].tolist(), records["latitude"].tolist())
+        ):
+            if previous_x is not None:
+                dx = x - previous_x
+                dy = y - previous_y
                 if dx * dx + dy * dy < 2.5e-7:  # 0.0005 degrees squared
                     stationary = True
                 elif stationary:
                     # mark end of stationary period
-                    data["locations"].append(previous)
+                    indices.append(i - 1)
                     stationary = False
 
             if not stationary:
-                data["locations"].append(location)
+                indices.append(i)
 
-                previous_coords = coords
-
-            previous = location
+                previous_x = x
+                previous_y = y
 
         if stationary:  # add last location
-            data["locations"].append(location)
+            indices.append(i)
 
-        del locations
+        records = records[indices]
+
+        tzinfo = timezone.get_current_timezone()
+        data["locations"] = [
+            {
+                "id": timestamp,
+                "coordinates": (longitude, latitude),
+                "delta": delay if has_delay else None,
+                "direction": heading if has_heading else None,
+                "datetime": datetime.datetime.fromtimestamp(timestamp, tzinfo),
+            }
+            for (
+                timestamp,
+                longitude,
+                latitude,
+                has_heading,
+                heading,
+                has_delay,
+                delay,
+            ) in records.tolist()
+        ]
 
     # if not trip - calculate using time and first location?
     # if not trip:
     #     Trip
 
     if journey.trip:
-        data["stops"] = []
-        # previous_latlong = None
-
-        trips = journey.trip.get_trips()
-        if trips == [journey.trip]:
-            stoptimes = trips[0].stoptime_set.select_related("stop__locality")
-        else:
-            stoptimes = (
-                StopTime.objects.filter(trip__in=trips)
-                .order_by("trip__start", "id")
-                .select_related("stop__locality")
-            )
-            stoptimes = contiguous_stoptimes_only(stoptimes, journey.trip.id)
-
-        for stoptime in stoptimes:
-            stop = stoptime.stop
-            # if stop := stoptime.stop:
-            #     if stop.latlong:
-            #         if previous_latlong:
-            #             heading = calculate_bearing(previous_latlong, stop.latlong)
-            #         else:
-            #             heading = None
-            #         previous_latlong = stop.latlong
-            data["stops"].append(
-                {
-                    "id": stoptime.id,
-                    "atco_code": stoptime.stop_id,
-                    "name": (
-                        stop.get_name_for_timetable() if stop else stoptime.stop_code
-                    ),
-                    "aimed_arrival_time": stoptime.arrival_time(),
-                    "aimed_departure_time": stoptime.departure_time(),
-                    "minor": stoptime.is_minor(),
-                    "heading": stop and stop.get_heading(),
-                    "coordinates": stop and stop.latlong and stop.latlong.coords,
-                }
-            )
+        trip_stops.check_services_modified()
+        try:
+            stops = trip_stops[journey.trip_id]
+        except KeyError:
+            stops = get_trip_stops(journey.trip)
+            # (unless some stops have no locations yet - a stops import might add them)
+            if all(stop["coordinates"] for stop in stops):
+                trip_stops[journey.trip_id] = stops
+        # (copies, as actual departure times might be added below)
+        data["stops"] = [stop.copy() for stop in stops]
     elif journey.service_id:
         stop_usages = StopUsage.objects.filter(
             service_id=journey.service_id
@@ -1145,9 +1554,9 @@ def journey_json(request, pk, vehicle_id=None, service_id=None):
 
         if stops:
             stop_coords = [stop["coordinates"][::-1] for stop in stops]
-            vehicle_coords = [
-                location["coordinates"][::-1] for location in data["locations"]
-            ]
+            vehicle_coords = np.column_stack(
+                (records["latitude"], records["longitude"])
+            )
             # pre-build stop headings array for azimuth filtering; NaN = unknown
             stop_headings = np.array(
                 [s["heading"] if s["heading"] is not None else np.nan for s in stops],
@@ -1163,26 +1572,28 @@ def journey_json(request, pk, vehicle_id=None, service_id=None):
             except ValueError as e:
                 logging.exception(e)
             else:
-                for distances, location in zip(
-                    haversine_vector_results, data["locations"]
-                ):
-                    vehicle_heading = location.get("direction")
-                    if vehicle_heading is not None:
-                        # mask stops whose heading differs by ≥ 90° from vehicle
-                        # heading_diff in [0, 180]; NaN headings are always kept
-                        heading_diff = np.abs(
-                            ((stop_headings - vehicle_heading) + 180) % 360 - 180
-                        )
-                        aligned = np.isnan(heading_diff) | (heading_diff < 90)
-                        if aligned.any():
-                            idx = int(np.argmin(np.where(aligned, distances, np.inf)))
-                        else:
-                            idx = int(np.argmin(distances))
-                    else:
-                        idx = int(np.argmin(distances))
-
-                    if distances[idx] < 100:
-                        stops[idx]["actual_departure_time"] = location["datetime"]
+                vehicle_headings = np.where(
+                    records["has_heading"], records["heading"], np.nan
+                )
+                # mask stops whose heading differs by ≥ 90° from vehicle
+                # heading_diff in [0, 180]; NaN headings are always kept
+                heading_diff = np.abs(
+                    ((stop_headings - vehicle_headings[:, np.newaxis]) + 180) % 360
+                    - 180
+                )
+                aligned = np.isnan(heading_diff) | (heading_diff < 90)
+                # (unless no stops are aligned)
+                aligned[~aligned.any(axis=1)] = True
+                nearest = np.argmin(
+                    np.where(aligned, haversine_vector_results, np.inf), axis=1
+                )
+                nearest_distances = haversine_vector_results[
+                    np.arange(len(nearest)), nearest
+                ]
+                for i in np.flatnonzero(nearest_distances < 100):
+                    stops[nearest[i]]["actual_departure_time"] = data["locations"][i][
+                        "datetime"
+                    ]
 
             # work out which direction we're going in
             inbound = datetime.timedelta()
@@ -1269,10 +1680,11 @@ def debug(request):
                 with transaction.atomic():
                     command = import_bod_avl.Command()
                     command.do_source()
-                    vehicle, created = command.get_vehicle(item)
-                    journey = command.get_journey(item, vehicle)
+                    activity = command.get_activity(item)
+                    vehicle, created = command.get_vehicle(activity)
+                    journey = command.get_journey(activity, vehicle)
                     if not journey.datetime:
-                        journey.datetime = command.get_datetime(item)
+                        journey.datetime = activity.datetime
                     raise Exception
             except Exception:
                 pass
@@ -1287,23 +1699,37 @@ def debug(request):
     return render(request, "vehicles/debug.html", {"form": form, "result": result})
 
 
+def add_post(subscription, request):
+    """add the raw body to the subscription's stream of recent posts
+    and return quickly, leaving the parsing to the handle_siri_post task
+    (or the consume_siri_posts command)
+    """
+    # (message ids start with a timestamp in milliseconds)
+    min_timestamp = timezone.now().timestamp() - settings.SIRI_POST_STREAM_AGE
+    message_id = redis_client.xadd(
+        subscription.get_posts_key(),
+        {"content-type": request.content_type, "body": request.body},
+        minid=f"{int(min_timestamp * 1000)}-0",
+        approximate=False,  # (approximate trimming only happens every 100 or so)
+    )
+    if not settings.SIRI_POST_CONSUMER:
+        handle_siri_post(subscription.uuid, message_id)
+
+
 @csrf_exempt
 def siri_post(request, uuid):
     subscription = get_object_or_404(SiriSubscription, uuid=uuid)
-    last_post_key = subscription.get_status_key().replace("_status", "_last_post")
 
     if request.method == "GET":
-        last_post = cache.get(last_post_key)
+        messages = redis_client.xrevrange(subscription.get_posts_key(), count=1)
+        if not messages:
+            raise Http404
+        _, last_post = messages[0]
         return HttpResponse(
-            last_post["body"], content_type=last_post["headers"]["content-type"]
+            last_post[b"body"], content_type=last_post[b"content-type"].decode()
         )
 
-    body = request.body.decode()
-    data = xmltodict.parse(body, force_list=["VehicleActivity"])
-
-    handle_siri_post(uuid, data)
-
-    cache.set(last_post_key, {"headers": request.headers, "body": body}, None)
+    add_post(subscription, request)
 
     return HttpResponse(
         xmltodict.unparse(
@@ -1330,46 +1756,7 @@ def siri_post(request, uuid):
 def overland(request, uuid):
     subscription = get_object_or_404(SiriSubscription, uuid=uuid)
 
-    data = json.loads(request.body)
-
-    for item in data["locations"][-1:]:
-        when = item["properties"]["timestamp"]
-        device_id = item["properties"]["device_id"]
-        operator, vehicle, line_name, journey_ref = device_id.split(":")
-        lon, lat = item["geometry"]["coordinates"]
-        activity = {
-            "RecordedAtTime": when,
-            "MonitoredVehicleJourney": {
-                "OperatorRef": operator,
-                "VehicleRef": vehicle,
-                "PublishedLineName": line_name,
-                "VehicleJourneyRef": journey_ref,
-                "VehicleLocation": {
-                    "Longitude": lon,
-                    "Latitude": lat,
-                },
-            },
-        }
-
-        handle_siri_post(
-            uuid,
-            {
-                "Siri": {
-                    "ServiceDelivery": {
-                        "ResponseTimestamp": when,
-                        "VehicleMonitoringDelivery": {
-                            "VehicleActivity": [activity],
-                        },
-                    }
-                }
-            },
-        )
-
-    cache.set(
-        subscription.get_status_key().replace("_status", "_last_post"),
-        {"headers": request.headers, "body": request.body.decode()},
-        None,
-    )
+    add_post(subscription, request)
 
     # https://github.com/aaronpk/Overland-iOS#api
     return JsonResponse({"result": "ok"})